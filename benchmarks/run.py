@@ -0,0 +1,218 @@
+import argparse
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import av
+import cv2
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.express as px
+
+from benchmarks.synthetic import synthetic_case
+from movesense import core, plotting
+from movesense.models import pose_solution
+
+# (width, height, source fps, seconds)
+FULL_CASES = [(640, 480, 30, 10), (1280, 720, 30, 10), (1280, 720, 60, 10), (1920, 1080, 30, 10), (1280, 720, 30, 60)]
+QUICK_CASES = [(640, 480, 30, 4), (1280, 720, 60, 4)]
+
+
+def _timed(run, repeat):
+    # Best wall time of several runs; run() returns the number of frames it handled
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = run()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return {'frames': frames,
+            'seconds': round(best, 6),
+            'fps': round(frames / best, 2) if best else None,
+            'ms_per_frame': round(1000 * best / frames, 4) if frames else None}
+
+
+def _pose_solution():
+    # (mp.solutions.pose, None), or (None, why the pose stages are skipped);
+    # MediaPipe is only imported here, so every other stage runs without it
+    try:
+        return pose_solution(), None
+    except ImportError:
+        return None, 'mediapipe is not installed'
+    except AttributeError:
+        return None, 'mediapipe.solutions is not available in this mediapipe build'
+
+
+def _mediapipe_version():
+    try:
+        return importlib.metadata.version('mediapipe')
+    except importlib.metadata.PackageNotFoundError:
+        return 'not installed'
+
+
+def _sampled(path, sample_fps):
+    container = core.open_video_container(path)
+    frames = [frame for _, frame in core.sampled_frames(container, sample_fps)]
+    container.close()
+    return frames
+
+
+def bench_case(path, landmarks, source_fps, sample_fps, repeat, profiles):
+    stages = {}
+
+    def decode(fps):
+        def run():
+            container = core.open_video_container(path)
+            count = sum(1 for _ in core.sampled_frames(container, fps))
+            container.close()
+            return count
+        return run
+
+    stages['decode_sampled'] = _timed(decode(sample_fps), repeat)
+    stages['decode_full'] = _timed(decode(source_fps), repeat)
+
+    frames = _sampled(path, sample_fps)
+    # Fixture landmarks at the sampled times stand in for inference output in later stages
+    sample_landmarks = landmarks[np.clip(np.round(np.arange(len(frames)) * source_fps / sample_fps).astype(int), 0, len(landmarks) - 1)]
+
+    pose_module, skipped = _pose_solution()
+    if pose_module is not None:
+        def model_load():
+            # Cold start of one pose model: loading the graph plus its first inference
+            model = pose_module.Pose(min_detection_confidence=0.85, min_tracking_confidence=0.85)
+            model.process(frames[0])
+            model.close()
+            return 1
+        stages['model_load'] = _timed(model_load, 1)
+
+        def pose():
+            with pose_module.Pose(min_detection_confidence=0.85, min_tracking_confidence=0.85) as model:
+                for frame in frames:
+                    model.process(frame)
+            return len(frames)
+        stages['pose'] = _timed(pose, 1)
+    else:
+        stages['model_load'] = {'skipped': skipped}
+        stages['pose'] = {'skipped': skipped}
+
+    valid = np.ones(len(landmarks), dtype=bool)
+    triplets = list(core.JOINT_ANGLE_TRIPLETS.values())
+    stages['angles'] = _timed(lambda: len(core.compute_joint_angles(landmarks, valid, triplets)), repeat)
+    stages['angles_3d'] = _timed(lambda: len(core.compute_joint_angles(landmarks, valid, triplets, use_3d=True)), repeat)
+
+    renderer = core.OverlayRenderer(core.JOINT_COLORS, 1.0, 2, 'White', 2, 5)
+
+    def overlay():
+        for frame, frame_landmarks in zip(frames, sample_landmarks):
+            renderer.draw(frame.copy(), frame_landmarks)
+        return len(frames)
+    stages['overlay'] = _timed(overlay, repeat)
+
+    height, width = frames[0].shape[:2]
+    for profile in profiles:
+        size = core.output_size(width, height, core.ENCODER_PROFILES[profile]['height'])
+        resized = [cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames]
+
+        def encode():
+            core.create_video(resized, size[1], size[0], sample_fps, profile=profile, frame_format='rgb24')
+            return len(resized)
+        stages[f'encode_{profile.replace(" ", "_")}'] = _timed(encode, repeat)
+
+    store = core.LandmarkStore()
+    for i, frame_landmarks in enumerate(landmarks):
+        store.append(frame_landmarks, i / source_fps)
+    df_joint_angles = core.calculate_joint_angles(store.trim())
+
+    def plot():
+        figure = plotting.series_figure(df_joint_angles, list(df_joint_angles.columns), core.JOINT_COLORS, 500)
+        figure.to_json()
+        return len(df_joint_angles)
+    stages['plot'] = _timed(plot, repeat)
+
+    def plot_full():
+        # Every sample through plotly express, as the app plotted before downsampling
+        figure = px.line(df_joint_angles, y=list(df_joint_angles.columns), color_discrete_map=core.JOINT_COLORS)
+        figure.to_json()
+        return len(df_joint_angles)
+    stages['plot_full'] = _timed(plot_full, repeat)
+    return stages
+
+
+def environment():
+    return {'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'av': av.__version__,
+                         'opencv': cv2.__version__, 'mediapipe': _mediapipe_version(),
+                         'plotly': plotly.__version__}}
+
+
+def compare(results, baseline, threshold):
+    # Print ms/frame against the baseline and return the stages that got slower than threshold allows
+    regressions = []
+    previous = {case['name']: case['stages'] for case in baseline['cases']}
+    print(f'{"case":<24}{"stage":<28}{"ms/frame":>12}{"baseline":>12}{"change":>10}')
+    for case in results['cases']:
+        for stage, current in case['stages'].items():
+            before = previous.get(case['name'], {}).get(stage, {})
+            if current.get('ms_per_frame') is None or before.get('ms_per_frame') is None:
+                continue
+            change = current['ms_per_frame'] / before['ms_per_frame'] - 1
+            print(f'{case["name"]:<24}{stage:<28}{current["ms_per_frame"]:>12.3f}{before["ms_per_frame"]:>12.3f}{change:>+10.1%}')
+            if change > threshold:
+                regressions.append((case['name'], stage, change))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Offline stage-level benchmarks on synthetic videos.')
+    parser.add_argument('--quick', action='store_true', help='Two short cases instead of the full matrix.')
+    parser.add_argument('--sample-fps', type=float, default=3, help='Analysis frame rate, as set in the app.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage; the best time is reported.')
+    parser.add_argument('--profiles', nargs='+', default=['fast preview', 'standard'], choices=list(core.ENCODER_PROFILES))
+    parser.add_argument('--video-dir', default=os.path.join(tempfile.gettempdir(), 'movesense_bench'),
+                        help='Where synthetic videos are generated and reused between runs.')
+    parser.add_argument('--output', default='bench_results.json', help='JSON file for the results.')
+    parser.add_argument('--baseline', help='Earlier results JSON to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown against the baseline that counts as a regression.')
+    options = parser.parse_args(argv)
+
+    os.makedirs(options.video_dir, exist_ok=True)
+    results = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'environment': environment(),
+               'sample_fps': options.sample_fps,
+               'cases': []}
+    for width, height, fps, seconds in (QUICK_CASES if options.quick else FULL_CASES):
+        name = f'{width}x{height}@{fps}x{seconds}s'
+        print(f'{name} ...', flush=True)
+        path, landmarks = synthetic_case(options.video_dir, width, height, fps, seconds)
+        stages = bench_case(path, landmarks, fps, options.sample_fps, options.repeat, options.profiles)
+        results['cases'].append({'name': name, 'width': width, 'height': height, 'fps': fps, 'seconds': seconds,
+                                 'stages': stages})
+        for stage, result in stages.items():
+            if 'skipped' in result:
+                print(f'  {stage:<28}skipped: {result["skipped"]}')
+            else:
+                print(f'  {stage:<28}{result["fps"]:>12.1f} frames/s{result["ms_per_frame"]:>12.3f} ms/frame')
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {options.output}')
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.threshold)
+        if regressions:
+            print(f'{len(regressions)} stages slower than the baseline by more than {options.threshold:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
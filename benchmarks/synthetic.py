@@ -0,0 +1,94 @@
+import os
+from fractions import Fraction
+
+import av
+import cv2
+import numpy as np
+
+# Resting pose of the landmarks the app uses, in normalized image coordinates
+_REST_POSE = {
+    0: (0.50, 0.15),   # nose
+    11: (0.42, 0.30), 12: (0.58, 0.30),   # shoulders
+    13: (0.38, 0.45), 14: (0.62, 0.45),   # elbows
+    15: (0.36, 0.58), 16: (0.64, 0.58),   # wrists
+    19: (0.35, 0.62), 20: (0.65, 0.62),   # index fingers
+    23: (0.45, 0.58), 24: (0.55, 0.58),   # hips
+    25: (0.44, 0.74), 26: (0.56, 0.74),   # knees
+    27: (0.44, 0.90), 28: (0.56, 0.90),   # ankles
+    31: (0.41, 0.94), 32: (0.59, 0.94),   # foot indices
+}
+
+# Segments drawn for the synthetic figure
+_BONES = [(11, 12), (11, 13), (13, 15), (15, 19), (12, 14), (14, 16), (16, 20),
+          (11, 23), (12, 24), (23, 24), (23, 25), (25, 27), (27, 31), (24, 26), (26, 28), (28, 32)]
+
+
+def _rotate(points, pivot, joint, angle):
+    # Rotate a landmark and everything hanging off it around a pivot landmark
+    chains = {13: [13, 15, 19], 14: [14, 16, 20], 15: [15, 19], 16: [16, 20],
+              25: [25, 27, 31], 26: [26, 28, 32], 27: [27, 31], 28: [28, 32]}
+    c, s = np.cos(angle), np.sin(angle)
+    for idx in chains[joint]:
+        offset = points[:, idx, :2] - points[:, pivot, :2]
+        points[:, idx, 0] = points[:, pivot, 0] + c * offset[:, 0] - s * offset[:, 1]
+        points[:, idx, 1] = points[:, pivot, 1] + s * offset[:, 0] + c * offset[:, 1]
+
+
+def figure_landmarks(n_frames, fps, seed = 0):
+    # (frames, 33, 4) landmark fixture of a figure swinging its arms and legs
+    # while drifting sideways; landmarks the figure does not use stay at the nose
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_frames) / fps
+    points = np.zeros((n_frames, 33, 4), dtype=np.float32)
+    points[:, :, :2] = _REST_POSE[0]
+    for idx, (x, y) in _REST_POSE.items():
+        points[:, idx, 0] = x
+        points[:, idx, 1] = y
+    swing = 0.6 * np.sin(2 * np.pi * 0.5 * t)
+    bend = 0.4 * (1 + np.sin(2 * np.pi * 0.8 * t))
+    _rotate(points, 11, 13, swing)
+    _rotate(points, 12, 14, -swing)
+    _rotate(points, 13, 15, bend)
+    _rotate(points, 14, 16, -bend)
+    _rotate(points, 23, 25, -0.5 * swing)
+    _rotate(points, 24, 26, 0.5 * swing)
+    _rotate(points, 25, 27, 0.5 * bend)
+    _rotate(points, 26, 28, 0.5 * bend)
+    points[:, :, 0] += (0.1 * np.sin(2 * np.pi * 0.1 * t))[:, None]
+    points[:, :, :2] += rng.normal(0, 0.001, points[:, :, :2].shape)
+    points[:, :, 2] = rng.normal(0, 0.05, points[:, :, 2].shape)
+    points[:, :, 3] = 1.0
+    return points
+
+
+def write_video(path, landmarks, width, height, fps):
+    # Render the landmark fixture as a filled stick figure on a plain background
+    container = av.open(path, 'w')
+    stream = container.add_stream('h264', Fraction(fps).limit_denominator(1001))
+    stream.width = width
+    stream.height = height
+    stream.pix_fmt = 'yuv420p'
+    stream.options = {'preset': 'ultrafast', 'crf': '23'}
+    thickness = max(2, height // 40)
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    for frame_landmarks in landmarks:
+        frame[:] = (70, 90, 110)
+        points = (frame_landmarks[:, :2] * (width, height)).astype(np.int32)
+        for a, b in _BONES:
+            cv2.line(frame, tuple(points[a]), tuple(points[b]), (230, 200, 170), thickness)
+        cv2.circle(frame, tuple(points[0]), height // 14, (230, 200, 170), -1)
+        for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format='rgb24')):
+            container.mux(packet)
+    for packet in stream.encode(None):
+        container.mux(packet)
+    container.close()
+
+
+def synthetic_case(directory, width, height, fps, seconds):
+    # Video file and landmark fixture for one case, generated once and reused
+    n_frames = int(round(fps * seconds))
+    landmarks = figure_landmarks(n_frames, fps)
+    path = os.path.join(directory, f'figure_{width}x{height}_{fps}fps_{seconds}s.mp4')
+    if not os.path.exists(path):
+        write_video(path, landmarks, width, height, fps)
+    return path, landmarks
@@ -0,0 +1,83 @@
+import importlib
+
+# Public names and the submodule each comes from. They are imported on first
+# use, so importing one submodule (the CLI, a service worker) does not load
+# OpenCV, PyAV, pandas and the rest for every other one.
+_EXPORTS = {
+    'AnalyticsStore': 'analytics',
+    'BROWSER_ENCODER_PROFILES': 'core',
+    'BufferReader': 'core',
+    'DEFAULT_ENCODER_PROFILE': 'core',
+    'ENCODER_PROFILES': 'core',
+    'JOINT_ANGLE_TRIPLETS': 'core',
+    'JOINT_COLORS': 'core',
+    'KINEMATIC_QUANTITIES': 'core',
+    'LANDMARK_NAMES': 'core',
+    'LandmarkStore': 'core',
+    'OverlayRenderer': 'core',
+    'PoseEstimator': 'core',
+    'StillPoseEstimator': 'core',
+    'calculate_joint_angles': 'core',
+    'compute_joint_angles': 'core',
+    'compute_kinematics': 'core',
+    'create_video': 'core',
+    'draw_pose_overlay': 'core',
+    'extract_pose_landmarks': 'core',
+    'extract_pose_landmarks_parallel': 'core',
+    'hex_to_rgb': 'core',
+    'image_resize': 'core',
+    'infer_landmarks': 'core',
+    'inference_frame_size': 'core',
+    'keyframe_landmarks': 'core',
+    'map_video_file': 'core',
+    'open_video_container': 'core',
+    'output_size': 'core',
+    'run_pipeline': 'core',
+    'sampled_frame_count': 'core',
+    'sampled_frames': 'core',
+    'smooth_joint_angles': 'core',
+    'spooled_video_output': 'core',
+    'stream_pose_video': 'core',
+    'summarize_kinematics': 'core',
+    'video_duration': 'core',
+    'video_file_path': 'core',
+    'EXPORT_FORMATS': 'export',
+    'available_formats': 'export',
+    'export_session': 'export',
+    'session_arrays': 'export',
+    'session_frame': 'export',
+    'FrameStore': 'frames',
+    'FrameStoreWriter': 'frames',
+    'Job': 'jobs',
+    'JobCancelled': 'jobs',
+    'CausalSmoother': 'live',
+    'FrameDropQueue': 'live',
+    'LiveSession': 'live',
+    'capture_frames': 'live',
+    'RunMetrics': 'metrics',
+    'SamplingProfiler': 'metrics',
+    'profile_run': 'metrics',
+    'PosePool': 'models',
+    'default_pose_pool': 'models',
+    'DEFAULT_SCHEMA': 'schema',
+    'JointSchema': 'schema',
+    'default_schema': 'schema',
+    'load_schema': 'schema',
+    'AdmissionError': 'service',
+    'InferenceService': 'service',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'{__name__}.{module}'), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,5 @@
+import sys
+
+from movesense.cli import main
+
+sys.exit(main())
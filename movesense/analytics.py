@@ -0,0 +1,252 @@
+import ast
+import datetime
+import importlib.util
+import json
+import operator
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from movesense.cache import result_key, video_hash
+from movesense.export import series_column, session_arrays, session_frame
+
+try:
+    import fcntl
+except ImportError:  # Windows; the index is then only serialized within one process
+    fcntl = None
+
+# Statistics of each quantity kept in the summary index, one column per joint
+INDEX_STATISTICS = {'angle': ['min', 'max', 'mean', 'range'], 'speed': ['mean', 'max']}
+
+
+def index_column(joint, quantity, statistic):
+    # Summary index column, e.g. right_knee_angle_range
+    return f'{series_column(joint, quantity)}_{statistic}'
+
+
+# Operators a session filter may compare with
+FILTER_COMPARISONS = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+                      ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+
+def _filter_operand(node, index):
+    # A column of the index, or a constant such as 90, -1.5 or 'A'
+    if isinstance(node, ast.Name):
+        if node.id == index.index.name:
+            return index.index.to_series()
+        if node.id in index.columns:
+            return index[node.id]
+        raise ValueError(f'Unknown column {node.id!r}')
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool)):
+        return node.value
+    if (isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd))
+            and isinstance(node.operand, ast.Constant) and isinstance(node.operand.value, (int, float))):
+        return -node.operand.value if isinstance(node.op, ast.USub) else node.operand.value
+    raise ValueError('Comparisons can only use index columns and constants')
+
+
+def _filter_mask(node, index):
+    # Boolean mask of the sessions a parsed filter selects. Only comparisons joined
+    # with and, or and not are accepted; nothing in the filter is ever evaluated.
+    if isinstance(node, ast.BoolOp):
+        masks = [_filter_mask(value, index) for value in node.values]
+        combine = operator.and_ if isinstance(node.op, ast.And) else operator.or_
+        mask = masks[0]
+        for other in masks[1:]:
+            mask = combine(mask, other)
+        return mask
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return ~_filter_mask(node.operand, index)
+    if isinstance(node, ast.Compare):
+        mask = pd.Series(True, index=index.index)
+        left = _filter_operand(node.left, index)
+        for op, comparator in zip(node.ops, node.comparators):
+            if type(op) not in FILTER_COMPARISONS:
+                raise ValueError('Filters can only compare with ==, !=, <, <=, > and >=')
+            right = _filter_operand(comparator, index)
+            mask = mask & FILTER_COMPARISONS[type(op)](left, right)
+            left = right
+        return mask
+    raise ValueError('Filters are comparisons of index columns joined with and, or and not')
+
+
+def filter_sessions(index, query):
+    # Sessions of the summary index matching a filter such as
+    # "right_knee_angle_range < 90 and subject == 'A'"
+    try:
+        tree = ast.parse(query, mode='eval')
+    except SyntaxError as error:
+        raise ValueError(f'Invalid filter: {error.msg}') from None
+    return index[_filter_mask(tree.body, index).fillna(False).astype(bool)]
+
+
+def series_format():
+    # How session series are stored: 'parquet' when pyarrow is installed, else 'npz'
+    return 'parquet' if importlib.util.find_spec('pyarrow') is not None else 'npz'
+
+
+class AnalyticsStore:
+    # Analyses of many sessions on disk, for queries and comparisons across them
+    # without processing any video again. Every session has a directory of its
+    # own with its full series (landmarks and kinematics per frame, in Parquet
+    # when pyarrow is installed and npz otherwise). index.jsonl holds one line
+    # per session with its metadata, duration, frame count and the per-joint
+    # summary statistics, so filters only ever read the index.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'sessions'), exist_ok=True)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, 'index.jsonl')
+
+    def _session_dir(self, session_id):
+        return os.path.join(self.directory, 'sessions', session_id)
+
+    def _series_path(self, session_id):
+        for name in ('series.parquet', 'series.npz'):
+            path = os.path.join(self._session_dir(session_id), name)
+            if os.path.exists(path):
+                return path
+        raise KeyError(session_id)
+
+    @contextmanager
+    def _exclusive(self):
+        # Serializes index reads and writes between threads and, where available,
+        # processes, e.g. the app and a CLI batch saving to the same library
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, 'index.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _records(self):
+        # Callers hold _exclusive
+        try:
+            with open(self._index_path) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def add_session(self, store, df_kinematics, df_summary, name = None, subject = None, recorded = None, notes = None, session_id = None):
+        # Save one analysis; df_kinematics and df_summary come from compute_kinematics
+        # and summarize_kinematics. The id defaults to a hash of the series, so saving
+        # the same analysis twice keeps one copy. Returns the session id.
+        session_id = session_id or result_key(video_hash(store.landmarks), kinematics=video_hash(np.ascontiguousarray(df_kinematics.to_numpy())))[:16]
+        with self._exclusive():
+            if any(record['session_id'] == session_id for record in self._records()):
+                return session_id
+        # The series go into a temporary directory outside the lock, which is then
+        # renamed into place together with the index line, so a session directory
+        # is always complete and indexed sessions always have one
+        staging = tempfile.mkdtemp(dir=os.path.join(self.directory, 'sessions'), prefix='.partial-')
+        try:
+            if series_format() == 'parquet':
+                session_frame(store, df_kinematics).to_parquet(os.path.join(staging, 'series.parquet'), compression='zstd', index=False)
+            else:
+                np.savez_compressed(os.path.join(staging, 'series.npz'), **session_arrays(store, df_kinematics, df_summary))
+
+            timestamps = store.timestamps
+            record = {'session_id': session_id,
+                      'name': name,
+                      'subject': subject,
+                      'recorded': (recorded or datetime.datetime.now()).isoformat(timespec='seconds'),
+                      'added': datetime.datetime.now().isoformat(timespec='seconds'),
+                      'notes': notes,
+                      'duration': float(timestamps[-1] - timestamps[0]) if len(timestamps) else 0.0,
+                      'frames': len(store),
+                      'detected': float(store.valid.mean()) if len(store) else 0.0}
+            for quantity, statistics in INDEX_STATISTICS.items():
+                for joint in df_kinematics[quantity].columns:
+                    for statistic in statistics:
+                        value = df_summary.loc[(quantity, joint), statistic]
+                        record[index_column(joint, quantity, statistic)] = None if np.isnan(value) else float(value)
+
+            with self._exclusive():
+                # Checked again, as another process may have saved it meanwhile
+                if not any(existing['session_id'] == session_id for existing in self._records()):
+                    # Left over from a save that did not reach the index
+                    shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+                    os.replace(staging, self._session_dir(session_id))
+                    with open(self._index_path, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return session_id
+
+    def sessions(self, query = None):
+        # The summary index, one row per session, optionally filtered on its columns,
+        # e.g. "right_knee_angle_range < 90 and subject == 'A'"; see filter_sessions
+        with self._exclusive():
+            index = pd.DataFrame(self._records())
+        if index.empty:
+            return index
+        index['recorded'] = pd.to_datetime(index['recorded'])
+        index['added'] = pd.to_datetime(index['added'])
+        index = index.set_index('session_id').sort_values('recorded')
+        return filter_sessions(index, query) if query else index
+
+    def series(self, session_ids, joint, quantity = 'angle'):
+        # One joint's series of several sessions side by side, indexed by seconds
+        # from the start of each session. Only that column is read from each session.
+        column = series_column(joint, quantity)
+        series = {}
+        for session_id in session_ids:
+            path = self._series_path(session_id)
+            # Sessions saved with a schema without this joint give a missing series
+            if path.endswith('.parquet'):
+                try:
+                    frame = pd.read_parquet(path, columns=['time', column])
+                    seconds, values = frame['time'].to_numpy(), frame[column].to_numpy()
+                except ValueError:
+                    seconds = pd.read_parquet(path, columns=['time'])['time'].to_numpy()
+                    values = np.full(len(seconds), np.nan)
+            else:
+                with np.load(path) as data:
+                    joints = list(data['joints'])
+                    seconds = data['timestamps']
+                    if joint in joints:
+                        values = data['kinematics'][:, list(data['quantities']).index(quantity), joints.index(joint)]
+                    else:
+                        values = np.full(len(seconds), np.nan)
+            series[session_id] = pd.Series(values, index=pd.Index(np.round(seconds - seconds[0], 6), name='seconds'))
+        if not series:
+            return pd.DataFrame()
+        # Sessions analyzed at different frame rates are filled in at each other's
+        # times, while frames without a detection stay missing
+        index = pd.Index(np.unique(np.concatenate([values.index.to_numpy() for values in series.values()])), name='seconds')
+        aligned = {}
+        for session_id, values in series.items():
+            filled = values.dropna().reindex(index).interpolate(method='index', limit_area='inside')
+            filled[values.index[values.isna()]] = np.nan
+            aligned[session_id] = filled
+        return pd.DataFrame(aligned)
+
+    def remove(self, session_id):
+        # The index is rewritten to a temporary file that replaces it, so an
+        # interrupted removal never leaves it truncated
+        with self._exclusive():
+            records = [record for record in self._records() if record['session_id'] != session_id]
+            fd, partial = tempfile.mkstemp(dir=self.directory, suffix='.partial')
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(json.dumps(record) + '\n' for record in records)
+            os.replace(partial, self._index_path)
+            shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+
+def default_store():
+    # Location can be set with MOVESENSE_LIBRARY_DIR
+    directory = os.environ.get('MOVESENSE_LIBRARY_DIR', os.path.join(os.path.expanduser('~'), '.local', 'share', 'movesense'))
+    return AnalyticsStore(directory)
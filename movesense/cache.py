@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from movesense.core import LandmarkStore
+from movesense.frames import FrameStore, FrameStoreWriter
+from movesense.schema import default_schema
+
+try:
+    import fcntl
+except ImportError:  # Windows; eviction is then only serialized within one process
+    fcntl = None
+
+
+def video_hash(video):
+    # Hash of the video content; video is any bytes-like buffer, e.g. a memoryview or mmap
+    return hashlib.sha256(video).hexdigest()
+
+
+def result_key(video_digest, **params):
+    # Cache key for a video hash plus the parameters that change the result
+    digest = hashlib.sha256(video_digest.encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def content_key(video, **params):
+    return result_key(video_hash(video), **params)
+
+
+def landmarks_key(video_digest, fps, detectconfidence, trackconfidence, sampling, inference_height = None, roi = False,
+                  keyframe_interval = 1, optical_flow = False):
+    # Key of the landmarks of a video; only settings that change the inference are part of it.
+    # Numbers are normalized so e.g. fps 3 from the app and 3.0 from the CLI give the same key.
+    return result_key(video_digest, fps=float(fps), detectconfidence=float(detectconfidence), trackconfidence=float(trackconfidence),
+                      sampling=sampling, inference_height=None if inference_height is None else int(inference_height), roi=bool(roi),
+                      keyframe_interval=int(keyframe_interval), optical_flow=bool(optical_flow))
+
+
+def pose_video_key(video_digest, store, fps, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling, profile, schema = None):
+    # Key of an annotated video, drawn from the landmarks in store with this styling
+    # and the joints of schema (default_schema() if None)
+    return result_key(video_digest, fps=fps, sampling=sampling, landmarks=video_hash(store.landmarks),
+                      color_discrete_map=color_discrete_map, textscale=textscale, textsize=textsize,
+                      angletextcolor=angletextcolor, linesize=linesize, markersize=markersize, profile=profile,
+                      schema=(schema or default_schema()).digest)
+
+
+class ResultCache:
+    # On-disk cache of landmark arrays and rendered videos, keyed by content_key.
+    # Entries are written atomically, reads refresh the entry's modification time
+    # and the least recently used entries are evicted once the directory grows
+    # past max_bytes. Several app processes can share one directory.
+
+    def __init__(self, directory, max_bytes = 2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    @contextmanager
+    def _exclusive(self):
+        # Serializes eviction between threads and, where available, processes
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, key, suffix, read):
+        path = self._path(key, suffix)
+        try:
+            value = read(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # Missing, evicted by another process meanwhile, or unreadable
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    @contextmanager
+    def _writing(self, key, suffix):
+        # File object for a new entry, which appears under its key once the block completes
+        path = self._path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.partial')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.replace(partial, path)
+        except BaseException:
+            os.remove(partial)
+            raise
+        self.evict()
+
+    def _write(self, key, suffix, write):
+        with self._writing(key, suffix) as f:
+            write(f)
+
+    def get_landmarks(self, key):
+        def read(path):
+            with np.load(path) as data:
+                store = LandmarkStore()
+                store.__setstate__({'chunk_size': store.chunk_size,
+                                    'landmarks': data['landmarks'],
+                                    'valid': data['valid'],
+                                    'timestamps': data['timestamps']})
+            return store
+        return self._read(key, '.landmarks.npz', read)
+
+    def has_landmarks(self, key):
+        return os.path.exists(self._path(key, '.landmarks.npz'))
+
+    def put_landmarks(self, key, store):
+        self._write(key, '.landmarks.npz',
+                    lambda f: np.savez(f, landmarks=store.landmarks, valid=store.valid, timestamps=store.timestamps))
+
+    def get_video(self, key):
+        def read(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        return self._read(key, '.mp4', read)
+
+    def has_video(self, key):
+        # Whether a video is cached, without reading it or counting a hit or miss
+        return os.path.exists(self._path(key, '.mp4'))
+
+    def put_video(self, key, video_data):
+        # video_data is bytes or a file object such as a BytesIO or a spooled_video_output(),
+        # which is copied from its start in chunks
+        def write(f):
+            if isinstance(video_data, (bytes, bytearray, memoryview)):
+                f.write(video_data)
+            else:
+                video_data.seek(0)
+                shutil.copyfileobj(video_data, f, 1024 * 1024)
+        self._write(key, '.mp4', write)
+
+    def get_frames(self, key):
+        # Memory-mapped FrameStore of the annotated frames of a video
+        return self._read(key, '.frames', FrameStore)
+
+    def has_frames(self, key):
+        return os.path.exists(self._path(key, '.frames'))
+
+    @contextmanager
+    def frames_writer(self, key):
+        # FrameStoreWriter for the annotated frames of a video, stored under key
+        with self._writing(key, '.frames') as f:
+            writer = FrameStoreWriter(f)
+            yield writer
+            writer.close()
+
+    def get_export(self, key, extension):
+        def read(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        return self._read(key, '.export' + extension, read)
+
+    def put_export(self, key, extension, data):
+        self._write(key, '.export' + extension, lambda f: f.write(data))
+
+    def _entries(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.') or name.endswith('.partial'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return entries
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits in max_bytes
+        with self._exclusive():
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        entries = self._entries()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes}
+
+
+def default_cache():
+    # Location and size budget can be set with MOVESENSE_CACHE_DIR and MOVESENSE_CACHE_BYTES
+    directory = os.environ.get('MOVESENSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'movesense'))
+    return ResultCache(directory, int(os.environ.get('MOVESENSE_CACHE_BYTES', 2 * 1024 ** 3)))
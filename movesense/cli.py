@@ -0,0 +1,238 @@
+import argparse
+import collections
+import datetime
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from movesense import core
+from movesense.analytics import AnalyticsStore, series_format
+from movesense.cache import ResultCache, landmarks_key, video_hash
+from movesense.export import EXPORT_FORMATS, export_session, missing_formats
+from movesense.metrics import NULL_METRICS, RunMetrics, profile_run
+from movesense.schema import default_schema, load_schema
+
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv', '.m4v', '.webm'}
+
+
+def _input_root(pattern):
+    # Directory the videos matched by an input are named relative to: a directory
+    # itself, the part of a glob pattern before its first wildcard, or a file's directory
+    if os.path.isdir(pattern):
+        return pattern
+    parts = pattern.split(os.sep)
+    fixed = next((i for i, part in enumerate(parts) if glob.has_magic(part)), None)
+    if fixed is None:
+        return os.path.dirname(pattern)
+    return os.sep.join(parts[:fixed]) or ('' if parts[0] else os.sep)
+
+
+def find_videos(inputs):
+    # Expand directories and glob patterns into a sorted list of (video file, name)
+    # pairs. The name is the file's path relative to the input it was found
+    # through, without extension, so a/run.mp4 and b/run.mp4 under one directory
+    # get outputs of their own. Names of different files that still clash, e.g.
+    # two inputs x/run.mp4 and y/run.mp4, raise a ValueError.
+    names = {}
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            candidates = glob.glob(pattern, recursive=True)
+        root = _input_root(pattern)
+        for path in candidates:
+            if os.path.isfile(path) and os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+                names.setdefault(os.path.realpath(path), (path, os.path.splitext(os.path.relpath(path, root or os.curdir))[0]))
+    videos = sorted(names.values())
+    paths_by_name = collections.defaultdict(list)
+    for path, name in videos:
+        paths_by_name[os.path.normcase(name)].append(path)
+    clashes = [paths for paths in paths_by_name.values() if len(paths) > 1]
+    if clashes:
+        raise ValueError('Videos would write the same outputs: ' + '; '.join(', '.join(paths) for paths in clashes))
+    return videos
+
+
+def output_paths(name, output_dir, video = True, exports = ()):
+    # Outputs of the video with this find_videos name; subdirectories of the
+    # input are mirrored in output_dir
+    stem = os.path.join(output_dir, name)
+    paths = {'landmarks': f'{stem}_landmarks.csv',
+             'angles': f'{stem}_angles.csv'}
+    if video:
+        paths['video'] = f'{stem}_pose.mp4'
+    for export_format in exports:
+        paths[export_format] = f'{stem}_session{EXPORT_FORMATS[export_format][0]}'
+    return paths
+
+
+def is_processed(name, output_dir, video = True, exports = ()):
+    return all(os.path.exists(path) for path in output_paths(name, output_dir, video, exports).values())
+
+
+def _write_atomic(path, write):
+    # Write under a temporary name first so an interrupted run never looks finished
+    os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+    partial = path + '.partial'
+    write(partial)
+    os.replace(partial, path)
+
+
+def metrics_path(name, output_dir):
+    return os.path.join(output_dir, f'{name}_metrics.json')
+
+
+def process_video(video_path, name, output_dir, options):
+    # Landmarks, smoothed joint angles and the annotated video for one file.
+    # Returns (sampled frames, input bytes, seconds taken)
+    start = time.perf_counter()
+    metrics = RunMetrics() if options.metrics or options.profile else NULL_METRICS
+    with profile_run(metrics, options.profile):
+        store = _process_video(video_path, name, output_dir, options, metrics)
+    if metrics is not NULL_METRICS:
+        def write_metrics(path):
+            with open(path, 'w') as f:
+                f.write(metrics.to_json())
+        _write_atomic(metrics_path(name, output_dir), write_metrics)
+    return len(store), os.path.getsize(video_path), time.perf_counter() - start
+
+
+def _process_video(video_path, name, output_dir, options, metrics):
+    # Decoding reads the file directly and hashing goes through a memory map,
+    # so the video is never loaded into memory as a whole
+    result_cache = ResultCache(options.cache_dir) if options.cache_dir else None
+    if result_cache is not None:
+        with core.map_video_file(video_path) as video:
+            # The app's key, so either one reuses the landmarks the other found
+            key = landmarks_key(video_hash(video), options.fps, options.detect_confidence, options.track_confidence, options.sampling,
+                                options.inference_height, options.roi, options.keyframe_interval, options.optical_flow)
+        store = result_cache.get_landmarks(key)
+        if store is not None:
+            metrics.count('landmark_disk_cache_hits')
+    else:
+        store = None
+    if store is None:
+        store = core.extract_pose_landmarks(video_path, options.fps, options.detect_confidence, options.track_confidence,
+                                            options.sampling, options.pose_workers, metrics = metrics,
+                                            inference_height = options.inference_height, roi = options.roi,
+                                            keyframe_interval = options.keyframe_interval, optical_flow = options.optical_flow)
+        if result_cache is not None:
+            result_cache.put_landmarks(key, store)
+    schema = load_schema(options.joint_schema) if options.joint_schema else default_schema()
+    df_joint_angles = core.smooth_joint_angles(core.calculate_joint_angles(store, use_3d = options.angles_3d, schema = schema))
+
+    paths = output_paths(name, output_dir, not options.no_video, options.export)
+    _write_atomic(paths['landmarks'], store.to_frame().to_csv)
+    _write_atomic(paths['angles'], df_joint_angles.to_csv)
+    if options.export or options.library:
+        df_kinematics = core.compute_kinematics(df_joint_angles)
+        df_summary = core.summarize_kinematics(df_kinematics)
+    if options.library:
+        # Recorded at the file's modification time, the best guess a batch has
+        AnalyticsStore(options.library).add_session(store, df_kinematics, df_summary, name = os.path.basename(video_path),
+                                                    recorded = datetime.datetime.fromtimestamp(os.path.getmtime(video_path)))
+    if options.export:
+        for export_format in options.export:
+            with metrics.time(f'export_{export_format}'):
+                data = export_session(store, df_kinematics, df_summary, export_format)
+
+            def write_export(path):
+                with open(path, 'wb') as f:
+                    f.write(data)
+            _write_atomic(paths[export_format], write_export)
+    if not options.no_video:
+        def write_video(path):
+            with open(path, 'wb') as output:
+                core.stream_pose_video(video_path, store, options.fps, schema.colors,
+                                       options.text_scale, options.text_size, options.text_color,
+                                       options.line_size, options.marker_size, options.sampling, output = output,
+                                       profile = options.encoder_profile, metrics = metrics, schema = schema)
+        _write_atomic(paths['video'], write_video)
+    return store
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='movesense',
+                                     description='Markerless motion capture for whole directories of videos.')
+    parser.add_argument('inputs', nargs='+', help='Video files, directories or glob patterns (quote globs such as "clips/**/*.mp4").')
+    parser.add_argument('-o', '--output-dir', default='movesense_output', help='Directory for landmarks, angles and annotated videos.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of videos processed at the same time.')
+    parser.add_argument('--pose-workers', type=int, default=1, help='Worker processes per video for segment-parallel pose estimation.')
+    parser.add_argument('--fps', type=float, default=3, help='Frames per second to analyze.')
+    parser.add_argument('--detect-confidence', type=float, default=0.85, help='Minimum pose detection confidence (0 to 1).')
+    parser.add_argument('--track-confidence', type=float, default=0.85, help='Minimum pose tracking confidence (0 to 1).')
+    parser.add_argument('--sampling', choices=['grab', 'seek'], default='grab', help='Sequential decoding or keyframe seeking between sampled frames.')
+    parser.add_argument('--inference-height', type=int, help='Scale frames down to this height for pose estimation (default: source size).')
+    parser.add_argument('--roi', action='store_true', help='Run pose estimation on a crop around the previous pose, falling back to the full frame.')
+    parser.add_argument('--keyframe-interval', type=int, default=1,
+                        help='Run pose estimation on every n-th analyzed frame and interpolate the rest, adding keyframes where motion is fast.')
+    parser.add_argument('--optical-flow', action='store_true', help='Follow landmarks between keyframes with optical flow instead of linear interpolation.')
+    parser.add_argument('--3d', dest='angles_3d', action='store_true', help='Include landmark depth in joint angles.')
+    parser.add_argument('--joint-schema', help='JSON file of extra angles, points and markers to measure and draw (default: MOVESENSE_JOINT_SCHEMA or the built-in joints).')
+    parser.add_argument('--export', action='append', default=[], choices=list(EXPORT_FORMATS),
+                        help='Also write landmarks, kinematics and summary statistics to {name}_session.{ext} in this format; repeat for several.')
+    parser.add_argument('--library', help='Also save each analysis to the session library in this directory, e.g. the one the app uses.')
+    parser.add_argument('--no-video', action='store_true', help='Skip rendering the annotated video.')
+    parser.add_argument('--encoder-profile', choices=list(core.ENCODER_PROFILES), default=core.DEFAULT_ENCODER_PROFILE,
+                        help='Resolution and compression of the annotated video. "archive 4:4:4" keeps full color detail but does not play in browsers.')
+    parser.add_argument('--cache-dir', help='Reuse landmarks from (and add them to) this result cache directory, e.g. the one the app uses.')
+    parser.add_argument('--metrics', action='store_true', help='Write stage timings and frame counts of each video to {name}_metrics.json.')
+    parser.add_argument('--profile', choices=['sampling', 'cprofile'], help='Profile each video and add the report to its metrics file.')
+    parser.add_argument('--overwrite', action='store_true', help='Process videos again even if all outputs already exist.')
+    parser.add_argument('--marker-size', type=int, default=5)
+    parser.add_argument('--line-size', type=int, default=2)
+    parser.add_argument('--text-scale', type=float, default=1.0)
+    parser.add_argument('--text-size', type=int, default=2)
+    parser.add_argument('--text-color', choices=['White', 'Grey', 'Black'], default='White')
+    return parser
+
+
+def main(argv = None):
+    parser = build_parser()
+    options = parser.parse_args(argv)
+    if options.joint_schema:
+        # Checked once here rather than failing every video
+        try:
+            load_schema(options.joint_schema)
+        except (OSError, ValueError) as error:
+            parser.error(f'--joint-schema: {error}')
+    missing = {export_format: module for export_format, module in missing_formats().items() if export_format in options.export}
+    if missing:
+        parser.error('--export: ' + ', '.join(f'{export_format} needs {module} (pip install {module})' for export_format, module in missing.items()))
+    if options.library and series_format() != 'parquet':
+        print('pyarrow is not installed, so the library series are saved as compressed npz instead of Parquet')
+    os.makedirs(options.output_dir, exist_ok=True)
+
+    try:
+        videos = find_videos(options.inputs)
+    except ValueError as error:
+        parser.error(str(error))
+    pending = [(path, name) for path, name in videos
+               if options.overwrite or not is_processed(name, options.output_dir, not options.no_video, options.export)]
+    print(f'{len(videos)} videos found, {len(videos) - len(pending)} already processed, {len(pending)} to process')
+
+    failures = 0
+    total_frames = 0
+    start = time.perf_counter()
+    # Spawned workers so every job gets a clean MediaPipe runtime
+    with ProcessPoolExecutor(max_workers=max(1, options.jobs), mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(process_video, path, name, options.output_dir, options): name for path, name in pending}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                frames, size, seconds = future.result()
+            except Exception as error:
+                failures += 1
+                print(f'{name}: failed ({error!r})')
+                continue
+            total_frames += frames
+            print(f'{name}: {frames} frames in {seconds:.1f} s '
+                  f'({frames / seconds:.1f} frames/s, {size / seconds / 1e6:.1f} MB/s)')
+
+    elapsed = time.perf_counter() - start
+    if pending:
+        print(f'Done: {len(pending) - failures} processed, {failures} failed, '
+              f'{total_frames} frames in {elapsed:.1f} s ({total_frames / elapsed:.1f} frames/s)')
+    return 1 if failures else 0
@@ -0,0 +1,1013 @@
+import io
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack, closing, contextmanager
+from fractions import Fraction
+from io import BytesIO
+
+import av
+import cv2
+import numpy as np
+import pandas as pd
+
+from movesense.metrics import NULL_METRICS, RunMetrics
+from movesense.models import default_pose_pool
+from movesense.schema import BUILTIN_SCHEMA, LANDMARK_NAMES, POSE_CONNECTIONS, default_schema
+
+
+def hex_to_rgb(hex_string):
+    r_hex = hex_string[1:3]
+    g_hex = hex_string[3:5]
+    b_hex = hex_string[5:7]
+    return int(r_hex, 16), int(g_hex, 16), int(b_hex, 16)
+
+
+def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
+    # initialize the dimensions of the image to be resized and
+    # grab the image size
+    dim = None
+    (h, w) = image.shape[:2]
+
+    # if both the width and height are None, then return the
+    # original image
+    if width is None and height is None:
+        return image
+
+    # check to see if the width is None
+    if width is None:
+        # calculate the ratio of the height and construct the
+        # dimensions
+        r = height / float(h)
+        dim = (int(w * r), height)
+
+    # otherwise, the height is None
+    else:
+        # calculate the ratio of the width and construct the
+        # dimensions
+        r = width / float(w)
+        dim = (width, int(h * r))
+
+    # resize the image
+    resized = cv2.resize(image, dim, interpolation = inter)
+
+    # return the resized image
+    return resized
+
+
+class LandmarkStore:
+    # Pose landmarks for every sampled frame as a (frames, 33, 4) float32 array of
+    # x, y, z and visibility, with a mask of frames that had a detection and the
+    # timestamp of each frame in seconds. Capacity grows in chunks so appending a
+    # frame never copies the whole table.
+    NUM_LANDMARKS = 33
+    COLUMNS = ['x', 'y', 'z', 'visibility']
+
+    def __init__(self, chunk_size = 256):
+        self.chunk_size = chunk_size
+        self._length = 0
+        self._landmarks = np.full((chunk_size, self.NUM_LANDMARKS, 4), np.nan, dtype=np.float32)
+        self._valid = np.zeros(chunk_size, dtype=bool)
+        self._timestamps = np.zeros(chunk_size, dtype=np.float64)
+
+    def __len__(self):
+        return self._length
+
+    def __getstate__(self):
+        # Only pickle (and hash) the filled part of the buffers
+        return {'chunk_size': self.chunk_size,
+                'landmarks': self.landmarks,
+                'valid': self.valid,
+                'timestamps': self.timestamps}
+
+    def __setstate__(self, state):
+        self.chunk_size = state['chunk_size']
+        self._length = len(state['timestamps'])
+        self._landmarks = state['landmarks']
+        self._valid = state['valid']
+        self._timestamps = state['timestamps']
+
+    @property
+    def landmarks(self):
+        return self._landmarks[:self._length]
+
+    @property
+    def valid(self):
+        return self._valid[:self._length]
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self._length]
+
+    def _grow(self):
+        # Grow by at least one chunk, or by half the current size for long clips
+        capacity = len(self._timestamps) + max(self.chunk_size, len(self._timestamps) // 2)
+        landmarks = np.full((capacity, self.NUM_LANDMARKS, 4), np.nan, dtype=np.float32)
+        landmarks[:self._length] = self.landmarks
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:self._length] = self.valid
+        timestamps = np.zeros(capacity, dtype=np.float64)
+        timestamps[:self._length] = self.timestamps
+        self._landmarks, self._valid, self._timestamps = landmarks, valid, timestamps
+
+    def append(self, landmarks, timestamp):
+        # landmarks is a mediapipe NormalizedLandmarkList, a (33, 4) array or None
+        if self._length == len(self._timestamps):
+            self._grow()
+        i = self._length
+        if landmarks is not None:
+            if hasattr(landmarks, 'landmark'):
+                landmarks = [(lm.x, lm.y, lm.z, lm.visibility) for lm in landmarks.landmark]
+            self._landmarks[i] = landmarks
+            self._valid[i] = True
+        self._timestamps[i] = timestamp
+        self._length += 1
+
+    def trim(self):
+        # Drop the unused capacity once capture is finished
+        self._landmarks = self.landmarks.copy()
+        self._valid = self.valid.copy()
+        self._timestamps = self.timestamps.copy()
+        return self
+
+    def copy(self):
+        # Independent, trimmed snapshot, e.g. of a store that is still being filled
+        store = LandmarkStore(self.chunk_size)
+        store.__setstate__({'chunk_size': self.chunk_size,
+                            'landmarks': self.landmarks.copy(),
+                            'valid': self.valid.copy(),
+                            'timestamps': self.timestamps.copy()})
+        return store
+
+    @classmethod
+    def concatenate(cls, stores):
+        # Join stores that cover consecutive time ranges into one store
+        stores = [store for store in stores if len(store)]
+        combined = cls()
+        if stores:
+            combined.__setstate__({'chunk_size': combined.chunk_size,
+                                   'landmarks': np.concatenate([store.landmarks for store in stores]),
+                                   'valid': np.concatenate([store.valid for store in stores]),
+                                   'timestamps': np.concatenate([store.timestamps for store in stores])})
+        return combined
+
+    def time_index(self):
+        return pd.Index(pd.to_datetime(self.timestamps, unit='s'), name='time')
+
+    def to_frame(self):
+        # Tidy (time, landmark) view; the value columns share memory with the store
+        values = self.landmarks.reshape(-1, 4)
+        index = pd.MultiIndex.from_arrays([self.time_index().repeat(self.NUM_LANDMARKS),
+                                           np.tile(np.arange(self.NUM_LANDMARKS), self._length)],
+                                          names=['time', 'landmark'])
+        return pd.DataFrame(values, index=index, columns=self.COLUMNS, copy=False)
+
+
+class BufferReader(io.RawIOBase):
+    # Read-only, seekable file object over a bytes-like buffer (bytes, memoryview,
+    # mmap) that never copies the whole buffer; only the chunks the demuxer asks for
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = min(max(offset, 0), len(self._view))
+        return self._position
+
+    def readinto(self, b):
+        chunk = self._view[self._position:self._position + len(b)]
+        b[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        # Release the export so the underlying buffer (e.g. an mmap) can be closed
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def open_video_container(video):
+    # video is a file path, a bytes-like buffer or a readable, seekable file object.
+    # Buffers and file objects are decoded in place instead of through a temp file
+    if isinstance(video, (str, os.PathLike)):
+        return av.open(os.fspath(video))
+    if hasattr(video, 'read'):
+        video.seek(0)
+        return av.open(video)
+    return av.open(BufferReader(video))
+
+
+@contextmanager
+def map_video_file(path):
+    # Read-only memory map of a video file: hashing and decoding page it in on
+    # demand instead of reading multi-GB files into memory
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+
+@contextmanager
+def video_file_path(video):
+    # A path other processes can open; buffers are written to a temp file once
+    if isinstance(video, (str, os.PathLike)):
+        yield os.fspath(video)
+        return
+    tfile = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        if hasattr(video, 'read'):
+            video.seek(0)
+            shutil.copyfileobj(video, tfile)
+        else:
+            tfile.write(video)
+        tfile.close()
+        yield tfile.name
+    finally:
+        tfile.close()
+        os.remove(tfile.name)
+
+
+def sampled_frames(container, fps, sampling = 'grab', seek_threshold = 2.0, start_time = 0.0, end_time = None, metrics = NULL_METRICS,
+                   size = None):
+    # Yield (seconds, RGB frame) for the source frame nearest each point of a
+    # 1 / fps time grid. Only sampled frames are converted to RGB; disposable
+    # packets that are not sampled are never decoded. With sampling = 'seek',
+    # gaps longer than seek_threshold seconds jump to the nearest keyframe
+    # instead of decoding every frame in between. start_time and end_time limit
+    # the output to [start_time, end_time) on the same grid as a full pass.
+    # size = (width, height) scales frames during the RGB conversion itself.
+    # Decode and RGB conversion time and frame counts go to metrics.
+    stream = container.streams.video[0]
+    stream.thread_type = 'AUTO'
+    period = 1.0 / float(stream.average_rate or fps)
+    start = float(stream.start_time * stream.time_base) if stream.start_time else 0.0
+
+    def is_sampled(t):
+        # A frame is sampled when a grid point falls within half a frame of it
+        return math.floor((t + period / 2) * fps) > math.floor((t - period / 2) * fps)
+
+    last_time = -1.0
+    # A seek lands on the last keyframe before its target and only pays off when
+    # that keyframe is past the frames already decoded. Seeks are only made when
+    # the spacing of the keyframes decoded so far puts one before the target, and
+    # after each seek only once decoding has reached a keyframe past the frames
+    # already handled, so a seek that lands too early is never repeated.
+    keyframe = None
+    keyframe_spacing = None
+    if start_time > 0:
+        container.seek(int((start_time + start - period) / stream.time_base), stream=stream)
+    while True:
+        seeked = False
+        for packet in container.demux(stream):
+            if packet.pts is not None and packet.is_disposable and not is_sampled(float(packet.pts * packet.time_base) - start):
+                metrics.count('packets_skipped')
+                continue
+            with metrics.time('decode'):
+                decoded = packet.decode()
+            metrics.count('frames_decoded', len(decoded))
+            for frame in decoded:
+                t = frame.time - start if frame.time is not None else last_time + period
+                if frame.key_frame and t > last_time:
+                    if keyframe is not None:
+                        keyframe_spacing = t - keyframe
+                    keyframe = t
+                # Frames before a seek target were already handled
+                if t <= last_time or t < start_time:
+                    continue
+                if end_time is not None and t >= end_time:
+                    return
+                last_time = t
+                if is_sampled(t):
+                    with metrics.time('convert'):
+                        if size is None:
+                            rgb = frame.to_ndarray(format='rgb24')
+                        else:
+                            rgb = frame.to_ndarray(format='rgb24', width=size[0], height=size[1])
+                    metrics.count('frames_sampled')
+                    yield t, rgb
+
+                next_sample = (math.floor((t + period / 2) * fps) + 1) / fps
+                if (sampling == 'seek' and keyframe is not None and keyframe_spacing and next_sample - t > seek_threshold
+                        and keyframe + keyframe_spacing * (math.floor((t - keyframe) / keyframe_spacing) + 1) <= next_sample):
+                    container.seek(int((next_sample + start - period) / stream.time_base), stream=stream)
+                    seeked = True
+                    # Keyframes either side of a seek are not consecutive
+                    keyframe = None
+                    break
+            if seeked:
+                break
+        if not seeked:
+            return
+
+
+_PIPELINE_DONE = object()
+
+
+def run_pipeline(source, stages, maxsize = 4):
+    # Run the source iterator and each stage function in their own thread, linked
+    # by bounded queues, and yield the output of the last stage in order. At most
+    # maxsize items wait between two stages so memory does not grow with video length.
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]
+
+    def put(q, item):
+        # Give up if the consumer went away so worker threads never block forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _PIPELINE_DONE
+
+    def produce():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except BaseException as error:
+            put(queues[0], error)
+        put(queues[0], _PIPELINE_DONE)
+
+    def work(stage, q_in, q_out):
+        while True:
+            item = get(q_in)
+            if item is _PIPELINE_DONE or isinstance(item, BaseException):
+                put(q_out, item)
+                return
+            try:
+                item = stage(item)
+            except BaseException as error:
+                put(q_out, error)
+                return
+            if not put(q_out, item):
+                return
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _PIPELINE_DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=1)
+
+
+class PoseEstimator:
+    # Runs a mediapipe Pose on frames at a reduced inference resolution and,
+    # with roi = True, only on a crop around the previous pose. The crop is the
+    # landmark bounding box plus margin (a fraction of the box size) on every
+    # side and is kept while the pose stays well inside it, so the model's own
+    # tracking sees a steady view. When nothing is found in the crop, the full
+    # frame is tried at once. Landmarks always come back as a (33, 4) array in
+    # full-frame normalized coordinates, or None.
+
+    def __init__(self, pose, inference_height = None, roi = False, margin = 0.25, metrics = NULL_METRICS):
+        self.pose = pose
+        self.inference_height = inference_height
+        self.roi = roi
+        self.margin = margin
+        self.metrics = metrics
+        self._box = None  # x0, y0, x1, y1 in pixels
+
+    def _infer(self, image):
+        if self.inference_height is not None and image.shape[0] > self.inference_height:
+            with self.metrics.time('inference_resize'):
+                image = cv2.resize(image, output_size(image.shape[1], image.shape[0], self.inference_height),
+                                   interpolation=cv2.INTER_AREA)
+        with self.metrics.time('pose'):
+            result = self.pose.process(image).pose_landmarks
+        if result is None:
+            return None
+        return np.array([(lm.x, lm.y, lm.z, lm.visibility) for lm in result.landmark], dtype=np.float32)
+
+    def _update_box(self, landmarks, width, height):
+        # Keep the crop while the pose bounding box stays inside it with half the margin to spare
+        xs = np.clip(landmarks[:, 0], 0, 1) * width
+        ys = np.clip(landmarks[:, 1], 0, 1) * height
+        x0, x1, y0, y1 = xs.min(), xs.max(), ys.min(), ys.max()
+        pad_x = max(x1 - x0, 1) * self.margin
+        pad_y = max(y1 - y0, 1) * self.margin
+        if self._box is not None:
+            bx0, by0, bx1, by1 = self._box
+            if x0 - pad_x / 2 >= bx0 and y0 - pad_y / 2 >= by0 and x1 + pad_x / 2 <= bx1 and y1 + pad_y / 2 <= by1:
+                return
+        box = (int(max(0, x0 - pad_x)), int(max(0, y0 - pad_y)), int(min(width, x1 + pad_x)), int(min(height, y1 + pad_y)))
+        # A crop covering most of the frame saves nothing
+        covered = (box[2] - box[0]) * (box[3] - box[1]) / (width * height)
+        self._box = box if covered < 0.8 else None
+
+    def process(self, frame):
+        height, width = frame.shape[:2]
+        if self._box is not None:
+            x0, y0, x1, y1 = self._box
+            landmarks = self._infer(frame[y0:y1, x0:x1])
+            if landmarks is not None:
+                self.metrics.count('roi_inferences')
+                # Crop-normalized to frame-normalized; z shares the scale of x
+                crop_width, crop_height = x1 - x0, y1 - y0
+                landmarks[:, 0] = (x0 + landmarks[:, 0] * crop_width) / width
+                landmarks[:, 1] = (y0 + landmarks[:, 1] * crop_height) / height
+                landmarks[:, 2] *= crop_width / width
+                self._update_box(landmarks, width, height)
+                return landmarks
+            # Subject lost or out of the crop
+            self.metrics.count('roi_fallbacks')
+            self._box = None
+        landmarks = self._infer(frame)
+        if self.roi and landmarks is not None:
+            self._update_box(landmarks, width, height)
+        return landmarks
+
+
+class StillPoseEstimator:
+    # PoseEstimator for frames that come out of time order: a static image mode
+    # Pose without a crop, so every frame is detected afresh and no tracking
+    # state carries over. The model is only checked out of the pool on first
+    # use; close() returns it.
+
+    def __init__(self, detectconfidence, trackconfidence, inference_height = None, metrics = NULL_METRICS):
+        self.detectconfidence = detectconfidence
+        self.trackconfidence = trackconfidence
+        self.inference_height = inference_height
+        self.metrics = metrics
+        self._stack = ExitStack()
+        self._estimator = None
+
+    def process(self, frame):
+        if self._estimator is None:
+            pose = self._stack.enter_context(default_pose_pool().checkout(self.detectconfidence, self.trackconfidence, metrics = self.metrics,
+                                                                          static_image_mode = True))
+            self._estimator = PoseEstimator(pose, self.inference_height, metrics = self.metrics)
+        return self._estimator.process(frame)
+
+    def close(self):
+        self._estimator = None
+        self._stack.close()
+
+
+# Interpolating between two keyframes is not trusted when a landmark visible in
+# both moves further than this (in normalized image coordinates), or when the
+# average visibility of either keyframe is below the visibility threshold
+KEYFRAME_MOTION_THRESHOLD = 0.05
+KEYFRAME_VISIBILITY_THRESHOLD = 0.5
+# Optical flow runs on grayscale frames scaled down to at most this height
+FLOW_HEIGHT = 480
+
+
+def _needs_keyframe(first, last, motion_threshold, visibility_threshold):
+    # Whether the frames between two inferred frames need another keyframe
+    if first is None or last is None:
+        # Detection found or lost in between; both missing means nothing to interpolate
+        return first is not last
+    if min(first[:, 3].mean(), last[:, 3].mean()) < visibility_threshold:
+        return True
+    visible = (first[:, 3] >= visibility_threshold) & (last[:, 3] >= visibility_threshold)
+    return bool(np.abs(last[visible, :2] - first[visible, :2]).max(initial=0) > motion_threshold)
+
+
+def _flow_gray(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    if gray.shape[0] > FLOW_HEIGHT:
+        gray = cv2.resize(gray, output_size(gray.shape[1], gray.shape[0], FLOW_HEIGHT), interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def _interpolate_landmarks(frames, times, first, last, optical_flow):
+    # Landmarks for the frames strictly between two keyframes. Linear in time;
+    # with optical_flow, x and y follow the landmarks tracked frame to frame from
+    # the first keyframe, with the drift from the last keyframe spread linearly.
+    # Landmarks the tracker loses fall back to linear interpolation.
+    weights = (np.asarray(times[1:-1]) - times[0]) / (times[-1] - times[0])
+    landmarks = first + weights[:, None, None] * (last - first)
+    if not optical_flow:
+        return landmarks
+    grays = [_flow_gray(frame) for frame in frames]
+    height, width = grays[0].shape
+    scale = np.array([width, height], dtype=np.float32)
+    points = (first[:, :2] * scale).reshape(-1, 1, 2).astype(np.float32)
+    tracked = np.empty((len(frames), len(first), 2), dtype=np.float32)
+    tracked[0] = first[:, :2]
+    ok = np.ones((len(frames), len(first)), dtype=bool)
+    for i in range(1, len(frames)):
+        points, status, _ = cv2.calcOpticalFlowPyrLK(grays[i - 1], grays[i], points, None)
+        tracked[i] = points.reshape(-1, 2) / scale
+        ok[i] = ok[i - 1] & (status.ravel() == 1)
+    drift = last[:, :2] - tracked[-1]
+    flow = tracked[1:-1] + weights[:, None, None] * drift
+    # Only landmarks tracked all the way to the last keyframe have a drift correction to trust
+    use_flow = ok[-1][None, :, None] & ok[1:-1][:, :, None]
+    landmarks[:, :, :2] = np.where(use_flow, flow, landmarks[:, :, :2])
+    return landmarks
+
+
+def keyframe_landmarks(frames, estimator, interval, optical_flow = False, motion_threshold = KEYFRAME_MOTION_THRESHOLD,
+                       visibility_threshold = KEYFRAME_VISIBILITY_THRESHOLD, metrics = NULL_METRICS, still_estimator = None):
+    # Yield (timestamp, landmarks) for every (timestamp, frame) while running the
+    # estimator only on every interval-th frame and interpolating the rest. Where
+    # motion or low visibility makes that unreliable, the gap is split with an
+    # extra keyframe in the middle until it can be interpolated or has no frames
+    # left in between. Up to interval + 1 frames are held at a time.
+    # The extra keyframes lie before the keyframe the estimator saw last, so they
+    # go to still_estimator (e.g. a StillPoseEstimator) and the estimator's
+    # tracking only ever sees frames in time order. Without a still_estimator
+    # gaps are always interpolated.
+    buffer = []
+    results = {}
+
+    def fill(lo, hi):
+        if hi - lo < 2:
+            return
+        if still_estimator is not None and _needs_keyframe(results[lo], results[hi], motion_threshold, visibility_threshold):
+            mid = (lo + hi) // 2
+            results[mid] = still_estimator.process(buffer[mid][1])
+            metrics.count('adaptive_keyframes')
+            fill(lo, mid)
+            fill(mid, hi)
+            return
+        metrics.count('interpolated_frames', hi - lo - 1)
+        # A detection found or lost in the gap leaves nothing to interpolate between
+        if results[lo] is None or results[hi] is None:
+            results.update((i, None) for i in range(lo + 1, hi))
+            return
+        with metrics.time('interpolate'):
+            filled = _interpolate_landmarks([frame for _, frame in buffer[lo:hi + 1]], [t for t, _ in buffer[lo:hi + 1]],
+                                            results[lo], results[hi], optical_flow)
+        results.update(zip(range(lo + 1, hi), filled))
+
+    for item in frames:
+        buffer.append(item)
+        last = len(buffer) - 1
+        if last == 0:
+            results[0] = estimator.process(item[1])
+            metrics.count('keyframes')
+        elif last == interval:
+            results[last] = estimator.process(item[1])
+            metrics.count('keyframes')
+            fill(0, last)
+            for i in range(last):
+                yield buffer[i][0], results[i]
+            # The keyframe that closed this gap opens the next one
+            buffer = buffer[last:]
+            results = {0: results[last]}
+    if buffer:
+        last = len(buffer) - 1
+        if last > 0:
+            results[last] = estimator.process(buffer[last][1])
+            metrics.count('keyframes')
+            fill(0, last)
+        for i in range(last + 1):
+            yield buffer[i][0], results[i]
+
+
+def infer_landmarks(frames, estimator, keyframe_interval = 1, optical_flow = False, metrics = NULL_METRICS, still_estimator = None):
+    # (timestamp, landmarks or None) for every (timestamp, frame); with a keyframe
+    # interval above 1 most frames are interpolated (see keyframe_landmarks)
+    if keyframe_interval > 1:
+        yield from keyframe_landmarks(frames, estimator, keyframe_interval, optical_flow, metrics = metrics, still_estimator = still_estimator)
+        return
+    for timestamp, frame in frames:
+        yield timestamp, estimator.process(frame)
+
+
+def inference_frame_size(container, inference_height = None):
+    # (width, height) to convert sampled frames to for inference at inference_height, or None for the source size
+    codec_context = container.streams.video[0].codec_context
+    if inference_height is None or inference_height >= codec_context.height:
+        return None
+    return output_size(codec_context.width, codec_context.height, inference_height)
+
+
+def extract_pose_landmarks(video, fps, detectconfidence, trackconfidence, sampling = 'grab', workers = 1, metrics = NULL_METRICS,
+                           inference_height = None, roi = False, keyframe_interval = 1, optical_flow = False, progress = None):
+    # Pose landmarks for the sampled frames of a video; no overlay is drawn here.
+    # inference_height limits the frame height given to the model and roi = True
+    # crops around the previous pose (see PoseEstimator). keyframe_interval > 1
+    # runs the model on fewer frames and interpolates the rest (see keyframe_landmarks).
+    # progress(frames done, store so far) is called as frames are added; an
+    # exception raised from it stops the extraction
+    if workers > 1:
+        return extract_pose_landmarks_parallel(video, fps, detectconfidence, trackconfidence, sampling, workers, metrics = metrics,
+                                               inference_height = inference_height, roi = roi,
+                                               keyframe_interval = keyframe_interval, optical_flow = optical_flow, progress = progress)
+    start = time.perf_counter()
+    container = open_video_container(video)
+    # Without a crop, frames are scaled down while they are converted to RGB; a crop
+    # needs the full frame and is scaled down after cropping instead
+    size = None if roi else inference_frame_size(container, inference_height)
+
+    # A loaded pose model from the process-wide pool, and one for adaptive keyframes
+    with default_pose_pool().checkout(detectconfidence, trackconfidence, metrics = metrics) as pose, \
+            closing(StillPoseEstimator(detectconfidence, trackconfidence, inference_height, metrics = metrics)) as still_estimator:
+        # Create a store for the pose keypoints
+        store = LandmarkStore()
+        estimator = PoseEstimator(pose, inference_height, roi, metrics = metrics)
+
+        # Decoding runs ahead of inference in its own thread, but only a few frames at a time
+        frames = run_pipeline(sampled_frames(container, fps, sampling, metrics = metrics, size = size), [])
+        try:
+            for timestamp, landmarks in infer_landmarks(frames, estimator, keyframe_interval, optical_flow, metrics = metrics,
+                                                        still_estimator = still_estimator):
+                # Add the landmarks (or an empty row if none were detected) at the frame time in seconds
+                if landmarks is None:
+                    metrics.count('frames_without_landmarks')
+                store.append(landmarks, timestamp)
+                if len(store) == 1:
+                    metrics.add_time('first_frame', time.perf_counter() - start)
+                if progress is not None:
+                    progress(len(store), store)
+        finally:
+            frames.close()
+            container.close()
+
+    return store.trim()
+
+
+def sampled_frame_count(container, fps):
+    # Approximate number of frames sampled_frames yields for the whole video
+    return int(video_duration(container) * fps) + 1
+
+
+def video_duration(container):
+    # Length of the first video stream in seconds
+    stream = container.streams.video[0]
+    if stream.duration is not None:
+        return float(stream.duration * stream.time_base)
+    return (container.duration or 0) / av.time_base
+
+
+def _extract_segment(path, fps, detectconfidence, trackconfidence, sampling, segment, warmup, inference_height = None, roi = False,
+                     keyframe_interval = 1, optical_flow = False):
+    # Landmarks for frames in [segment start, segment end) using a Pose of its own.
+    # Frames from the warm-up overlap before the segment only prime tracking.
+    # Returns the store and the segment's metrics as a dict for the parent to merge.
+    seg_start, seg_end = segment
+    metrics = RunMetrics()
+    container = av.open(path)
+    store = LandmarkStore()
+    size = None if roi else inference_frame_size(container, inference_height)
+    with default_pose_pool().checkout(detectconfidence, trackconfidence, metrics=metrics) as pose, \
+            closing(StillPoseEstimator(detectconfidence, trackconfidence, inference_height, metrics=metrics)) as still_estimator:
+        estimator = PoseEstimator(pose, inference_height, roi, metrics=metrics)
+        frames = sampled_frames(container, fps, sampling, start_time=max(0.0, seg_start - warmup), end_time=seg_end,
+                                metrics=metrics, size=size)
+        for timestamp, landmarks in infer_landmarks(frames, estimator, keyframe_interval, optical_flow, metrics=metrics,
+                                                    still_estimator=still_estimator):
+            if timestamp >= seg_start:
+                if landmarks is None:
+                    metrics.count('frames_without_landmarks')
+                store.append(landmarks, timestamp)
+    container.close()
+    return store.trim(), metrics.to_dict()
+
+
+# Seconds between checks for a cancellation while segments run in worker processes
+SEGMENT_POLL_INTERVAL = 0.25
+
+
+def _terminate_executor(executor):
+    # Stop a process pool without waiting for the tasks that are running.
+    # ProcessPoolExecutor has no public way to kill its workers, so this reads
+    # its private _processes (CPython); without it, the workers are left to
+    # finish their current task after the shutdown.
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def extract_pose_landmarks_parallel(video, fps, detectconfidence, trackconfidence, sampling = 'grab', workers = None, warmup = 1.0,
+                                    metrics = NULL_METRICS, inference_height = None, roi = False, keyframe_interval = 1, optical_flow = False,
+                                    progress = None):
+    # Split the video into time segments and run pose estimation on each in a
+    # separate process, then stitch the segments back together in time order
+    workers = workers or os.cpu_count() or 1
+    with video_file_path(video) as path:
+        container = av.open(path)
+        duration = video_duration(container)
+        container.close()
+
+        # Segments much shorter than the warm-up would spend most of their time warming up
+        n_segments = max(1, min(workers, int(duration // (4 * warmup))))
+        bounds = [duration * i / n_segments for i in range(n_segments)] + [math.inf]
+        segments = list(zip(bounds[:-1], bounds[1:]))
+
+        # Spawned workers start clean instead of inheriting the threads of a running server
+        executor = ProcessPoolExecutor(max_workers=n_segments, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            futures = [executor.submit(_extract_segment, path, fps, detectconfidence, trackconfidence, sampling, segment, warmup,
+                                       inference_height, roi, keyframe_interval, optical_flow)
+                       for segment in segments]
+            pending = set(futures)
+            results = []
+            done = LandmarkStore()
+            while pending:
+                finished, pending = wait(pending, timeout=SEGMENT_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # A failed segment fails the run without waiting for the others
+                    future.result()
+                # Segments finish in any order; progress covers the leading ones that are done
+                while len(results) < len(futures) and futures[len(results)].done():
+                    results.append(futures[len(results)].result())
+                    done = LandmarkStore.concatenate([store for store, _ in results])
+                # Also called between segments, as it is where a cancellation takes effect
+                if progress is not None:
+                    progress(len(done), done)
+        except BaseException:
+            # Cancelled or failed: the segments still running are abandoned, not waited for
+            _terminate_executor(executor)
+            raise
+        executor.shutdown()
+    # Stage times are summed over the workers, so they can add up to more than the wall time
+    for _, segment_metrics in results:
+        metrics.merge(segment_metrics)
+    return LandmarkStore.concatenate([store for store, _ in results])
+
+
+# Output height (None keeps the source size), x264 crf and preset, encoder
+# threads (0 lets x264 decide) and pixel format of each rendered video profile
+ENCODER_PROFILES = {
+    'fast preview': {'height': 400, 'crf': 23, 'preset': 'veryfast', 'threads': 0, 'pix_fmt': 'yuv420p'},
+    'standard': {'height': 400, 'crf': 17, 'preset': 'medium', 'threads': 0, 'pix_fmt': 'yuv420p'},
+    'archive quality': {'height': None, 'crf': 17, 'preset': 'slow', 'threads': 0, 'pix_fmt': 'yuv420p'},
+    'archive 4:4:4': {'height': None, 'crf': 17, 'preset': 'slow', 'threads': 0, 'pix_fmt': 'yuv444p'},
+    'small download': {'height': 360, 'crf': 30, 'preset': 'faster', 'threads': 0, 'pix_fmt': 'yuv420p'}
+}
+DEFAULT_ENCODER_PROFILE = 'standard'
+# Browsers only play 4:2:0 H.264 (4:4:4 is the High 4:4:4 Predictive profile),
+# so these are the profiles a video shown in a page can use
+BROWSER_ENCODER_PROFILES = [name for name, settings in ENCODER_PROFILES.items() if settings['pix_fmt'] == 'yuv420p']
+
+
+ANGLE_TEXT_COLORS = {'White': (255, 255, 255), 'Grey': (128, 128, 128), 'Black': (0, 0, 0)}
+
+
+class OverlayRenderer:
+    # Draws the skeleton, joint markers and joint angles onto RGB frames. Everything
+    # that only depends on the style (colors, index arrays, text settings) is
+    # worked out once here, so drawing a frame is a handful of OpenCV calls and
+    # one vectorized angle computation.
+
+    def __init__(self, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, schema = None):
+        self.textscale = textscale
+        self.textsize = textsize
+        self.linesize = linesize
+        self.markersize = markersize
+        self.text_color = ANGLE_TEXT_COLORS.get(angletextcolor, ANGLE_TEXT_COLORS['White'])
+        self.schema = schema or default_schema()
+
+        # Color lookup table in marker order; joints without a color in
+        # color_discrete_map keep the schema's
+        colors = {**self.schema.colors, **color_discrete_map}
+        self.marker_indices = self.schema.marker_indices
+        self.marker_colors = [hex_to_rgb(colors.get(color, color)) for color in self.schema.marker_colors]
+
+        self.angle_triplets = self.schema.triplets
+        self.angle_vertices = self.angle_triplets[:, 1]
+        self.connections = np.array(sorted(POSE_CONNECTIONS), dtype=np.intp)
+
+    def _table_angles(self, table):
+        return compute_joint_angles(table[np.newaxis], [True], self.angle_triplets)[0]
+
+    def frame_angles(self, landmarks):
+        # The angles draw() shows for one frame's (33, 4) landmarks, in schema.joints order
+        return self._table_angles(self.schema.points(landmarks))
+
+    def draw(self, frame, landmarks):
+        # landmarks is one (33, 4) array of x, y, z, visibility for this frame
+        height, width = frame.shape[:2]
+        table = self.schema.points(landmarks)
+        points = (table[:, :2] * (width, height)).astype(np.int32)
+
+        # Draw the landmark connections, skipping landmarks that are not visible
+        if self.linesize > 0:
+            visible = landmarks[:, 3] >= 0.5
+            shown = visible[self.connections[:, 0]] & visible[self.connections[:, 1]]
+            cv2.polylines(frame, points[self.connections[shown]], False, (255, 255, 255), self.linesize)
+
+        # Draw joint markers
+        for idx, color in zip(self.marker_indices, self.marker_colors):
+            cv2.circle(frame, (int(points[idx, 0]), int(points[idx, 1])), self.markersize, color, -1)
+
+        # Calculate and display joint angles
+        if self.textsize > 0:
+            angles = self._table_angles(table)
+            for idx, angle in zip(self.angle_vertices, angles):
+                if np.isnan(angle):
+                    continue
+                cv2.putText(frame, f'{angle:.2f}', (int(points[idx, 0]) + 10, int(points[idx, 1]) + 10),
+                            cv2.FONT_HERSHEY_SIMPLEX, self.textscale, self.text_color, self.textsize)
+        return frame
+
+
+def draw_pose_overlay(frame, landmarks, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, schema = None):
+    # One-off drawing; build an OverlayRenderer once when drawing many frames
+    return OverlayRenderer(color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, schema).draw(frame, landmarks)
+
+
+def stream_pose_video(video, store, fps, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling = 'grab', output = None, profile = DEFAULT_ENCODER_PROFILE,
+                      metrics = NULL_METRICS, progress = None, frame_store = None, schema = None):
+    # Decode, draw and encode one frame at a time so no rendered frames are kept around.
+    # output is any writable, seekable file object; defaults to an in-memory BytesIO.
+    # frame_store, e.g. a FrameStoreWriter, also gets every annotated frame with its timestamp.
+    # progress(frames drawn, None) is called per frame; an exception raised from it stops rendering
+    container = open_video_container(video)
+    codec_context = container.streams.video[0].codec_context
+    width, height = output_size(codec_context.width, codec_context.height, ENCODER_PROFILES[profile]['height'])
+
+    # The same sampling as extract_pose_landmarks gives the same frames in the same order
+    frames = zip(range(len(store)), sampled_frames(container, fps, sampling, metrics = metrics))
+
+    renderer = OverlayRenderer(color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, schema)
+
+    def draw(item):
+        i, (timestamp, frame) = item
+        if store.valid[i]:
+            with metrics.time('draw'):
+                renderer.draw(frame, store.landmarks[i])
+
+        # Scale to the exact stream geometry so the encoder never rescales
+        if frame.shape[1] != width or frame.shape[0] != height:
+            with metrics.time('resize'):
+                frame = cv2.resize(frame, (width, height), interpolation = cv2.INTER_AREA)
+        if frame_store is not None:
+            with metrics.time('frame_store'):
+                frame_store.append(frame, timestamp)
+        if progress is not None:
+            progress(i + 1, None)
+        return frame
+
+    try:
+        video_data = create_video(frames = run_pipeline(frames, [draw]), height = height, width = width, fps = fps,
+                                  output = output, profile = profile, frame_format = 'rgb24', metrics = metrics)
+    finally:
+        container.close()
+    return video_data
+
+
+def spooled_video_output(max_size = 64 * 1024 * 1024):
+    # Keeps small videos in RAM and rolls larger ones over to a temp file on disk
+    return tempfile.SpooledTemporaryFile(max_size=max_size, suffix='.mp4')
+
+
+def output_size(width, height, target_height = None):
+    # Frame size for a target height (None keeps the source size), keeping the
+    # aspect ratio and rounding to even numbers as yuv420p requires
+    if target_height is not None and target_height < height:
+        width = width * target_height / height
+        height = target_height
+    return int(width) // 2 * 2, int(height) // 2 * 2
+
+
+def create_video(frames, height, width, fps, output = None, profile = DEFAULT_ENCODER_PROFILE, frame_format = 'bgr24', metrics = NULL_METRICS):
+  settings = ENCODER_PROFILES[profile]
+  
+  output_memory_file = BytesIO() if output is None else output  # Create BytesIO "in memory file" unless given a file to write to.
+  
+  output = av.open(output_memory_file, 'w', format="mp4")  # Open "in memory file" as MP4 video output
+  stream = output.add_stream('h264', Fraction(fps).limit_denominator(1001))  # Add H.264 video stream to the MP4 container, with framerate = fps.
+  stream.width = width  # Set frame width; must match the frames given
+  stream.height = height  # Set frame height; must match the frames given
+  stream.pix_fmt = settings['pix_fmt']   # yuv420p for wide compatibility, yuv444p for better color detail.
+  # Lower crf is higher quality (the price is larger file size); slower presets compress better.
+  stream.options = {'crf': str(settings['crf']), 'preset': settings['preset'], 'threads': str(settings['threads'])}
+  # Encode and write each image to the MP4 file as it arrives; frames can be any iterable, including a generator.
+  for img in frames:
+      with metrics.time('encode'):
+          frame = av.VideoFrame.from_ndarray(img, format=frame_format)  # Convert image from NumPy Array to frame.
+          packet = stream.encode(frame)  # Encode video frame
+          output.mux(packet)  # "Mux" the encoded frame (add the encoded frame to MP4 file).
+      metrics.count('frames_encoded')
+      metrics.count('bytes_encoded', sum(p.size for p in packet))  # Compressed size of this frame's packets, if any yet.
+  
+  # Flush the encoder
+  with metrics.time('encode'):
+      packet = stream.encode(None)
+      output.mux(packet)
+      output.close()
+  metrics.count('bytes_encoded', sum(p.size for p in packet))
+  
+  output_memory_file.seek(0)  # Seek to the beginning of the BytesIO.
+  return output_memory_file
+
+
+# Landmark triplets (outer, vertex, outer) of the built-in joint angles; the
+# angles of a run come from its JointSchema
+JOINT_ANGLE_TRIPLETS = BUILTIN_SCHEMA.triplet_map()
+
+
+def compute_joint_angles(landmarks, valid, triplets, use_3d = False):
+    # Angle at the vertex of every triplet for every frame in one array pass.
+    # landmarks is (frames, landmarks or points, 4), e.g. from JointSchema.points, triplets
+    # is (joints, 3) indices into it; returns (frames, joints) in degrees
+    triplets = np.asarray(triplets, dtype=np.intp)
+    coords = np.asarray(landmarks, dtype=np.float64)[..., :3 if use_3d else 2]
+    vertex = coords[:, triplets[:, 1]]
+    v1 = coords[:, triplets[:, 0]] - vertex
+    v2 = coords[:, triplets[:, 2]] - vertex
+    dot = np.einsum('fjk,fjk->fj', v1, v2)
+    norms = np.linalg.norm(v1, axis=-1) * np.linalg.norm(v2, axis=-1)
+    # Missing landmarks and degenerate (zero length) segments come out as NaN
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosine_angle = np.clip(dot / norms, -1.0, 1.0)
+    angles = np.degrees(np.arccos(cosine_angle))
+    angles[~np.asarray(valid, dtype=bool)] = np.nan
+    return angles
+
+
+def calculate_joint_angles(store, use_3d = False, schema = None):
+    # The angles of schema (default_schema() if None), the same ones the overlay shows
+    schema = schema or default_schema()
+    angles = compute_joint_angles(schema.points(store.landmarks), store.valid, schema.triplets, use_3d = use_3d)
+    # Create a dataframe to store the joint angles
+    df_joint_angles = pd.DataFrame(angles, index=store.time_index(), columns=schema.joints)
+    return df_joint_angles
+
+
+
+# Default color of each built-in joint in the overlay and the plots
+JOINT_COLORS = dict(BUILTIN_SCHEMA.colors)
+
+
+def smooth_joint_angles(df_joint_angles):
+    # Perform exponential weighted mean on joint angles to smooth data
+    return df_joint_angles.ewm(com=1.5, adjust = False).mean()
+
+
+KINEMATIC_QUANTITIES = ['angle', 'velocity', 'speed', 'acceleration']
+SUMMARY_PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def compute_kinematics(df_joint_angles):
+    # Angles with their angular velocity (degrees/second), speed (absolute
+    # velocity) and acceleration (degrees/second²) from the actual frame
+    # timestamps, as one table with (quantity, joint) columns
+    index = df_joint_angles.index
+    seconds = index.asi8 / 1e9 if isinstance(index, pd.DatetimeIndex) else np.asarray(index, dtype=np.float64)
+    angles = df_joint_angles.to_numpy(dtype=np.float64)
+    if len(angles) > 1:
+        # Central differences, one-sided at the ends; uneven frame spacing is taken into account
+        with np.errstate(invalid='ignore', divide='ignore'):
+            velocity = np.gradient(angles, seconds, axis=0)
+            acceleration = np.gradient(velocity, seconds, axis=0)
+    else:
+        velocity = np.full_like(angles, np.nan)
+        acceleration = np.full_like(angles, np.nan)
+    data = np.concatenate([angles, velocity, np.abs(velocity), acceleration], axis=1)
+    columns = pd.MultiIndex.from_product([KINEMATIC_QUANTITIES, df_joint_angles.columns], names=['quantity', 'joint'])
+    return pd.DataFrame(data, index=index, columns=columns)
+
+
+def summarize_kinematics(df_kinematics, percentiles = SUMMARY_PERCENTILES):
+    # Mean, min, max, range and percentiles of every (quantity, joint) column in
+    # one pass over the whole table; rows are (quantity, joint), missing frames are ignored
+    values = df_kinematics.to_numpy(dtype=np.float64)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        # All-NaN columns (a joint never detected) just summarize to NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        minimum = np.nanmin(values, axis=0)
+        maximum = np.nanmax(values, axis=0)
+        stats = {'mean': np.nanmean(values, axis=0), 'min': minimum, 'max': maximum, 'range': maximum - minimum}
+        for percentile, value in zip(percentiles, np.nanpercentile(values, percentiles, axis=0)):
+            stats[f'p{percentile}'] = value
+    return pd.DataFrame(stats, index=df_kinematics.columns)
@@ -0,0 +1,123 @@
+import importlib.util
+import io
+
+import numpy as np
+import pandas as pd
+
+from movesense.core import KINEMATIC_QUANTITIES, LANDMARK_NAMES, LandmarkStore
+
+# File extension and MIME type of each export format
+EXPORT_FORMATS = {'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+                  'arrow': ('.arrow', 'application/vnd.apache.arrow.file'),
+                  'hdf5': ('.h5', 'application/x-hdf5'),
+                  'npz': ('.npz', 'application/octet-stream'),
+                  'csv': ('.csv', 'text/csv')}
+# Optional package each format needs
+EXPORT_REQUIREMENTS = {'parquet': 'pyarrow', 'arrow': 'pyarrow', 'hdf5': 'h5py'}
+COMPRESSION = 'zstd'
+
+
+def available_formats():
+    return [export_format for export_format in EXPORT_FORMATS if export_format not in missing_formats()]
+
+
+def missing_formats():
+    # Formats whose package is not installed -> that package
+    return {export_format: module for export_format, module in EXPORT_REQUIREMENTS.items() if importlib.util.find_spec(module) is None}
+
+
+def _require(export_format):
+    module = EXPORT_REQUIREMENTS[export_format]
+    if importlib.util.find_spec(module) is None:
+        raise ImportError(f'{export_format} export needs {module} (pip install {module})')
+
+
+def series_column(joint, quantity):
+    # Column of a joint's quantity in session_frame, e.g. right_knee_angle
+    return f"{joint.lower().replace(' ', '_')}_{quantity}"
+
+
+def session_frame(store, df_kinematics):
+    # One row per sampled frame: time in seconds, whether a pose was detected,
+    # x, y, z and visibility of every landmark, then every kinematic quantity of
+    # every joint. Values are float32, as the landmarks are stored.
+    columns = {'time': store.timestamps, 'detected': store.valid}
+    landmarks = store.landmarks
+    for i, name in enumerate(LANDMARK_NAMES):
+        for j, coordinate in enumerate(LandmarkStore.COLUMNS):
+            columns[f'{name}_{coordinate}'] = landmarks[:, i, j]
+    for (quantity, joint), values in df_kinematics.items():
+        columns[series_column(joint, quantity)] = values.to_numpy(dtype=np.float32)
+    return pd.DataFrame(columns, copy=False)
+
+
+def session_arrays(store, df_kinematics, df_summary):
+    # The same data as arrays for numeric users: landmarks (frames, 33, 4),
+    # kinematics (frames, quantities, joints) and summary (quantities, joints,
+    # statistics), with the names of every axis alongside
+    joints = list(df_kinematics['angle'].columns)
+    return {'timestamps': store.timestamps,
+            'valid': store.valid,
+            'landmarks': store.landmarks,
+            'landmark_names': np.array(LANDMARK_NAMES),
+            'coordinates': np.array(LandmarkStore.COLUMNS),
+            'kinematics': df_kinematics.to_numpy(dtype=np.float32).reshape(len(store), len(KINEMATIC_QUANTITIES), len(joints)),
+            'quantities': np.array(KINEMATIC_QUANTITIES),
+            'joints': np.array(joints),
+            'summary': df_summary.to_numpy(dtype=np.float64).reshape(len(KINEMATIC_QUANTITIES), len(joints), -1),
+            'statistics': np.array(list(df_summary.columns))}
+
+
+def _write_parquet(f, store, df_kinematics, df_summary):
+    import pyarrow.parquet as pq
+    pq.write_table(_arrow_table(store, df_kinematics, df_summary), f, compression=COMPRESSION)
+
+
+def _write_arrow(f, store, df_kinematics, df_summary):
+    import pyarrow as pa
+    table = _arrow_table(store, df_kinematics, df_summary)
+    with pa.ipc.new_file(f, table.schema, options=pa.ipc.IpcWriteOptions(compression=COMPRESSION)) as writer:
+        writer.write_table(table)
+
+
+def _arrow_table(store, df_kinematics, df_summary):
+    # The summary statistics travel in the schema metadata
+    import pyarrow as pa
+    table = pa.Table.from_pandas(session_frame(store, df_kinematics), preserve_index=False)
+    summary = df_summary.copy()
+    summary.index = [series_column(joint, quantity) for quantity, joint in summary.index]
+    return table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                          b'movesense.summary': summary.to_json(orient='index').encode()})
+
+
+def _write_hdf5(f, store, df_kinematics, df_summary):
+    import h5py
+    with h5py.File(f, 'w') as h5:
+        for name, array in session_arrays(store, df_kinematics, df_summary).items():
+            if array.dtype.kind == 'U':
+                h5.create_dataset(name, data=array.astype(object), dtype=h5py.string_dtype())
+            else:
+                h5.create_dataset(name, data=array, compression='gzip', shuffle=True)
+
+
+def _write_npz(f, store, df_kinematics, df_summary):
+    np.savez_compressed(f, **session_arrays(store, df_kinematics, df_summary))
+
+
+def _write_csv(f, store, df_kinematics, df_summary):
+    f.write(session_frame(store, df_kinematics).to_csv(index=False).encode())
+
+
+WRITERS = {'parquet': _write_parquet, 'arrow': _write_arrow, 'hdf5': _write_hdf5, 'npz': _write_npz, 'csv': _write_csv}
+
+
+def export_session(store, df_kinematics, df_summary, export_format = 'parquet'):
+    # Landmarks, kinematics and summary of one result as the bytes of an export file.
+    # df_kinematics and df_summary come from compute_kinematics and summarize_kinematics
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {export_format!r}; choose from {", ".join(EXPORT_FORMATS)}')
+    if export_format in EXPORT_REQUIREMENTS:
+        _require(export_format)
+    f = io.BytesIO()
+    WRITERS[export_format](f, store, df_kinematics, df_summary)
+    return f.getvalue()
@@ -0,0 +1,89 @@
+import mmap
+import struct
+
+import cv2
+import numpy as np
+
+# Frame data is followed by the index (frames + 1 byte offsets, then the frame
+# timestamps) and this trailer: magic, number of frames, index position
+TRAILER = struct.Struct('<8sqq')
+MAGIC = b'MSFRAME1'
+
+
+class FrameStoreWriter:
+    # Writes annotated frames, each JPEG-compressed on its own, to a file object
+    # in the FrameStore format. Frames are appended in time order; close() adds
+    # the index.
+
+    def __init__(self, f, quality = 85):
+        self.f = f
+        self.quality = quality
+        self.offsets = [0]
+        self.timestamps = []
+
+    def append(self, frame, timestamp):
+        # frame is an RGB array
+        ok, data = cv2.imencode('.jpg', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            raise ValueError('Could not encode frame')
+        self.f.write(data.tobytes())
+        self.offsets.append(self.offsets[-1] + len(data))
+        self.timestamps.append(timestamp)
+
+    def close(self):
+        index_start = self.offsets[-1]
+        self.f.write(np.asarray(self.offsets, dtype='<i8').tobytes())
+        self.f.write(np.asarray(self.timestamps, dtype='<f8').tobytes())
+        self.f.write(TRAILER.pack(MAGIC, len(self.timestamps), index_start))
+
+
+class FrameStore:
+    # Read side of a frame file, memory-mapped. Looking up the frame at a time is
+    # an index computation from the (near uniform) frame spacing plus a check of
+    # the neighbours, and reading it is a slice of the map, so scrubbing costs the
+    # same at any point of any length of session and never decodes video.
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, index_start = TRAILER.unpack_from(self._map, len(self._map) - TRAILER.size)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f'{path} is not a frame store')
+        self.offsets = np.frombuffer(self._map, dtype='<i8', count=n + 1, offset=index_start)
+        self.timestamps = np.frombuffer(self._map, dtype='<f8', count=n, offset=index_start + 8 * (n + 1))
+        self._step = (self.timestamps[-1] - self.timestamps[0]) / (n - 1) if n > 1 else 1.0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def index_at(self, seconds):
+        # Index of the frame closest to a time in seconds
+        n = len(self.timestamps)
+        if n == 0:
+            raise IndexError('The frame store is empty')
+        i = int(round((seconds - self.timestamps[0]) / self._step)) if self._step > 0 else 0
+        i = min(max(i, 0), n - 1)
+        # Frame times are only roughly uniform, so the estimate can be a frame or so off
+        while i > 0 and abs(self.timestamps[i - 1] - seconds) < abs(self.timestamps[i] - seconds):
+            i -= 1
+        while i < n - 1 and abs(self.timestamps[i + 1] - seconds) < abs(self.timestamps[i] - seconds):
+            i += 1
+        return i
+
+    def jpeg(self, i):
+        # Compressed frame, ready to be shown as an image
+        return self._map[self.offsets[i]:self.offsets[i + 1]]
+
+    def frame(self, i):
+        # Decoded RGB frame
+        data = np.frombuffer(self._map, dtype=np.uint8, count=self.offsets[i + 1] - self.offsets[i], offset=self.offsets[i])
+        return cv2.cvtColor(cv2.imdecode(data, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+    def frame_at(self, seconds):
+        return self.frame(self.index_at(seconds))
+
+    def close(self):
+        # The index arrays are views of the map and have to go first
+        self.offsets = self.timestamps = None
+        self._map.close()
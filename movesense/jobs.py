@@ -0,0 +1,52 @@
+import threading
+import time
+import uuid
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # State of one background job as seen from the UI: status, the current stage
+    # with frames done out of the expected total, a snapshot of partial results
+    # and the final result or error. InferenceService keeps it up to date from
+    # the progress events its worker processes send through a Manager queue,
+    # and hands cancel() on to the worker through a Manager dict, where the
+    # run stops at its next progress report.
+
+    def __init__(self, name = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.status = 'queued'
+        self.stage = None
+        self.done = 0
+        self.total = None
+        self.partial = None
+        self.result = None
+        self.error = None
+        # Set by a scheduler that queues jobs per session and estimates their wait
+        self.session = None
+        self.estimated_wait = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def cancel(self):
+        # Queued jobs never start; running jobs stop at their next progress report
+        self._cancel.set()
+
+    def progress(self):
+        # Fraction of the current stage that is done, or None when the total is unknown
+        if not self.total:
+            return None
+        return min(1.0, self.done / self.total)
@@ -0,0 +1,208 @@
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from movesense.core import JOINT_COLORS, OverlayRenderer, PoseEstimator, compute_joint_angles
+from movesense.metrics import NULL_METRICS
+from movesense.models import default_pose_pool
+
+
+class FrameDropQueue:
+    # Bounded queue between the capture thread and inference. When it is full the
+    # oldest frame is dropped, so inference always works on the freshest frames
+    # instead of falling further and further behind the source.
+
+    def __init__(self, maxsize = 1):
+        self._items = collections.deque()
+        self._maxsize = maxsize
+        self._condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self._condition:
+            if len(self._items) >= self._maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self, timeout = None):
+        # Next item, or None on timeout or once the queue is closed and empty
+        with self._condition:
+            self._condition.wait_for(lambda: self._items or self.closed, timeout)
+            return self._items.popleft() if self._items else None
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+def open_capture(source):
+    # source is a webcam index (an int or a string of digits), a stream URL such as rtsp://... or a file path
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f'Could not open video source {source!r}')
+    return capture
+
+
+def capture_frames(source, realtime = False, stop = None):
+    # Yield (capture time, RGB frame) as frames arrive from the source. Webcams
+    # and streams deliver at their own pace; realtime = True replays a file at
+    # its recorded frame rate instead of as fast as it decodes.
+    capture = open_capture(source)
+    try:
+        start = time.perf_counter()
+        while stop is None or not stop.is_set():
+            ok, frame = capture.read()
+            if not ok:
+                return
+            if realtime:
+                delay = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000 - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield time.perf_counter(), cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+
+class CausalSmoother:
+    # Frame-by-frame version of smooth_joint_angles: the same exponentially
+    # weighted mean (com = 1.5, adjust = False) using only past frames, plus the
+    # angular velocity between consecutive smoothed values. A joint that is missing
+    # in a frame keeps its last smoothed angle and has no velocity for that frame.
+
+    def __init__(self, n_joints, com = 1.5):
+        self.alpha = 1 / (1 + com)
+        self.angles = np.full(n_joints, np.nan)
+        self.velocities = np.full(n_joints, np.nan)
+        self.time = None
+
+    def update(self, angles, timestamp):
+        previous = self.angles
+        with np.errstate(invalid='ignore'):
+            updated = np.where(np.isnan(previous), angles, previous + self.alpha * (angles - previous))
+        self.angles = np.where(np.isnan(angles), previous, updated)
+        if self.time is not None and timestamp > self.time:
+            self.velocities = np.where(np.isnan(angles), np.nan, (self.angles - previous) / (timestamp - self.time))
+        self.time = timestamp
+        return self.angles, self.velocities
+
+
+class LiveSession:
+    # Pose estimation, overlay and joint angles on a live source with a latency
+    # budget. A capture thread feeds a FrameDropQueue; frames that have waited
+    # longer than latency_budget seconds by the time inference is free are
+    # skipped. run() yields one update per processed frame.
+
+    def __init__(self, source, detectconfidence, trackconfidence, color_discrete_map = JOINT_COLORS,
+                 textscale = 1.0, textsize = 2, angletextcolor = 'White', linesize = 2, markersize = 5,
+                 latency_budget = 0.25, queue_size = 1, realtime = False, metrics = NULL_METRICS, inference_height = None, roi = False,
+                 schema = None):
+        self.source = source
+        self.detectconfidence = detectconfidence
+        self.trackconfidence = trackconfidence
+        self.renderer = OverlayRenderer(color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, schema)
+        self.schema = self.renderer.schema
+        self.latency_budget = latency_budget
+        self.queue_size = queue_size
+        self.realtime = realtime
+        self.metrics = metrics
+        self.inference_height = inference_height
+        self.roi = roi
+        self.joints = self.schema.joints
+        self.processed = 0
+        self.stale = 0
+        self.dropped = 0
+        # Completion times and latencies of recent frames for the reported fps and latency
+        self._done = collections.deque(maxlen=30)
+        self._latencies = collections.deque(maxlen=300)
+
+    def stats(self):
+        done = self._done
+        latencies = np.array(self._latencies) * 1000
+        return {'fps': (len(done) - 1) / (done[-1] - done[0]) if len(done) > 1 and done[-1] > done[0] else 0.0,
+                'latency_ms': float(latencies[-1]) if len(latencies) else None,
+                'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'latency_p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'stale': self.stale}
+
+    def run(self):
+        # Yields dicts with the annotated frame, the time in seconds since the
+        # start, the (33, 4) landmarks or None, smoothed angles and velocities
+        # in self.joints order, and the current stats()
+        stop = threading.Event()
+        frames = FrameDropQueue(self.queue_size)
+        errors = []
+
+        def capture():
+            try:
+                for item in capture_frames(self.source, self.realtime, stop):
+                    frames.put(item)
+            except BaseException as error:
+                errors.append(error)
+            finally:
+                frames.close()
+
+        opened = time.perf_counter()
+        thread = threading.Thread(target=capture, daemon=True)
+        thread.start()
+        smoother = CausalSmoother(len(self.joints))
+        start = None
+        try:
+            with default_pose_pool().checkout(self.detectconfidence, self.trackconfidence, metrics=self.metrics) as pose:
+                estimator = PoseEstimator(pose, self.inference_height, self.roi, metrics=self.metrics)
+                while True:
+                    item = frames.get(timeout=0.1)
+                    self.dropped = frames.dropped
+                    if item is None:
+                        if frames.closed:
+                            break
+                        continue
+                    captured, frame = item
+                    start = captured if start is None else start
+                    # Too old to be worth showing; the next frame is fresher
+                    if time.perf_counter() - captured > self.latency_budget:
+                        self.stale += 1
+                        self.metrics.count('frames_stale')
+                        continue
+
+                    landmarks = estimator.process(frame)
+                    if landmarks is None:
+                        angles = np.full(len(self.joints), np.nan)
+                        self.metrics.count('frames_without_landmarks')
+                    else:
+                        with self.metrics.time('draw'):
+                            self.renderer.draw(frame, landmarks)
+                        angles = compute_joint_angles(self.schema.points(landmarks)[np.newaxis], [True], self.schema.triplets)[0]
+                    smoothed, velocities = smoother.update(angles, captured - start)
+
+                    done = time.perf_counter()
+                    self.processed += 1
+                    if self.processed == 1:
+                        self.metrics.add_time('first_frame', done - opened)
+                    self._done.append(done)
+                    self._latencies.append(done - captured)
+                    self.metrics.count('frames_processed')
+                    self.metrics.add_time('latency', done - captured)
+                    yield {'time': captured - start,
+                           'frame': frame,
+                           'landmarks': landmarks,
+                           'angles': smoothed.copy(),
+                           'velocities': velocities.copy(),
+                           'stats': self.stats()}
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            frames.close()
+            thread.join(timeout=1)
+            self.metrics.count('frames_dropped', frames.dropped)
@@ -0,0 +1,178 @@
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    # Per-run stage timers and counters. Stages are timed with time() or
+    # add_time() and counters bumped with count(); both are safe to use from the
+    # pipeline's worker threads.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = Counter()
+        self.profile = None
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def merge(self, data):
+        # Add the stages and counters of another run's to_dict(), e.g. from a worker process
+        with self._lock:
+            for stage, timing in data['stages'].items():
+                calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+                self.stages[stage] = (calls + timing['calls'], total + timing['seconds'],
+                                      max(longest, timing['max_ms'] / 1000))
+            self.counters.update(data['counters'])
+
+    def to_dict(self):
+        with self._lock:
+            stages = {stage: {'calls': calls,
+                              'seconds': round(total, 6),
+                              'mean_ms': round(1000 * total / calls, 4) if calls else None,
+                              'max_ms': round(1000 * longest, 4)}
+                      for stage, (calls, total, longest) in self.stages.items()}
+            return {'started': self.started,
+                    'wall_seconds': round(time.time() - self.started, 6),
+                    'stages': stages,
+                    'counters': dict(self.counters),
+                    'profile': self.profile}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix = 'movesense', labels = None):
+        # Prometheus text exposition format
+        label_text = ','.join(f'{key}="{value}"' for key, value in (labels or {}).items())
+
+        def series(name, value, extra = ''):
+            inner = ','.join(part for part in (label_text, extra) if part)
+            return f'{prefix}_{name}{{{inner}}} {value}' if inner else f'{prefix}_{name} {value}'
+
+        data = self.to_dict()
+        lines = [f'# HELP {prefix}_stage_seconds_total Time spent in each processing stage.',
+                 f'# TYPE {prefix}_stage_seconds_total counter']
+        lines += [series('stage_seconds_total', stage['seconds'], f'stage="{name}"') for name, stage in data['stages'].items()]
+        lines += [f'# HELP {prefix}_stage_calls_total Number of times each processing stage ran.',
+                  f'# TYPE {prefix}_stage_calls_total counter']
+        lines += [series('stage_calls_total', stage['calls'], f'stage="{name}"') for name, stage in data['stages'].items()]
+        for name, value in sorted(data['counters'].items()):
+            lines += [f'# TYPE {prefix}_{name}_total counter', series(f'{name}_total', value)]
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(RunMetrics):
+    # Stand-in used when nobody asked for metrics; records nothing
+
+    def merge(self, data):
+        pass
+
+    @contextmanager
+    def time(self, stage):
+        yield
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, name, n = 1):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads at a fixed interval, so time spent in
+    # the pipeline's worker threads shows up too (cProfile only sees one thread)
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self.leaf = Counter()
+        self.cumulative = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                self.samples += 1
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+                    if leaf:
+                        self.leaf[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        self.cumulative[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, limit = 30):
+        lines = [f'{self.samples} samples every {self.interval * 1000:.0f} ms across all threads',
+                 '', 'Self time:']
+        lines += [f'{100 * n / self.samples:6.1f}%  {key}' for key, n in self.leaf.most_common(limit)] if self.samples else []
+        lines += ['', 'Including callees:']
+        lines += [f'{100 * n / self.samples:6.1f}%  {key}' for key, n in self.cumulative.most_common(limit)] if self.samples else []
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile_run(metrics, profiler = None, limit = 30):
+    # Opt-in profiling of one run; the text report ends up in metrics.profile.
+    # profiler is None, 'sampling' (all threads) or 'cprofile' (calling thread only)
+    if profiler is None:
+        yield
+        return
+    if profiler == 'sampling':
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            metrics.profile = sampler.report(limit)
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(limit)
+        metrics.profile = output.getvalue()
@@ -0,0 +1,138 @@
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from movesense.metrics import NULL_METRICS
+
+# One-off costs of this process, filled in as they happen: importing MediaPipe,
+# loading the first Pose graph and its first inference
+COLD_START = {}
+_import_lock = threading.Lock()
+
+
+def pose_solution():
+    # mp.solutions.pose, imported on first use. MediaPipe is by far the slowest
+    # import of the app, so nothing loads it until a pose model is needed.
+    with _import_lock:
+        start = time.perf_counter()
+        import mediapipe as mp
+        COLD_START.setdefault('mediapipe_import_seconds', time.perf_counter() - start)
+    return mp.solutions.pose
+
+
+class PosePool:
+    # Process-wide pool of loaded MediaPipe Pose graphs keyed on detection and
+    # tracking confidence and static image mode. A run checks a graph out, uses it from one thread and
+    # returns it reset, so the next video starts detection from scratch without
+    # loading the model again. At most max_idle graphs are kept; the least
+    # recently returned ones are closed first.
+
+    def __init__(self, max_idle = 4):
+        self.max_idle = max_idle
+        self._idle = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.loaded = 0
+        self.reused = 0
+
+    @staticmethod
+    def _key(detectconfidence, trackconfidence, static_image_mode = False):
+        return (round(float(detectconfidence), 4), round(float(trackconfidence), 4), bool(static_image_mode))
+
+    def _load(self, key, metrics):
+        start = time.perf_counter()
+        pose = pose_solution().Pose(static_image_mode=key[2], min_detection_confidence=key[0], min_tracking_confidence=key[1])
+        seconds = time.perf_counter() - start
+        COLD_START.setdefault('first_model_load_seconds', seconds)
+        metrics.add_time('model_load', seconds)
+        metrics.count('pose_models_loaded')
+        with self._lock:
+            self.loaded += 1
+        return pose
+
+    def _take(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if not idle:
+                return None
+            pose = idle.pop()
+            if not idle:
+                del self._idle[key]
+            self.reused += 1
+            return pose
+
+    def _give_back(self, key, pose):
+        try:
+            # Forget the tracked pose of the previous video
+            if hasattr(pose, 'reset'):
+                pose.reset()
+        except Exception:
+            pose.close()
+            return
+        closing = []
+        with self._lock:
+            self._idle.setdefault(key, []).append(pose)
+            self._idle.move_to_end(key)
+            while sum(len(idle) for idle in self._idle.values()) > self.max_idle:
+                oldest = next(iter(self._idle))
+                closing.append(self._idle[oldest].pop(0))
+                if not self._idle[oldest]:
+                    del self._idle[oldest]
+        for pose in closing:
+            pose.close()
+
+    @contextmanager
+    def checkout(self, detectconfidence, trackconfidence, metrics = NULL_METRICS, static_image_mode = False):
+        # static_image_mode graphs detect the pose afresh in every image, without tracking
+        key = self._key(detectconfidence, trackconfidence, static_image_mode)
+        pose = self._take(key)
+        if pose is None:
+            pose = self._load(key, metrics)
+        else:
+            metrics.count('pose_models_reused')
+        try:
+            yield pose
+        finally:
+            self._give_back(key, pose)
+
+    def warm(self, detectconfidence, trackconfidence):
+        # Load a graph and run it once on a blank frame, which allocates the
+        # model's tensors, so the first real frame of the next run is not slower
+        key = self._key(detectconfidence, trackconfidence)
+        with self._lock:
+            if self._idle.get(key):
+                return
+        pose = self._load(key, NULL_METRICS)
+        start = time.perf_counter()
+        pose.process(np.zeros((256, 256, 3), dtype=np.uint8))
+        COLD_START.setdefault('first_warmup_seconds', time.perf_counter() - start)
+        self._give_back(key, pose)
+
+    def stats(self):
+        with self._lock:
+            return {'loaded': self.loaded,
+                    'reused': self.reused,
+                    'idle': sum(len(idle) for idle in self._idle.values()),
+                    **COLD_START}
+
+    def close(self):
+        with self._lock:
+            closing = [pose for idle in self._idle.values() for pose in idle]
+            self._idle.clear()
+        for pose in closing:
+            pose.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pose_pool():
+    # The pool shared by every run in this process
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = PosePool()
+        return _default_pool
@@ -0,0 +1,83 @@
+import numpy as np
+import plotly.graph_objects as go
+
+# Points kept per trace; about the pixel width of a wide chart, beyond which
+# extra points only add payload
+MAX_POINTS = 2000
+# Static (SVG) thumbnails are small, so they need far fewer points
+STATIC_MAX_POINTS = 400
+# Traces with more points than this are drawn with WebGL instead of SVG
+WEBGL_THRESHOLD = 1000
+
+
+def lttb(x, y, n_out):
+    # Indices of n_out points picked by Largest-Triangle-Three-Buckets, which keeps
+    # peaks and troughs that plain striding would drop. x must be increasing.
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # First and last points are always kept; the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        # Pick the point forming the largest triangle with the previous pick and the next bucket's mean
+        cx = x[end:next_end].mean()
+        cy = y[end:next_end].mean()
+        area = np.abs((x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def downsample_indices(x, y, n_out):
+    # LTTB over the finite values, plus the first missing value of every gap
+    # so lines still break where no pose was detected
+    y = np.asarray(y, dtype=np.float64)
+    finite = np.isfinite(y)
+    if finite.all():
+        return lttb(x, y, n_out)
+    present = np.flatnonzero(finite)
+    keep = present[lttb(np.asarray(x)[present], y[present], n_out)]
+    gaps = np.flatnonzero(~finite & np.r_[True, finite[:-1]])
+    return np.union1d(keep, gaps)
+
+
+def _numeric(x):
+    # Datetimes as integer nanoseconds, anything else as float, for bucket geometry
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return x.astype(np.float64)
+
+
+def series_figure(df, columns, colors, height, area = False, static = False, max_points = None):
+    # One trace per column of df against its index, downsampled to max_points.
+    # Line traces are downsampled one by one and large ones use WebGL unless the
+    # figure is static, where SVG is required. Area traces are stacked, which needs
+    # shared x values and SVG, so they are downsampled together on their sum.
+    if isinstance(columns, str):
+        columns = [columns]
+    max_points = max_points or (STATIC_MAX_POINTS if static else MAX_POINTS)
+    x = df.index.to_numpy()
+    x_numeric = _numeric(x)
+    if area:
+        shared = downsample_indices(x_numeric, df[columns].sum(axis=1, min_count=1).to_numpy(), max_points)
+    figure = go.Figure()
+    for column in columns:
+        y = df[column].to_numpy(dtype=np.float64)
+        if area:
+            figure.add_trace(go.Scatter(x=x[shared], y=y[shared], name=column, mode='lines',
+                                        line={'color': colors.get(column)}, stackgroup='one'))
+            continue
+        idx = downsample_indices(x_numeric, y, max_points)
+        trace = go.Scatter if static or len(idx) <= WEBGL_THRESHOLD else go.Scattergl
+        figure.add_trace(trace(x=x[idx], y=y[idx], name=column, mode='lines', line={'color': colors.get(column)}))
+    figure.update_layout(height=height, hovermode='x', showlegend=False)
+    return figure
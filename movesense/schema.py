@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# MediaPipe Pose landmarks in index order
+LANDMARK_NAMES = ['nose', 'left_eye_inner', 'left_eye', 'left_eye_outer', 'right_eye_inner', 'right_eye',
+                  'right_eye_outer', 'left_ear', 'right_ear', 'mouth_left', 'mouth_right',
+                  'left_shoulder', 'right_shoulder', 'left_elbow', 'right_elbow', 'left_wrist', 'right_wrist',
+                  'left_pinky', 'right_pinky', 'left_index', 'right_index', 'left_thumb', 'right_thumb',
+                  'left_hip', 'right_hip', 'left_knee', 'right_knee', 'left_ankle', 'right_ankle',
+                  'left_heel', 'right_heel', 'left_foot_index', 'right_foot_index']
+
+# Landmark pairs of the skeleton, as mp.solutions.pose.POSE_CONNECTIONS, kept
+# here so drawing from cached landmarks never has to import MediaPipe
+POSE_CONNECTIONS = [(0, 1), (1, 2), (2, 3), (3, 7), (0, 4), (4, 5), (5, 6), (6, 8), (9, 10),
+                    (11, 12), (11, 13), (13, 15), (15, 17), (15, 19), (15, 21), (17, 19),
+                    (12, 14), (14, 16), (16, 18), (16, 20), (16, 22), (18, 20),
+                    (11, 23), (12, 24), (23, 24), (23, 25), (24, 26), (25, 27), (26, 28),
+                    (27, 29), (28, 30), (29, 31), (30, 32), (27, 31), (28, 32)]
+
+# The joints MoveSense measures and draws, in the format of a schema file:
+#   points   derived points, each the mean of some landmarks plus an optional
+#            (x, y, z) offset in normalized image coordinates
+#   angles   the angle at the middle of three landmarks or points, in column
+#            order, with the color of its plots and overlay marker
+#   markers  landmarks or points that get a marker in the overlay; color is a
+#            color or the name of the angle whose color the marker shares
+#            (the angle of the same name by default)
+# A schema file is merged into this one, so it only needs its additions, e.g.
+#   {"points": {"mid_shoulder": {"mean": ["left_shoulder", "right_shoulder"]},
+#               "mid_hip": {"mean": ["left_hip", "right_hip"]},
+#               "above_mid_hip": {"mean": ["left_hip", "right_hip"], "offset": [0, -0.1, 0]}},
+#    "angles": {"Trunk Lean": {"points": ["mid_shoulder", "mid_hip", "above_mid_hip"], "color": "#00a000"},
+#               "Left Leg Alignment": {"points": ["left_hip", "left_knee", "left_ankle"], "color": "#00c0c0"}}}
+# Set "extends": false to replace the built-in joints instead.
+DEFAULT_SCHEMA = {
+    'points': {},
+    'angles': {
+        'Left Shoulder': {'points': ['left_hip', 'left_shoulder', 'left_elbow'], 'color': '#ff0000'},
+        'Right Shoulder': {'points': ['right_hip', 'right_shoulder', 'right_elbow'], 'color': '#ff8000'},
+        'Left Elbow': {'points': ['left_shoulder', 'left_elbow', 'left_wrist'], 'color': '#ff6666'},
+        'Right Elbow': {'points': ['right_shoulder', 'right_elbow', 'right_wrist'], 'color': '#ffb266'},
+        'Left Wrist': {'points': ['left_index', 'left_wrist', 'left_elbow'], 'color': '#ffcccc'},
+        'Right Wrist': {'points': ['right_index', 'right_wrist', 'right_elbow'], 'color': '#ffe5cc'},
+        'Left Hip': {'points': ['right_hip', 'left_hip', 'left_knee'], 'color': '#0000ff'},
+        'Right Hip': {'points': ['left_hip', 'right_hip', 'right_knee'], 'color': '#7f00ff'},
+        'Left Knee': {'points': ['left_hip', 'left_knee', 'left_ankle'], 'color': '#6666ff'},
+        'Right Knee': {'points': ['right_hip', 'right_knee', 'right_ankle'], 'color': '#b266ff'},
+        'Left Ankle': {'points': ['left_foot_index', 'left_ankle', 'left_knee'], 'color': '#ccccff'},
+        'Right Ankle': {'points': ['right_foot_index', 'right_ankle', 'right_knee'], 'color': '#e5ccff'}
+    },
+    'markers': {
+        'Left Shoulder': {'point': 'left_shoulder'}, 'Left Elbow': {'point': 'left_elbow'}, 'Left Wrist': {'point': 'left_wrist'},
+        'Right Shoulder': {'point': 'right_shoulder'}, 'Right Elbow': {'point': 'right_elbow'}, 'Right Wrist': {'point': 'right_wrist'},
+        'Right Index': {'point': 'right_index', 'color': 'Right Wrist'}, 'Left Index': {'point': 'left_index', 'color': 'Left Wrist'},
+        'Left Hip': {'point': 'left_hip'}, 'Left Knee': {'point': 'left_knee'}, 'Left Ankle': {'point': 'left_ankle'},
+        'Right Hip': {'point': 'right_hip'}, 'Right Knee': {'point': 'right_knee'}, 'Right Ankle': {'point': 'right_ankle'},
+        'Right Foot Index': {'point': 'right_foot_index', 'color': 'Right Ankle'},
+        'Left Foot Index': {'point': 'left_foot_index', 'color': 'Left Ankle'}
+    }
+}
+
+DEFAULT_COLOR = '#808080'
+
+
+class JointSchema:
+    # A joint schema compiled to index arrays. Landmarks and derived points share
+    # one table, the 33 landmarks followed by the points: points() appends the
+    # derived points to landmark arrays of any leading shape with one gather, and
+    # triplets indexes that table, so any number of angles is a single vectorized
+    # angle computation per frame or per video.
+
+    def __init__(self, definition):
+        self.definition = definition
+        table = {name: i for i, name in enumerate(LANDMARK_NAMES)}
+
+        def lookup(reference, where):
+            if isinstance(reference, int) and 0 <= reference < len(table):
+                return reference
+            if reference in table:
+                return table[reference]
+            raise ValueError(f'Unknown landmark or point {reference!r} in {where}')
+
+        # Every point's members padded to the same length with its own first
+        # member at zero weight, so a missing landmark only affects the points
+        # that use it
+        points = definition.get('points', {})
+        members = []
+        offsets = []
+        for name, point in points.items():
+            if not point.get('mean'):
+                raise ValueError(f'Point {name!r} needs a list of landmarks to average')
+            members.append([lookup(member, f'point {name!r}') for member in point['mean']])
+            offsets.append(point.get('offset', [0.0, 0.0, 0.0]))
+            table[name] = len(table)
+        width = max((len(indices) for indices in members), default=1)
+        self.point_members = np.array([indices + indices[:1] * (width - len(indices)) for indices in members],
+                                      dtype=np.intp).reshape(len(members), width)
+        self.point_weights = np.array([[1.0 / len(indices)] * len(indices) + [0.0] * (width - len(indices)) for indices in members],
+                                      dtype=np.float64).reshape(len(members), width)
+        self.point_offsets = np.array(offsets, dtype=np.float64).reshape(len(members), 3)
+
+        angles = definition.get('angles', {})
+        for name, angle in angles.items():
+            if len(angle.get('points', [])) != 3:
+                raise ValueError(f'Angle {name!r} needs three points (outer, vertex, outer)')
+        self.joints = list(angles)
+        self.triplets = np.array([[lookup(reference, f'angle {name!r}') for reference in angle['points']] for name, angle in angles.items()],
+                                 dtype=np.intp).reshape(len(angles), 3)
+        self.colors = {name: angle.get('color', DEFAULT_COLOR) for name, angle in angles.items()}
+
+        markers = definition.get('markers', {})
+        self.markers = list(markers)
+        self.marker_indices = np.array([lookup(marker['point'], f'marker {name!r}') for name, marker in markers.items()], dtype=np.intp)
+        # Name of the angle whose color each marker takes, or a color of its own
+        self.marker_colors = [marker.get('color', name if name in self.colors else DEFAULT_COLOR) for name, marker in markers.items()]
+
+        self.digest = hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()[:16]
+
+    def points(self, landmarks):
+        # (..., 33, 4) landmarks to (..., 33 + points, 4) with the derived points;
+        # their visibility is the mean visibility of their landmarks
+        landmarks = np.asarray(landmarks)
+        if not len(self.point_members):
+            return landmarks
+        derived = np.einsum('...pmk,pm->...pk', landmarks[..., self.point_members, :], self.point_weights)
+        derived[..., :3] += self.point_offsets
+        return np.concatenate([landmarks, derived.astype(landmarks.dtype, copy=False)], axis=-2)
+
+    def triplet_map(self):
+        # Angle name -> landmark/point index triplet
+        return {name: tuple(int(i) for i in triplet) for name, triplet in zip(self.joints, self.triplets)}
+
+
+def merge_schema(base, extra):
+    # extra's points, angles and markers added to (or replacing those of the
+    # same name in) base's, unless extra sets "extends": false
+    if not extra.get('extends', True):
+        return {section: dict(extra.get(section, {})) for section in ('points', 'angles', 'markers')}
+    return {section: {**base.get(section, {}), **extra.get(section, {})} for section in ('points', 'angles', 'markers')}
+
+
+def load_schema(path):
+    # A schema from a JSON file, merged into the built-in one
+    with open(path) as f:
+        return JointSchema(merge_schema(DEFAULT_SCHEMA, json.load(f)))
+
+
+BUILTIN_SCHEMA = JointSchema(DEFAULT_SCHEMA)
+
+_default_schema = None
+_default_schema_lock = threading.Lock()
+
+
+def default_schema():
+    # The schema of this process: the file named by MOVESENSE_JOINT_SCHEMA, or
+    # the built-in one. Worker processes inherit the variable and so the schema.
+    global _default_schema
+    with _default_schema_lock:
+        if _default_schema is None:
+            path = os.environ.get('MOVESENSE_JOINT_SCHEMA')
+            _default_schema = load_schema(path) if path else BUILTIN_SCHEMA
+        return _default_schema
@@ -0,0 +1,438 @@
+import collections
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import suppress
+from queue import Empty
+
+import numpy as np
+
+from movesense import core
+from movesense.cache import ResultCache, landmarks_key, pose_video_key
+from movesense.jobs import Job, JobCancelled
+from movesense.metrics import RunMetrics, profile_run
+from movesense.models import COLD_START, default_pose_pool
+
+# Seconds between progress messages and between partial result snapshots sent by a worker
+PROGRESS_INTERVAL = 0.25
+PARTIAL_INTERVAL = 1.0
+# Assumed processing time per sampled frame until some jobs have finished
+DEFAULT_SECONDS_PER_FRAME = 0.05
+
+
+class AdmissionError(Exception):
+    # An upload the service will not take; estimated_wait is when trying again
+    # is likely to succeed, in seconds, or None when waiting would not help
+    def __init__(self, message, estimated_wait = None):
+        super().__init__(message)
+        self.estimated_wait = estimated_wait
+
+
+def _percentiles(values):
+    if not values:
+        return None, None
+    p50, p95 = np.percentile(np.asarray(values), [50, 95])
+    return float(p50), float(p95)
+
+
+def _analyze(job_id, path, cache_directory, cache_max_bytes, video_key, settings, workers, render, profiler, events, cancelled):
+    # Runs in a service worker process: landmarks into the shared result cache,
+    # then the annotated video unless render is None. Progress and partial
+    # landmarks go back through events; a job id in cancelled stops the run.
+    # Returns the run's metrics as a dict.
+    metrics = RunMetrics()
+    sent = {'progress': 0.0, 'partial': 0.0}
+
+    def report(stage, done, total, partial = None):
+        if job_id in cancelled:
+            raise JobCancelled(job_id)
+        now = time.monotonic()
+        if now - sent['progress'] < PROGRESS_INTERVAL:
+            return
+        sent['progress'] = now
+        if partial is not None and now - sent['partial'] >= PARTIAL_INTERVAL:
+            sent['partial'] = now
+            partial = partial.copy()
+        else:
+            partial = None
+        events.put((job_id, stage, done, total, partial))
+
+    with profile_run(metrics, profiler):
+        result_cache = ResultCache(cache_directory, cache_max_bytes)
+        container = core.open_video_container(path)
+        total = core.sampled_frame_count(container, settings['fps'])
+        container.close()
+        key = landmarks_key(video_key, **settings)
+        store = result_cache.get_landmarks(key)
+        if store is None:
+            store = core.extract_pose_landmarks(path, settings['fps'], settings['detectconfidence'], settings['trackconfidence'],
+                                                settings['sampling'], workers, metrics = metrics,
+                                                inference_height = settings['inference_height'], roi = settings['roi'],
+                                                keyframe_interval = settings['keyframe_interval'], optical_flow = settings['optical_flow'],
+                                                progress = lambda done, partial: report('Analyzing', done, total, partial))
+            result_cache.put_landmarks(key, store)
+        else:
+            metrics.count('landmark_disk_cache_hits')
+        if render is not None:
+            key = pose_video_key(video_key, store, **render)
+            if not (result_cache.has_video(key) and result_cache.has_frames(key)):
+                # The annotated frames are kept too, for scrubbing without decoding the video.
+                # The video only goes to the cache, so long ones spill to disk instead of RAM.
+                with result_cache.frames_writer(key) as frame_store, core.spooled_video_output() as output:
+                    core.stream_pose_video(path, store, render['fps'], render['color_discrete_map'], render['textscale'],
+                                           render['textsize'], render['angletextcolor'], render['linesize'],
+                                           render['markersize'], render['sampling'], output = output, profile = render['profile'], metrics = metrics,
+                                           progress = lambda done, _: report('Rendering', done, len(store)), frame_store = frame_store)
+                    result_cache.put_video(key, output)
+    return metrics.to_dict()
+
+
+def _warm(detectconfidence, trackconfidence):
+    # Runs in a service worker process; returns the process's cold start figures
+    default_pose_pool().warm(detectconfidence, trackconfidence)
+    return dict(COLD_START)
+
+
+class InferenceService:
+    # Local inference service shared by every session of the app. Videos are
+    # analyzed in a pool of worker processes, at most `workers` at a time;
+    # waiting jobs are queued per session and dispatched round-robin, so one
+    # session's batch of uploads cannot hold everyone else back. Admission is
+    # checked at submit(): a video longer than max_video_seconds, a session
+    # with more than max_session_frames sampled frames queued or running, or a
+    # full queue (max_queued jobs) is rejected with an AdmissionError carrying
+    # the estimated wait. Results land in the shared result cache; a Job
+    # tracks progress, partial landmarks and the run's metrics. Each job splits
+    # its video over segment_workers processes of its own (see
+    # extract_pose_landmarks_parallel), so up to workers * segment_workers
+    # processes analyze at once; both are the operator's settings, not a visitor's.
+
+    def __init__(self, result_cache, workers = 1, max_queued = 16, max_session_frames = None, max_video_seconds = None, segment_workers = 1):
+        self.result_cache = result_cache
+        self.workers = workers
+        self.segment_workers = segment_workers
+        self.max_queued = max_queued
+        self.max_session_frames = max_session_frames
+        self.max_video_seconds = max_video_seconds
+        self._context = multiprocessing.get_context('spawn')
+        # Spawned workers start clean instead of inheriting the threads of a running server,
+        # and keep their warm pose models from one job to the next
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=self._context)
+        self._start_manager()
+        # Reentrant: a future that is already done runs its callback inside _dispatch
+        self._lock = threading.RLock()
+        self._queues = collections.OrderedDict()  # session -> deque of waiting (job, submission)
+        self._running = {}
+        self._session_frames = collections.Counter()
+        self._served = {}
+        self._frames = {}
+        self._staged = {}  # video_key -> upload staged on disk for the workers (see _stage)
+        self._job_videos = {}  # job id -> video_key of its staged upload
+        self._queue_waits = collections.deque(maxlen=500)
+        self._processing_times = collections.deque(maxlen=500)
+        self._seconds_per_frame = collections.deque(maxlen=50)
+        self.rejected = 0
+        self._closed = threading.Event()
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def _start_manager(self):
+        # Progress events from the workers and the ids of cancelled jobs go through a Manager process
+        self._manager = self._context.Manager()
+        self._events = self._manager.Queue()
+        self._cancelled = self._manager.dict()
+
+    def _manager_lost(self):
+        # The Manager process died: running jobs can neither report nor be
+        # cancelled any more, so they fail, and the next jobs get a new Manager.
+        # Their workers stop at their next report, which can no longer reach it.
+        with self._lock:
+            for job in list(self._running.values()):
+                job.error = RuntimeError('The analysis lost its connection to the inference service')
+                del self._running[job.id]
+                self._finish(job, 'failed')
+            with suppress(Exception):
+                self._manager.shutdown()
+            self._start_manager()
+        self._dispatch()
+
+    def _probe(self, video, fps):
+        container = core.open_video_container(video)
+        try:
+            return core.video_duration(container), core.sampled_frame_count(container, fps)
+        finally:
+            container.close()
+
+    def _seconds_per_frame_estimate(self):
+        return float(np.median(self._seconds_per_frame)) if self._seconds_per_frame else DEFAULT_SECONDS_PER_FRAME
+
+    def _backlog_frames(self):
+        # Sampled frames still to be processed by running and queued jobs
+        running = sum(max(self._frames[job.id] - (job.done if job.stage == 'Analyzing' else 0), 0) for job in self._running.values())
+        queued = sum(self._frames[job.id] for queue in self._queues.values() for job, _ in queue)
+        return running + queued
+
+    def _estimate_wait(self):
+        return self._backlog_frames() * self._seconds_per_frame_estimate() / self.workers
+
+    def _reject(self, message, estimated_wait = None):
+        self.rejected += 1
+        raise AdmissionError(message, estimated_wait)
+
+    def submit(self, session_id, video, video_key, settings, render = None, profiler = None, name = None):
+        # Queue a video for a session, or raise AdmissionError. video is a path or
+        # a bytes-like buffer; worker processes cannot see the app's memory, so a
+        # buffer is written to a temp file, once admitted and outside the lock, by
+        # the calling session's thread. Jobs of the same video_key share that file
+        # (see _stage). settings are the landmarks_key arguments
+        # and render the pose_video_key ones (without the video digest and store),
+        # or None to skip the video.
+        duration, frames = self._probe(video, settings['fps'])
+        with self._lock:
+            if self.max_video_seconds is not None and duration > self.max_video_seconds:
+                self._reject(f'The video is {duration:.0f} s long; videos up to {self.max_video_seconds:.0f} s are accepted')
+            if self.max_session_frames is not None and self._session_frames[session_id] + frames > self.max_session_frames:
+                if frames > self.max_session_frames:
+                    self._reject(f'The video has {frames} frames to analyze at this frame rate; up to {self.max_session_frames} are accepted')
+                self._reject(f'Your earlier videos are still being analyzed ({self._session_frames[session_id]} frames); '
+                             f'up to {self.max_session_frames} frames can be queued per session', self._estimate_wait())
+            if sum(len(queue) for queue in self._queues.values()) >= self.max_queued:
+                self._reject('The analysis queue is full', self._estimate_wait())
+            job = Job(name)
+            job.session = session_id
+            job.total = frames
+            job.estimated_wait = self._estimate_wait()
+            self._frames[job.id] = frames
+            self._session_frames[session_id] += frames
+        if isinstance(video, (str, os.PathLike)):
+            path = os.fspath(video)
+        else:
+            try:
+                path = self._stage(job, video, video_key)
+            except BaseException:
+                with self._lock:
+                    self._finish(job, 'failed')
+                raise
+        with self._lock:
+            self._queues.setdefault(session_id, collections.deque()).append((job, (path, video_key, settings, render, profiler)))
+        self._dispatch()
+        return job
+
+    def _stage(self, job, video, video_key):
+        # Path of a temp file holding the upload, written by the first job of its
+        # video_key and shared by the jobs after it, e.g. re-renders with another
+        # style, until the last of them finishes
+        with self._lock:
+            staged = self._staged.get(video_key)
+            writer = staged is None
+            if writer:
+                staged = self._staged[video_key] = {'path': None, 'jobs': 0, 'ready': threading.Event()}
+            staged['jobs'] += 1
+            self._job_videos[job.id] = video_key
+        if writer:
+            try:
+                fd, path = tempfile.mkstemp(suffix='.video', prefix='movesense-')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(video)
+                staged['path'] = path
+            finally:
+                staged['ready'].set()
+        else:
+            staged['ready'].wait()
+        if staged['path'] is None:
+            raise RuntimeError('The upload could not be staged for analysis')
+        return staged['path']
+
+    def _release(self, job):
+        # Called with the lock held; removes the staged upload once no job uses it
+        video_key = self._job_videos.pop(job.id, None)
+        if video_key is None:
+            return
+        staged = self._staged[video_key]
+        staged['jobs'] -= 1
+        if staged['jobs'] > 0:
+            return
+        del self._staged[video_key]
+        if staged['path'] is not None:
+            try:
+                os.remove(staged['path'])
+            except OSError:
+                pass
+
+    def _next(self):
+        # Next job from the session with the fewest running jobs, and among those
+        # the one served longest ago; cancelled jobs are dropped on the way
+        while self._queues:
+            running = collections.Counter(job.session for job in self._running.values())
+            session_id = min(self._queues, key=lambda session_id: (running[session_id], self._served.get(session_id, 0.0)))
+            queue = self._queues[session_id]
+            job, submission = queue.popleft()
+            if not queue:
+                del self._queues[session_id]
+            if job.cancelled:
+                self._finish(job, 'cancelled')
+                continue
+            return job, submission
+        return None
+
+    def _replace_executor(self, executor):
+        # A worker that died (a crash in MediaPipe, the OOM killer) breaks its whole
+        # pool for good; start a new one unless that already happened. Lock held.
+        if self._executor is executor and not self._closed.is_set():
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context)
+
+    def _submit(self, function, *args):
+        # (executor, future) of function on the worker pool, on a new pool if the current one is broken
+        with self._lock:
+            executor = self._executor
+            try:
+                return executor, executor.submit(function, *args)
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                return self._executor, self._executor.submit(function, *args)
+
+    def _dispatch(self):
+        with self._lock:
+            while len(self._running) < self.workers:
+                picked = self._next()
+                if picked is None:
+                    return
+                job, (path, video_key, settings, render, profiler) = picked
+                try:
+                    executor, future = self._submit(_analyze, job.id, path, self.result_cache.directory, self.result_cache.max_bytes,
+                                                    video_key, settings, self.segment_workers, render, profiler, self._events, self._cancelled)
+                except Exception as error:
+                    # Shutting down, or a new pool that could not start
+                    job.error = error
+                    self._finish(job, 'failed')
+                    continue
+                job.status = 'running'
+                job.started = time.time()
+                self._queue_waits.append(job.started - job.created)
+                self._running[job.id] = job
+                self._served[job.session] = time.monotonic()
+                # Runs right here if the future is already done, hence the reentrant lock
+                future.add_done_callback(lambda future, job=job, executor=executor: self._completed(job, future, executor))
+
+    def _finish(self, job, status):
+        # Called with the lock held
+        job.status = status
+        job.finished = time.time()
+        self._session_frames[job.session] -= self._frames.pop(job.id)
+        if self._session_frames[job.session] <= 0:
+            del self._session_frames[job.session]
+        self._release(job)
+
+    def _completed(self, job, future, executor):
+        try:
+            data = future.result()
+        except JobCancelled:
+            status = 'cancelled'
+        except BrokenProcessPool:
+            # Every job running in the pool fails with it; the first to get here replaces the pool
+            job.error = RuntimeError('The worker process analyzing this video stopped unexpectedly (it crashed or ran out of memory)')
+            status = 'failed'
+            with self._lock:
+                self._replace_executor(executor)
+        except Exception as error:
+            job.error = error
+            status = 'failed'
+        else:
+            job.result = RunMetrics()
+            job.result.merge(data)
+            job.result.profile = data['profile']
+            status = 'done'
+        with self._lock:
+            if self._running.pop(job.id, None) is None:
+                # Already failed when the Manager was lost
+                status = None
+            with suppress(EOFError, BrokenPipeError, ConnectionError):
+                self._cancelled.pop(job.id, None)
+            if status == 'done':
+                seconds = time.time() - job.started
+                self._processing_times.append(seconds)
+                # Landmarks from the cache say nothing about the cost of a frame
+                if self._frames[job.id] and not job.result.counters['landmark_disk_cache_hits']:
+                    self._seconds_per_frame.append(seconds / self._frames[job.id])
+            if status is not None:
+                self._finish(job, status)
+        if not self._closed.is_set():
+            self._dispatch()
+
+    def _listen(self):
+        # Progress from the workers onto the jobs, and cancellations from the jobs to the workers
+        while not self._closed.is_set():
+            with self._lock:
+                running = list(self._running.values())
+                # Jobs cancelled while waiting leave the queue right away
+                for session_id, queue in list(self._queues.items()):
+                    for job, submission in [(job, submission) for job, submission in queue if job.cancelled]:
+                        queue.remove((job, submission))
+                        self._finish(job, 'cancelled')
+                    if not queue:
+                        del self._queues[session_id]
+            try:
+                for job in running:
+                    if job.cancelled and job.id not in self._cancelled:
+                        self._cancelled[job.id] = True
+                job_id, stage, done, total, partial = self._events.get(timeout=0.2)
+            except Empty:
+                continue
+            except (EOFError, BrokenPipeError, ConnectionError):
+                # Shut down by close(), or the Manager process died
+                if not self._closed.is_set():
+                    self._manager_lost()
+                continue
+            job = self._running.get(job_id)
+            if job is None:
+                continue
+            job.stage = stage
+            job.done = done
+            job.total = total
+            if partial is not None:
+                job.partial = partial
+
+    def warm(self, detectconfidence, trackconfidence):
+        # Start the workers and load a pose model in each, ahead of the first upload.
+        # Returns the futures; their results are the workers' cold start figures
+        return [self._submit(_warm, detectconfidence, trackconfidence)[1] for _ in range(self.workers)]
+
+    def estimated_wait(self, job):
+        # Seconds until a queued job is likely to start
+        if job.status != 'queued':
+            return 0.0
+        return max(0.0, job.estimated_wait - (time.time() - job.created))
+
+    def stats(self):
+        with self._lock:
+            queue_wait = _percentiles(self._queue_waits)
+            processing = _percentiles(self._processing_times)
+            return {'workers': self.workers,
+                    'segment_workers': self.segment_workers,
+                    'running': len(self._running),
+                    'queued': sum(len(queue) for queue in self._queues.values()),
+                    'sessions': len(self._session_frames),
+                    'rejected': self.rejected,
+                    'queue_wait_p50': queue_wait[0],
+                    'queue_wait_p95': queue_wait[1],
+                    'processing_p50': processing[0],
+                    'processing_p95': processing[1],
+                    'seconds_per_frame': self._seconds_per_frame_estimate(),
+                    'estimated_wait': self._estimate_wait()}
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            for queue in self._queues.values():
+                for job, _ in queue:
+                    job.cancel()
+            for job in self._running.values():
+                self._cancelled[job.id] = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._listener.join()
+        self._manager.shutdown()
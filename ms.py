@@ -1,14 +1,26 @@
+import time
+# Start of this script run; on a fresh server process the first run includes the imports
+script_start = time.perf_counter()
+
 import streamlit as st
-import mediapipe as mp
-import cv2
 import pandas as pd
 import numpy as np
-import plotly.express as px
-import tempfile
-import time
-from io import BytesIO
 import os
-import av
+import uuid
+import datetime
+import itertools
+import plotly.colors
+
+from io import BytesIO
+
+from movesense import analytics, core, export, plotting
+from movesense.cache import default_cache, landmarks_key, pose_video_key, result_key, video_hash
+from movesense.live import LiveSession
+from movesense.metrics import NULL_METRICS, profile_run
+from movesense.schema import default_schema
+from movesense.service import AdmissionError, InferenceService
+
+imports_done = time.perf_counter()
 
 
 #######################################
@@ -61,347 +73,318 @@ st.markdown(hide_img_fs, unsafe_allow_html=True)
 #######################################
 #######################################
 
-def hex_to_rgb(hex_string):
-    r_hex = hex_string[1:3]
-    g_hex = hex_string[3:5]
-    b_hex = hex_string[5:7]
-    return int(r_hex, 16), int(g_hex, 16), int(b_hex, 16)
-
+@st.cache_resource
+def get_result_cache():
+    # Shared by every session of this server process; the directory can be shared between processes
+    return default_cache()
 
-def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
-    # initialize the dimensions of the image to be resized and
-    # grab the image size
-    dim = None
-    (h, w) = image.shape[:2]
 
-    # if both the width and height are None, then return the
-    # original image
-    if width is None and height is None:
-        return image
+@st.cache_resource
+def startup_times():
+    # Filled in by the first run of this server process, so it holds the cold start figures
+    return {'imports_seconds': imports_done - script_start}
 
-    # check to see if the width is None
-    if width is None:
-        # calculate the ratio of the height and construct the
-        # dimensions
-        r = height / float(h)
-        dim = (int(w * r), height)
 
-    # otherwise, the height is None
-    else:
-        # calculate the ratio of the width and construct the
-        # dimensions
-        r = width / float(w)
-        dim = (width, int(h * r))
-
-    # resize the image
-    resized = cv2.resize(image, dim, interpolation = inter)
-
-    # return the resized image
-    return resized
+@st.cache_resource
+def warm_pose_model(detectconfidence, trackconfidence):
+    # Load a pose model for these confidences in the inference workers while the page
+    # renders, so the first analysis checks out a warm one; once per confidence pair
+    return get_inference_service().warm(detectconfidence, trackconfidence)
 
 
-@st.cache_data(show_spinner="Analyzing video frames...")
-def extract_pose_keypoints(video_path, fps, detectconfidence, trackconfidence, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize):
-    tfile = tempfile.NamedTemporaryFile(delete=False)
-    tfile.write(video_path.read())
-    cap = cv2.VideoCapture(tfile.name)
-    os.remove(tfile.name)
-
-    # Define mediapipe pose detection module
-    mp_pose = mp.solutions.pose
-    mp_drawing = mp.solutions.drawing_utils
+def environ_number(name, default = None, kind = int):
+    value = os.environ.get(name)
+    return default if value in (None, '') else kind(value)
 
-    # Initialize the pose detection module
-    with mp_pose.Pose(min_detection_confidence=detectconfidence, min_tracking_confidence=trackconfidence) as pose:
-        wdt = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        ht = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-        # Create a dataframe to store the pose keypoints
-        df_pose = pd.DataFrame()
+def live_sources():
+    # What the live tab may open: camera indices MOVESENSE_LIVE_CAMERAS (default 0-3)
+    # plus stream URLs or server files the operator lists, comma separated, in
+    # MOVESENSE_LIVE_SOURCES. Visitors only pick from these, so they cannot make
+    # the server open other files or reach other hosts.
+    cameras = [str(i) for i in range(environ_number('MOVESENSE_LIVE_CAMERAS', 4))]
+    allowed = [source.strip() for source in os.environ.get('MOVESENSE_LIVE_SOURCES', '').split(',') if source.strip()]
+    return cameras + allowed
 
-        frame_rate = cap.get(cv2.CAP_PROP_FPS)  # Get the frame rate of the video
-        capture_interval = int(frame_rate / fps)  # Capture a frame every second
-        frame_count = 0
-        image_list = []
 
-        while True:
-            # Read a frame from the video
-            ret, frame = cap.read()
-
-            # Break the loop if we have reached the end of the video
-            if not ret:
-                break
-
-            frame_count += 1
-
-            # Check if the frame count matches the capture interval
-            if frame_count % capture_interval != 0:
-                continue
+@st.cache_resource
+def get_inference_service():
+    # Worker processes shared by every session of this server process. Set with
+    # MOVESENSE_JOB_WORKERS (videos analyzed at the same time), MOVESENSE_MAX_QUEUED
+    # (waiting videos before uploads are turned away), MOVESENSE_SESSION_FRAMES
+    # (frames one session may have queued or running), MOVESENSE_MAX_VIDEO_SECONDS
+    # and MOVESENSE_SEGMENT_WORKERS (processes that analyze segments of one video)
+    return InferenceService(get_result_cache(),
+                            workers = environ_number('MOVESENSE_JOB_WORKERS', 1),
+                            segment_workers = environ_number('MOVESENSE_SEGMENT_WORKERS', 1),
+                            max_queued = environ_number('MOVESENSE_MAX_QUEUED', 16),
+                            max_session_frames = environ_number('MOVESENSE_SESSION_FRAMES'),
+                            max_video_seconds = environ_number('MOVESENSE_MAX_VIDEO_SECONDS', kind = float))
 
-            # Convert the frame to RGB and resize if needed
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            # frame = cv2.resize(frame, (fx, fy))  # Adjust the size as needed
-
-            # Process the frame to extract the pose keypoints
-            results = pose.process(frame)
-
-            # Extract the pose landmarks from the results
-            landmarks = results.pose_landmarks
-
-            # If landmarks are detected, draw them on the frame
-            if landmarks is not None:
-
-                # Draw the landmarks on the frame
-                mp_drawing.draw_landmarks(frame, landmarks, mp_pose.POSE_CONNECTIONS,
-                                          landmark_drawing_spec=mp_drawing.DrawingSpec(color=(128, 128, 128),
-                                                                                        circle_radius=0),
-                                          connection_drawing_spec=mp_drawing.DrawingSpec(color=(255, 255, 255),
-                                                                                          thickness=linesize))
-
-                # Add joint markers and lines
-                joint_indices = {'Left Shoulder': 11, 'Left Elbow': 13, 'Left Wrist': 15,
-                                 'Right Shoulder': 12, 'Right Elbow': 14, 'Right Wrist': 16,
-                                 'Right Index': 20, 'Left Index': 19,
-                                 'Left Hip': 23, 'Left Knee': 25, 'Left Ankle': 27,
-                                 'Right Hip': 24, 'Right Knee': 26, 'Right Ankle': 28,
-                                 'Right Foot Index': 32, 'Left Foot Index': 31}
-
-                for joint, idx in joint_indices.items():
-                    x, y = int(landmarks.landmark[idx].x * frame.shape[1]), int(landmarks.landmark[idx].y * frame.shape[0])
-
-                    # Assign colors to joint markers
-                    if 'Left Shoulder' in joint:
-                        color = hex_to_rgb(color_discrete_map['Left Shoulder']) # Red
-                    elif 'Left Elbow' in joint:
-                        color = hex_to_rgb(color_discrete_map['Left Elbow'])  # Orange
-                    elif 'Left Wrist' in joint:
-                        color = hex_to_rgb(color_discrete_map['Left Wrist'])  # White
-                    if 'Right Shoulder' in joint:
-                        color = hex_to_rgb(color_discrete_map['Right Shoulder'])  # Red
-                    elif 'Right Elbow' in joint:
-                        color = hex_to_rgb(color_discrete_map['Right Elbow'])
-                    elif 'Right Wrist' in joint:
-                        color = hex_to_rgb(color_discrete_map['Right Wrist'])
-                    elif 'Left Hip' in joint:
-                        color = hex_to_rgb(color_discrete_map['Left Hip'])
-                    elif 'Left Knee' in joint:
-                        color = hex_to_rgb(color_discrete_map['Left Knee'])
-                    elif 'Left Ankle' in joint:
-                        color = hex_to_rgb(color_discrete_map['Left Ankle'])
-                    elif 'Right Hip' in joint:
-                        color = hex_to_rgb(color_discrete_map['Right Hip'])
-                    elif 'Right Knee' in joint:
-                        color = hex_to_rgb(color_discrete_map['Right Knee'])
-                    elif 'Right Ankle' in joint:
-                        color = hex_to_rgb(color_discrete_map['Right Ankle'])
-
-                    # Draw joint markers
-                    cv2.circle(frame, (x, y), markersize, color, -1)
-                    def calculate_angle(landmarks, joint1, joint2, joint3):
-                        # Get the landmarks for the specified joints
-                        landmark1 = landmarks.landmark[joint_indices[joint1]]
-                        landmark2 = landmarks.landmark[joint_indices[joint2]]
-                        landmark3 = landmarks.landmark[joint_indices[joint3]]
-
-                        # Calculate the vectors between the landmarks
-                        vector1 = np.array([landmark1.x, landmark1.y])
-                        vector2 = np.array([landmark2.x, landmark2.y])
-                        vector3 = np.array([landmark3.x, landmark3.y])
-
-                        # Calculate the vectors between joints
-                        v1 = vector1 - vector2
-                        v2 = vector3 - vector2
-
-                        # Calculate the angle using dot product and magnitudes
-                        angle = np.arccos(np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2)))
-
-                        return np.degrees(angle)
-
-                    # Calculate and display joint angles
-                    if joint == 'Left Shoulder':
-                        angle = calculate_angle(landmarks, 'Left Elbow', 'Left Shoulder', 'Left Hip')
-                    elif joint == 'Left Elbow':
-                        angle = calculate_angle(landmarks, 'Left Shoulder', 'Left Elbow', 'Left Wrist')
-                    elif joint == 'Left Wrist':
-                        angle = calculate_angle(landmarks, 'Left Elbow', 'Left Wrist', 'Left Index')
-                    elif joint == 'Right Shoulder':
-                        angle = calculate_angle(landmarks, 'Right Elbow', 'Right Shoulder', 'Right Hip')
-                    elif joint == 'Right Elbow':
-                        angle = calculate_angle(landmarks, 'Right Shoulder', 'Right Elbow', 'Right Wrist')
-                    elif joint == 'Right Wrist':
-                        angle = calculate_angle(landmarks, 'Right Elbow', 'Right Wrist', 'Right Index')
-                    elif joint == 'Left Hip':
-                        angle = calculate_angle(landmarks, 'Left Knee', 'Left Hip', 'Left Shoulder')
-                    elif joint == 'Left Knee':
-                        angle = calculate_angle(landmarks, 'Left Hip', 'Left Knee', 'Left Ankle')
-                    elif joint == 'Left Ankle':
-                        angle = calculate_angle(landmarks, 'Left Knee', 'Left Ankle', 'Left Foot Index')
-                    elif joint == 'Right Hip':
-                        angle = calculate_angle(landmarks, 'Right Knee', 'Right Hip', 'Right Shoulder')
-                    elif joint == 'Right Knee':
-                        angle = calculate_angle(landmarks, 'Right Hip', 'Right Knee', 'Right Ankle')
-                    elif joint == 'Right Ankle':
-                        angle = calculate_angle(landmarks, 'Right Knee', 'Right Ankle', 'Right Foot Index')
-                    elif joint == 'Right Foot Index':
-                        angle = ''
-                    elif joint == 'Left Foot Index':
-                        angle = ''
-                    elif joint == 'Right Index':
-                        angle = ''
-                    elif joint == 'Left Index':
-                        angle = ''
-                    try:
-                        if angletextcolor == 'Grey':
-                            cv2.putText(frame, f'{angle:.2f}', (x + 10, y + 10), cv2.FONT_HERSHEY_SIMPLEX, textscale, (128, 128, 128), textsize)
-                        if angletextcolor == 'White':
-                            cv2.putText(frame, f'{angle:.2f}', (x + 10, y + 10), cv2.FONT_HERSHEY_SIMPLEX, textscale, (255, 255, 255), textsize)
-                        if angletextcolor == 'Black':
-                            cv2.putText(frame, f'{angle:.2f}', (x + 10, y + 10), cv2.FONT_HERSHEY_SIMPLEX, textscale, (0, 0, 0), textsize)
-                    except:
-                        continue
-
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-            # Append the frame to the image list
-            frame = image_resize(frame, height=400)
-            image_list.append(frame)
-
-            # Create a dictionary to store the pose landmarks
-            landmarks_dict = {}
-
-            # If landmarks are detected, store them in the dictionary
-            if landmarks is not None:
-                for idx, landmark in enumerate(landmarks.landmark):
-                    landmarks_dict[f'landmark_{idx}'] = [landmark.x, landmark.y, landmark.z, landmark.visibility]
-
-            # Add the landmarks to the dataframe
-            df_pose = df_pose.append(landmarks_dict, ignore_index=True)
-
-
-        # Convert the dataframe to seconds
-        df_pose['Frame'] = df_pose.index / fps
-        diff = df_pose['Frame'].iloc[1] - df_pose['Frame'].iloc[0]
-        data_points = len(df_pose)
-        time_interval = pd.Timedelta(seconds=diff)
-
-        df_pose['time'] = pd.date_range(start='00:00:00', periods=data_points, freq=time_interval)
-        df_pose = df_pose.set_index('time')
-        video_data = create_video(frames = image_list, height = ht, width = wdt, fps = fps)
-        
-
-    return df_pose, video_data
-
-def create_video(frames, height, width, fps):
-  
-  output_memory_file = BytesIO()  # Create BytesIO "in memory file".
-  
-  output = av.open(output_memory_file, 'w', format="mp4")  # Open "in memory file" as MP4 video output
-  stream = output.add_stream('h264', str(fps))  # Add H.264 video stream to the MP4 container, with framerate = fps.
-  stream.width = width  # Set frame width
-  stream.height = height  # Set frame height
-  #stream.pix_fmt = 'yuv444p'   # Select yuv444p pixel format (better quality than default yuv420p).
-  stream.pix_fmt = 'yuv420p'   # Select yuv420p pixel format for wider compatibility.
-  stream.options = {'crf': '17'}  # Select low crf for high quality (the price is larger file size).
-  # Iterate the created images, encode and write to MP4 memory file.
-  for i in range(len(frames)):
-      img = frames[i]  # Create OpenCV image for testing (resolution 192x108, pixel format BGR).
-      frame = av.VideoFrame.from_ndarray(img, format='bgr24')  # Convert image from NumPy Array to frame.
-      packet = stream.encode(frame)  # Encode video frame
-      output.mux(packet)  # "Mux" the encoded frame (add the encoded frame to MP4 file).
-  
-  # Flush the encoder
-  packet = stream.encode(None)
-  output.mux(packet)
-  output.close()
-  
-  output_memory_file.seek(0)  # Seek to the beginning of the BytesIO.
-  return output_memory_file
 
+@st.cache_data(show_spinner="Analyzing video frames...")
+def extract_pose_landmarks(video_key, _video, fps, detectconfidence, trackconfidence, sampling = 'grab', workers = 1, _metrics = NULL_METRICS, inference_height = None, roi = False, keyframe_interval = 1, optical_flow = False):
+    # Only the video content and inference settings are part of the cache key,
+    # so changing overlay styling never runs pose estimation again.
+    # _video is the upload buffer itself and is not hashed; video_key (its content hash) stands in for it.
+    # Results also persist on disk across restarts and re-uploads of the same clip
+    result_cache = get_result_cache()
+    key = landmarks_key(video_key, fps, detectconfidence, trackconfidence, sampling, inference_height, roi, keyframe_interval, optical_flow)
+    store = result_cache.get_landmarks(key)
+    if store is None:
+        store = core.extract_pose_landmarks(_video, fps, detectconfidence, trackconfidence, sampling, workers, metrics = _metrics,
+                                            inference_height = inference_height, roi = roi,
+                                            keyframe_interval = keyframe_interval, optical_flow = optical_flow)
+        result_cache.put_landmarks(key, store)
+    else:
+        _metrics.count('landmark_disk_cache_hits')
+    return store
+
+
+@st.cache_data(show_spinner="Rendering video...")
+def render_pose_video(video_key, _video, store, fps, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling = 'grab', profile = core.DEFAULT_ENCODER_PROFILE, _metrics = NULL_METRICS):
+    # Redraw the overlay from cached landmarks; decoding and encoding are cheap next to pose inference
+    result_cache = get_result_cache()
+    key = pose_video_key(video_key, store, fps, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling, profile)
+    video_data = result_cache.get_video(key) if result_cache.has_frames(key) else None
+    if video_data is not None:
+        _metrics.count('video_disk_cache_hits')
+        return BytesIO(video_data)
+    # The annotated frames are kept as well, for scrubbing
+    with result_cache.frames_writer(key) as frame_store:
+        video_data = core.stream_pose_video(_video, store, fps, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling, profile = profile, metrics = _metrics,
+                                            frame_store = frame_store)
+    result_cache.put_video(key, video_data)
+    return video_data
+
+
+@st.cache_resource
+def get_library():
+    # Saved analyses of every session, on disk; see MOVESENSE_LIBRARY_DIR
+    return analytics.default_store()
+
+
+def save_to_library(store, df_kinematics, df_summary, name):
+    # Name, subject and date of an analysis, saved to the library for later comparison
+    with st.expander("Save to Library"):
+        with st.form("save_session"):
+            l, m, r = st.columns(3)
+            session_name = l.text_input("Name", value = os.path.splitext(name)[0])
+            subject = m.text_input("Subject", help = 'Athlete or patient, to compare one person across sessions.')
+            recorded = r.date_input("Recorded", value = datetime.date.today())
+            notes = st.text_input("Notes")
+            if analytics.series_format() != 'parquet':
+                st.caption("pyarrow is not installed on this server, so the series are saved as compressed npz instead of Parquet.")
+            if st.form_submit_button("Save", use_container_width = True):
+                session_id = get_library().add_session(store, df_kinematics, df_summary, name = session_name, subject = subject or None,
+                                                       recorded = datetime.datetime.combine(recorded, datetime.time()), notes = notes or None)
+                st.success(f"Saved as {session_id}")
+
+
+def show_library():
+    # Filter saved sessions on their summary index and compare a joint across the chosen ones
+    library_store = get_library()
+    sessions = library_store.sessions()
+    if sessions.empty:
+        st.info("Analyses saved with Save to Library in the Velocity tab appear here.", icon = '\U0001f4da')
+        return
+    l, r = st.columns(2)
+    joint = l.selectbox("Joint", default_schema().joints, key = 'library_joint')
+    quantity = r.selectbox("Quantity", core.KINEMATIC_QUANTITIES, key = 'library_quantity')
+    query = st.text_input("Filter", placeholder = "right_knee_angle_range < 90 and subject == 'A'",
+                          help = 'A condition on the summary columns: name, subject, recorded, duration, frames, detected and, for every joint, '
+                                 'angle min, max, mean and range and speed mean and max, e.g. left_hip_angle_max or right_elbow_speed_mean.')
+    try:
+        sessions = library_store.sessions(query or None)
+    except Exception as error:
+        st.error(f"Invalid filter: {error}")
+    summary_columns = [analytics.index_column(joint, quantity_name, statistic)
+                       for quantity_name, statistics in analytics.INDEX_STATISTICS.items() for statistic in statistics]
+    st.dataframe(sessions.reindex(columns = ['name', 'subject', 'recorded', 'duration', 'frames'] + summary_columns), use_container_width = True)
+    labels = {session_id: f"{row['name'] or session_id} ({row['recorded']:%Y-%m-%d})" for session_id, row in sessions.iterrows()}
+    compare = st.multiselect("Compare Sessions", list(sessions.index), default = list(sessions.index[-3:]), format_func = labels.get)
+    if compare:
+        df_compare = library_store.series(compare, joint, quantity).rename(columns = labels)
+        colors = dict(zip(df_compare.columns, itertools.cycle(plotly.colors.qualitative.Plotly)))
+        compare_plot = plotting.series_figure(df_compare, list(df_compare.columns), colors, 450)
+        compare_plot.update_layout(showlegend = True)
+        compare_plot.update_xaxes(title = 'Seconds')
+        compare_plot.update_yaxes(title = f"{joint} {quantity}")
+        st.plotly_chart(compare_plot, use_container_width = True, config = {'displaylogo': False})
+
+
+@st.cache_resource(max_entries = 8)
+def get_frame_store(key):
+    # Memory-mapped annotated frames of a rendered video; None if they were evicted
+    return get_result_cache().get_frames(key)
+
+
+def extract_pose_keypoints(video_path, fps, detectconfidence, trackconfidence, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling = 'grab', workers = 1, profile = core.DEFAULT_ENCODER_PROFILE, metrics = NULL_METRICS, profiler = None, inference_height = None, roi = False, keyframe_interval = 1, optical_flow = False, video_key = None):
+    # Decode straight from the upload's own buffer; no copy in memory or on disk.
+    # Stage timings and counters of this run go to metrics; profiler is None, 'sampling' or 'cprofile'
+    with profile_run(metrics, profiler):
+        video = video_path.getbuffer()
+        if video_key is None:
+            with metrics.time('hash'):
+                video_key = video_hash(video)
+        store = extract_pose_landmarks(video_key, video, fps, detectconfidence, trackconfidence, sampling, workers, metrics, inference_height, roi, keyframe_interval, optical_flow)
+        video_data = render_pose_video(video_key, video, store, fps, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling, profile, metrics)
+    return store, video_data
+
+
+def upload_hash(video_file):
+    # Content hash of an upload, worked out once per upload instead of on every rerun
+    hashes = st.session_state.setdefault('upload_hashes', {})
+    upload_id = getattr(video_file, 'file_id', None) or (video_file.name, video_file.size)
+    if upload_id not in hashes:
+        hashes[upload_id] = video_hash(video_file.getbuffer())
+    return hashes[upload_id]
+
+
+def submit_analysis(video_file):
+    # Background job for an upload with the current settings, submitted once per upload and settings.
+    # Returns (job, None), (None, AdmissionError) when the service turned the upload away, or
+    # (None, None) when the landmarks are cached and only the overlay is drawn, in this process
+    video_key = upload_hash(video_file)
+    settings = dict(fps = fps, detectconfidence = detectconfidence, trackconfidence = trackconfidence, sampling = sampling,
+                    inference_height = inference_height, roi = roi, keyframe_interval = keyframe_interval, optical_flow = optical_flow)
+    render = dict(fps = fps, color_discrete_map = color_discrete_map, textscale = textscale, textsize = textsize, angletextcolor = angletextcolor,
+                  linesize = linesize, markersize = markersize, sampling = sampling, profile = profile)
+    job_key = result_key(landmarks_key(video_key, **settings), **render)
+    session_jobs = st.session_state.setdefault('jobs', {})
+    job = session_jobs.get(job_key)
+    if job is None and get_result_cache().has_landmarks(landmarks_key(video_key, **settings)):
+        # A restyle: drawing straight from the upload's buffer beats staging it for a worker
+        return None, None
+    if job is None:
+        try:
+            job = get_inference_service().submit(st.session_state.setdefault('session_id', uuid.uuid4().hex), video_file.getbuffer(), video_key,
+                                                 settings, render, profiler if diagnostics else None, name = video_file.name)
+        except AdmissionError as error:
+            return None, error
+        session_jobs[job_key] = job
+    return job, None
+
+
+def forget_job(job_id):
+    # Drop a finished job from the session so the upload is submitted again
+    session_jobs = st.session_state.get('jobs', {})
+    for job_key in [job_key for job_key, job in session_jobs.items() if job.id == job_id]:
+        del session_jobs[job_key]
+
+
+def show_rejection(name, error):
+    # Why the service did not take an upload; the button just reruns, which submits it again
+    l, r = st.columns([5, 1])
+    wait = f" Try again in about {error.estimated_wait:.0f} s." if error.estimated_wait is not None else ""
+    l.warning(f"{name}: {error}.{wait}")
+    if error.estimated_wait is not None:
+        r.button("Try Again", key = f'retry-{name}')
+
+
+def show_job(job):
+    # Progress bar with a cancel button while a job is queued or running; errors and cancellations after
+    if job.status == 'queued':
+        l, r = st.columns([5, 1])
+        l.progress(0.0, text = f"{job.name}: waiting for other videos, about {get_inference_service().estimated_wait(job):.0f} s")
+        r.button("Cancel", key = f'cancel-{job.id}', on_click = job.cancel)
+    elif job.status == 'running':
+        l, r = st.columns([5, 1])
+        total = job.total or '?'
+        l.progress(job.progress() or 0.0, text = f"{job.name}: {job.stage} frame {job.done} of {total}")
+        r.button("Cancel", key = f'cancel-{job.id}', on_click = job.cancel)
+    elif job.status in ('failed', 'cancelled'):
+        l, r = st.columns([5, 1])
+        if job.status == 'failed':
+            l.error(f"{job.name}: analysis failed ({job.error})")
+        else:
+            l.warning(f"{job.name}: analysis cancelled")
+        r.button("Restart", key = f'restart-{job.id}', on_click = forget_job, args = (job.id,))
+
+
+def show_diagnostics(metrics):
+    # Stage timings, counters and profile of the last run, with JSON and Prometheus downloads
+    data = metrics.to_dict()
+    if not data['stages']:
+        st.caption("Nothing was processed on this run; all results came from the cache.")
+    else:
+        stages = pd.DataFrame(data['stages']).T
+        stages['share'] = (stages['seconds'] / stages['seconds'].sum()).map('{:.1%}'.format)
+        st.dataframe(stages, use_container_width = True)
+    st.dataframe(pd.Series(data['counters'], name = 'count', dtype = 'int64'), use_container_width = True)
+    l, r = st.columns(2)
+    l.download_button("Download JSON", metrics.to_json(), file_name = 'movesense_metrics.json', mime = 'application/json')
+    r.download_button("Download Prometheus", metrics.to_prometheus(), file_name = 'movesense_metrics.prom', mime = 'text/plain')
+    if data['profile']:
+        st.code(data['profile'], language = None)
 
-@st.cache_data()
-def calculate_joint_angles(df_pose):
-    # Define the joint angle calculation function
-    def get_joint_angle(p1, p2, p3):
-        v1 = np.array([p1[0] - p2[0], p1[1] - p2[1]])
-        v2 = np.array([p3[0] - p2[0], p3[1] - p2[1]])
-        cosine_angle = np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-        angle = np.arccos(cosine_angle) 
-        return np.degrees(angle)
-    # Define the joint indices
-    joint_indices = {
-        'Left Shoulder': (23, 11, 13),
-        'Right Shoulder': (24, 12, 14),
-        'Left Elbow': (11, 13, 15),
-        'Right Elbow': (12, 14, 16),
-        'Left Wrist': (19, 15, 13),
-        'Right Wrist': (20, 16, 14),
-        'Left Hip': (24, 23, 25),
-        'Right Hip': (23, 24, 26),
-        'Left Knee': (23, 25, 27),
-        'Right Knee': (24, 26, 28),
-        'Left Ankle': (31, 27, 25),
-        'Right Ankle': (32, 28, 26)
-    }
-    # Create a dataframe to store the joint angles
-    df_joint_angles = pd.DataFrame(columns=list(joint_indices.keys()))
-    # Loop through each second of the video
-    for i in range(len(df_pose)):
-        # Get the pose landmarks for the current second
-        pose_landmarks = df_pose.iloc[i, :].values
-        # Calculate the joint angles
-        joint_angles = {}
-        for joint, indices in joint_indices.items():
-            try:
-                p1, p2, p3 = pose_landmarks[indices[0]][:3], pose_landmarks[indices[1]][:3], pose_landmarks[indices[2]][:3]
-                angle = get_joint_angle(p1, p2, p3)
-                joint_angles[joint] = angle
-            except:
-                joint_angles[joint] = np.nan
-        # Add the joint angles to the dataframe
-        df_joint_angles.loc[df_pose.index[i]] = joint_angles
-    return df_joint_angles
 
 @st.cache_data()
-def calculate_joint_angle_velocities(df_joint_angles):
-    # Calculate the joint angle velocities
-    df_joint_angle_velocities = df_joint_angles.diff().dropna()
-    df_joint_angle_velocities.index = pd.to_datetime(df_joint_angle_velocities.index).time
-
-    return df_joint_angle_velocities
-
-
-def create_joint_line_plot(df_joint_angles, jnt, slide, color_discrete_map, height = 200):
-    joint_line_plot = px.line(df_joint_angles, 
-                              y = jnt, 
-                              color_discrete_map=color_discrete_map) 
-    joint_line_plot.update_layout(height = height, 
-                                  hovermode="x",
-                                  showlegend = False)
+def calculate_kinematics(store, use_3d = False):
+    # Smoothed angles, angular velocity, speed and acceleration plus the per-joint
+    # summary statistics, computed once per result; every tab reads from these
+    df_joint_angles = core.smooth_joint_angles(core.calculate_joint_angles(store, use_3d = use_3d))
+    df_kinematics = core.compute_kinematics(df_joint_angles)
+    return df_kinematics, core.summarize_kinematics(df_kinematics)
+
+
+EXPORT_LABELS = {'parquet': 'Parquet', 'arrow': 'Arrow IPC', 'hdf5': 'HDF5', 'npz': 'NumPy (npz)', 'csv': 'CSV'}
+
+
+@st.cache_data(max_entries = 16, show_spinner = "Preparing export...")
+def export_result(export_key, export_format, _store, _df_kinematics, _df_summary):
+    # Export files are only built when asked for and are kept in the result cache,
+    # so every result is written at most once per format
+    result_cache = get_result_cache()
+    extension = export.EXPORT_FORMATS[export_format][0]
+    data = result_cache.get_export(export_key, extension)
+    if data is None:
+        data = export.export_session(_store, _df_kinematics, _df_summary, export_format)
+        result_cache.put_export(export_key, extension, data)
+    return data
+
+
+def show_export(store, df_kinematics, df_summary, use_3d, name):
+    # Format picker plus a button that prepares the file; the download appears once it is ready
+    l, r = st.columns(2)
+    export_format = l.selectbox("Export Format", export.available_formats(), format_func = EXPORT_LABELS.get,
+                                help = 'Raw landmarks (x, y, z and visibility of all 33 points), joint angles, velocities, speeds and accelerations with their timestamps. Parquet and Arrow are compressed columnar tables that also carry the summary statistics; HDF5 and npz hold the same data as arrays.')
+    missing = export.missing_formats()
+    if missing:
+        l.caption(f"Not available on this server: {', '.join(EXPORT_LABELS[export_format] for export_format in missing)} "
+                  f"(needs {', '.join(sorted(set(missing.values())))}).")
+    export_key = result_key(video_hash(store.landmarks), use_3d = use_3d, export_format = export_format, schema = default_schema().digest)
+    requested = st.session_state.setdefault('exports', set())
+    if export_key not in requested and r.button("Prepare Export", use_container_width = True):
+        requested.add(export_key)
+    if export_key in requested:
+        extension, mime = export.EXPORT_FORMATS[export_format]
+        r.download_button(f"Download {EXPORT_LABELS[export_format]}", export_result(export_key, export_format, store, df_kinematics, df_summary),
+                          file_name = f"{os.path.splitext(name)[0]}_session{extension}", mime = mime, use_container_width = True)
+
+
+# Charts are cached on data_key, a hash of the angles, plus their style, so
+# changing the joint selection or colors only rebuilds the charts that changed.
+# Series are downsampled to screen resolution and large ones drawn with WebGL.
+@st.cache_data(max_entries = 256)
+def create_joint_line_plot(data_key, _df_joint_angles, jnt, interactive, color_discrete_map, height = 200):
+    joint_line_plot = plotting.series_figure(_df_joint_angles, jnt, color_discrete_map, height, static = not interactive)
     joint_line_plot.update_xaxes(tickformat="%H:%M:%S", 
                                  title = 'Seconds (HH:MM:SS)')
     joint_line_plot.update_yaxes(range=[0,190], 
                                  title = 'Angle (degrees)')
-    if slide is not None:
-        joint_line_plot.add_vline(x = df_joint_angles['time'].iloc[slide], line_color = 'grey')
-    if slide == None:
-        color = color_discrete_map[jnt]
-        joint_line_plot.update_traces(line_color = color)
     return joint_line_plot
-def create_joint_velocity_plot(df_joint_angles, jnt, fps, slide, color_discrete_map, height = 200):
-    df_joint_angles['time'] = df_joint_angles.index
-    joint_velocity_plot = px.area(df_joint_angles.diff(fps).abs(), 
-                                  y = jnt, 
-                                  color_discrete_map=color_discrete_map)
-    joint_velocity_plot.update_layout(height = height, hovermode="x", showlegend = False)
+@st.cache_data(max_entries = 256)
+def create_joint_velocity_plot(data_key, _df_joint_speeds, jnt, interactive, color_discrete_map, height = 200):
+    joint_velocity_plot = plotting.series_figure(_df_joint_speeds, jnt, color_discrete_map, height,
+                                                 area = True, static = not interactive)
     joint_velocity_plot.update_xaxes(tickformat="%H:%M:%S", title = 'Seconds (HH:MM:SS)')
     joint_velocity_plot.update_yaxes(title = 'Velocity (degrees/second)')
-    #joint_velocity_plot.add_vline(x = df_joint_angles['time'].iloc[slide], line_color = 'grey')
-    if slide == None:
-      joint_velocity_plot.update_traces(line_color = color_discrete_map[jnt])
     return joint_velocity_plot
 
 def update_info():
-  st.session_state.df_pose, st.session_state.key_arr = extract_pose_keypoints(video_file, fps, detectconfidence, trackconfidence, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize)
+  # Queue the analysis instead of running it in the script thread
+  submit_analysis(video_file)
 
 #######################################
 ######################################
@@ -423,64 +406,34 @@ l.markdown(
   """
 [![forthebadge](data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHdpZHRoPSI2My4xNCIgaGVpZ2h0PSIzNSIgdmlld0JveD0iMCAwIDYzLjE0IDM1Ij48cmVjdCBjbGFzcz0ic3ZnX19yZWN0IiB4PSIwIiB5PSIwIiB3aWR0aD0iNjMuMTQiIGhlaWdodD0iMzUiIGZpbGw9IiM1ODVFNjAiLz48cmVjdCBjbGFzcz0ic3ZnX19yZWN0IiB4PSI2My4xNCIgeT0iMCIgd2lkdGg9IjAiIGhlaWdodD0iMzUiIGZpbGw9IiMzODlBRDUiLz48cGF0aCBjbGFzcz0ic3ZnX190ZXh0IiBkPSJNMTUuNzAgMjJMMTQuMjIgMjJMMTQuMjIgMTMuNDdMMTUuNzAgMTMuNDdMMTUuNzAgMTcuMDJMMTkuNTEgMTcuMDJMMTkuNTEgMTMuNDdMMjAuOTkgMTMuNDdMMjAuOTkgMjJMMTkuNTEgMjJMMTkuNTEgMTguMjFMMTUuNzAgMTguMjFMMTUuNzAgMjJaTTMxLjMxIDIyTDI1LjczIDIyTDI1LjczIDEzLjQ3TDMxLjI3IDEzLjQ3TDMxLjI3IDE0LjY2TDI3LjIxIDE0LjY2TDI3LjIxIDE3LjAyTDMwLjcyIDE3LjAyTDMwLjcyIDE4LjE5TDI3LjIxIDE4LjE5TDI3LjIxIDIwLjgyTDMxLjMxIDIwLjgyTDMxLjMxIDIyWk00MC44NiAyMkwzNS41MCAyMkwzNS41MCAxMy40N0wzNi45OSAxMy40N0wzNi45OSAyMC44Mkw0MC44NiAyMC44Mkw0MC44NiAyMlpNNDYuNDcgMjJMNDQuOTggMjJMNDQuOTggMTMuNDdMNDguMjUgMTMuNDdRNDkuNjggMTMuNDcgNTAuNTIgMTQuMjFRNTEuMzYgMTQuOTYgNTEuMzYgMTYuMThMNTEuMzYgMTYuMThRNTEuMzYgMTcuNDQgNTAuNTQgMTguMTNRNDkuNzEgMTguODMgNDguMjMgMTguODNMNDguMjMgMTguODNMNDYuNDcgMTguODNMNDYuNDcgMjJaTTQ2LjQ3IDE0LjY2TDQ2LjQ3IDE3LjY0TDQ4LjI1IDE3LjY0UTQ5LjA0IDE3LjY0IDQ5LjQ2IDE3LjI3UTQ5Ljg3IDE2LjkwIDQ5Ljg3IDE2LjE5TDQ5Ljg3IDE2LjE5UTQ5Ljg3IDE1LjUwIDQ5LjQ1IDE1LjA5UTQ5LjAzIDE0LjY4IDQ4LjI5IDE0LjY2TDQ4LjI5IDE0LjY2TDQ2LjQ3IDE0LjY2WiIgZmlsbD0iI0ZGRkZGRiIvPjxwYXRoIGNsYXNzPSJzdmdfX3RleHQiIGQ9IiIgZmlsbD0iI0ZGRkZGRiIgeD0iNzYuMTQiLz48L3N2Zz4=)](https://github.com/chags1313/MoveSense) 
 """)
-upload, analysis, data = st.tabs(['Pose Estimation', 'Angle', 'Velocity'])
-color_discrete_map={
-'Right Shoulder': '#ff8000',
-'Right Elbow': '#ffb266', 
-'Right Wrist': '#ffe5cc', 
-'Left Shoulder': '#ff0000',
-'Left Elbow': '#ff6666', 
-'Left Wrist': '#ffcccc',
-'Right Hip': '#7f00ff',
-'Right Knee': '#b266ff', 
-'Right Ankle': '#e5ccff',
-'Left Hip': '#0000ff',
-'Left Knee': '#6666ff', 
-'Left Ankle': '#ccccff'
-}
+upload, analysis, data, library, live = st.tabs(['Pose Estimation', 'Angle', 'Velocity', 'Library', 'Live'])
+color_discrete_map = dict(default_schema().colors)
 with upload:
-    video_file = st.file_uploader("Upload a video", 
-                            help = "Upload a video to markerless motion capture data.")
+    video_files = st.file_uploader("Upload a video", 
+                            accept_multiple_files = True,
+                            help = "Upload a video to markerless motion capture data. Several videos are analyzed one after another in the background.")
     with st.expander("Advanced Motion Capture Settings"):
           l, r = st.columns(2)
-          fps = st.number_input("Frames Per Second", value = 3, max_value = 10, min_value = 1, step = 1, help = 'Frames per second (FPS) to be processed. Processing time increases as FPS increases.')
+          fps = st.number_input("Frames Per Second", value = 3, max_value = 60, min_value = 1, step = 1, help = 'Frames per second (FPS) to be processed. Processing time increases as FPS increases; above 10 FPS a keyframe interval keeps it manageable.')
           trackconfidence = l.number_input("Tracking Confidence", value = 0.85, step = 0.1, help = 'The minimum confidence level to be used for tracking joints over time. This is on a scale of 0 to 1. 0 represents low confidence and 1 represents high confidence.')
           detectconfidence = r.number_input("Detection Confidence", value = 0.85, step = 0.1, help = 'The minimum confidence level to be used for detecting joints. This is on a scale of 0 to 1. 0 represents low confidence and 1 represents high confidence.')
+          warm_pose_model(detectconfidence, trackconfidence)
+          sampling = st.selectbox("Frame Sampling", options = ['grab', 'seek'], format_func = lambda mode: {'grab': 'Sequential', 'seek': 'Keyframe Seek'}[mode], help = 'Sequential decodes the video in order and only converts the sampled frames. Keyframe Seek jumps between sampled frames and is faster for long videos at low FPS.')
           l1, r1 = st.columns(2)
-          fx = 640
-          fy = 480
+          inference_height = st.selectbox("Inference Resolution", options = [None, 1080, 720, 480, 360], format_func = lambda height: 'Source' if height is None else f'{height}p', help = 'Frame height given to pose estimation. Frames are scaled down while they are decoded, which makes 4K and 1080p footage much faster to analyze. Smaller people in the frame need a higher resolution.')
+          keyframe_interval = st.number_input("Keyframe Interval", value = 1, min_value = 1, max_value = 10, step = 1, help = 'Run pose estimation on every n-th analyzed frame and interpolate the frames in between. Extra keyframes are added automatically where the movement is fast or joints are hard to see. 1 analyzes every frame.')
+          optical_flow = st.checkbox("Optical Flow Refinement", value = False, disabled = keyframe_interval == 1, help = 'Follow the joints between keyframes with optical flow instead of straight-line interpolation. More accurate for curved movements at a small extra cost.')
+          roi = st.checkbox("Track Region of Interest", value = False, help = 'Run pose estimation on a crop around the pose found in the previous frame instead of the whole frame, falling back to the whole frame when the person is lost. Fastest when the person fills a small part of the frame.')
           l1.write("___")
           r1.write("___")
           l1.write("Left Joint Colors")
           r1.write("Right Joint Colors")
           l1.write("___")
           r1.write("___")
-          colorshldl = l1.color_picker("Left Shoulder", value = color_discrete_map['Left Shoulder'])
-          colorshldr = r1.color_picker("Right Shoulder", value = color_discrete_map['Right Shoulder'])
-          colorelbl = l1.color_picker("Left Elbow", value = color_discrete_map['Left Elbow'])
-          colorelbr = r1.color_picker("Right Elbow", value = color_discrete_map['Right Elbow'])
-          colorwrsl = l1.color_picker("Left Wrist", value = color_discrete_map['Left Wrist'])
-          colorwrsr = r1.color_picker("Right Wrist", value = color_discrete_map['Right Wrist'])
-          colorhipl = l1.color_picker("Left Hip", value = color_discrete_map['Left Hip'])
-          colorhipr = r1.color_picker("Right Hip", value = color_discrete_map['Right Hip'])
-          colorknl = l1.color_picker("Left Knee", value = color_discrete_map['Left Knee'])
-          colorknr = r1.color_picker("Right Knee", value = color_discrete_map['Right Knee'])
-          colorankl = l1.color_picker("Left Ankle", value = color_discrete_map['Left Ankle'])
-          colorankr = r1.color_picker("Right Ankle", value = color_discrete_map['Right Ankle'])
-          color_discrete_map={
-          'Right Shoulder': colorshldr,
-          'Right Elbow': colorelbr, 
-          'Right Wrist': colorwrsr, 
-          'Left Shoulder': colorshldl,
-          'Left Elbow': colorelbl, 
-          'Left Wrist':colorwrsl,
-          'Right Hip': colorhipr,
-          'Right Knee': colorknr, 
-          'Right Ankle': colorankr,
-          'Left Hip': colorhipl,
-          'Left Knee': colorknl, 
-          'Left Ankle': colorankl
-          }
+          # One picker per joint of the schema; left and right joints side by side
+          for i, joint in enumerate(default_schema().joints):
+              column = l1 if joint.startswith('Left') else r1 if joint.startswith('Right') else (l1, r1)[i % 2]
+              color_discrete_map[joint] = column.color_picker(joint, value = color_discrete_map[joint])
           st.write("___")
           st.write("Marker and Text Settings")
           st.write("___")
@@ -488,100 +441,128 @@ with upload:
           linesize = st.number_input("Line Sizes", min_value = 0, max_value = 20, value = 2, help = 'Size of the line in pixels that will be displayed on each joint connection')
           textscale = st.number_input("Angle Text Scale", min_value = 0.0, max_value = 5.0, value = 1.0, step = 0.1, help = 'Scale of text in reference to the depth of the marker coordinates.')
           textsize = st.number_input("Angle Text Thickness", min_value = 0, max_value = 20, value = 2, help = 'Thickness of the text appended to each image representing the angle of each joint in degrees.')
+          profile = st.selectbox("Video Quality", options = core.BROWSER_ENCODER_PROFILES, index = core.BROWSER_ENCODER_PROFILES.index(core.DEFAULT_ENCODER_PROFILE), format_func = str.title, help = 'Resolution and compression of the annotated video. Fast Preview encodes quickest, Archive Quality keeps the source resolution and Small Download gives the smallest file.')
           angletextcolor = st.selectbox("Angle Text Color", options = ['White', 'Grey', 'Black'], help = 'Color of the text appended to show joint angle values.')
           st.write("___")
           st.write("Plot Settings")
           st.write("___")
-          options = color_discrete_map.keys()
+          options = default_schema().joints
           jnt = st.multiselect('Joint', key = 'jnt', options = options, default = options, help = 'Select the joints to view in the plots')
+          angles3d = st.checkbox("3D Joint Angles", value = False, help = 'Include the estimated depth (z) of each landmark when calculating joint angles. By default angles are measured in the image plane.')
+          st.write("___")
+          st.write("Diagnostics")
+          st.write("___")
+          diagnostics = st.checkbox("Show Diagnostics", value = False, help = 'Show where processing time went (decode, pose estimation, drawing, resizing, encoding) and frame counts for each run.')
+          profiler = st.selectbox("Profiler", options = [None, 'sampling', 'cprofile'], format_func = lambda mode: {None: 'Off', 'sampling': 'Sampling (all threads)', 'cprofile': 'cProfile (main thread)'}[mode], disabled = not diagnostics, help = 'Profile each run. The sampling profiler sees the decode and drawing threads too; cProfile is exact but only sees the main thread.')
 
     htm = """
-    <style>
-        span[data-baseweb="tag"][aria-label="Right Shoulder, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorshldr};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Left Shoulder, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorshldl};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Right Elbow, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorelbr};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Left Elbow, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorelbl};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Right Wrist, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorwrsr}; color: black"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Left Wrist, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorwrsl}; color: black"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Right Hip, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorhipr};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Left Hip, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorhipl};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Right Knee, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorknr};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Left Knee, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorknl};"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Right Ankle, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorankr}; color: black"""
-    htm +=  """}"""
-    htm += """    span[data-baseweb="tag"][aria-label="Left Ankle, close by backspace"]{"""
-    htm += f"""
-            background-color: {colorankl}; color: black"""
-    htm +=  """}"""
-
+    <style>"""
+    # Joint tags in the plot selection take the joint's color, with dark text on light colors
+    for joint in default_schema().joints:
+        color = color_discrete_map[joint]
+        red, green, blue = core.hex_to_rgb(color)
+        text = 'color: black' if 0.299 * red + 0.587 * green + 0.114 * blue > 186 else ''
+        htm += f"""    span[data-baseweb="tag"][aria-label="{joint}, close by backspace"]{{
+            background-color: {color}; {text}}}"""
     htm += """</style>"""
     st.markdown(htm, unsafe_allow_html=True)
+    cache_stats = get_result_cache().stats()
+    st.caption(f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+               f"{cache_stats['entries']} entries using {cache_stats['bytes'] / 1e6:.1f} of {cache_stats['max_bytes'] / 1e6:.0f} MB")
+    if diagnostics:
+        # One-off costs of this server process and of the first inference worker, next to the service's load
+        startup = dict(startup_times())
+        warmed = [future.result() for future in warm_pose_model(detectconfidence, trackconfidence) if future.done() and not future.exception()]
+        if warmed:
+            startup.update({name: value for name, value in warmed[0].items() if name not in startup})
+        cold_start = [f"{label} {startup[name]:.2f} s"
+                      for name, label in [('imports_seconds', 'imports'), ('first_render_seconds', 'first page'),
+                                          ('mediapipe_import_seconds', 'MediaPipe import'), ('first_model_load_seconds', 'model load'),
+                                          ('first_warmup_seconds', 'warm-up')]
+                      if startup.get(name) is not None]
+        st.caption(f"Cold start: {', '.join(cold_start)}")
+        service_stats = get_inference_service().stats()
+        seconds = lambda value: '-' if value is None else f"{value:.1f}"
+        st.caption(f"Inference: {service_stats['running']} of {service_stats['workers']} workers busy ({service_stats['segment_workers']} processes each), {service_stats['queued']} queued, "
+                   f"{service_stats['rejected']} turned away. Queue wait p50/p95 {seconds(service_stats['queue_wait_p50'])}/{seconds(service_stats['queue_wait_p95'])} s, "
+                   f"processing p50/p95 {seconds(service_stats['processing_p50'])}/{seconds(service_stats['processing_p95'])} s")
+
+# Every upload is analyzed by a background job; the page polls them while any is active
+video_file = None
+job = None
+active_jobs = False
+if video_files:
+    with upload:
+        submitted = []
+        for upload_file in video_files:
+            upload_job, rejection = submit_analysis(upload_file)
+            submitted.append((upload_job, rejection))
+            if rejection is not None:
+                show_rejection(upload_file.name, rejection)
+                continue
+            if upload_job is None:
+                continue
+            show_job(upload_job)
+            active_jobs = active_jobs or upload_job.active
+        selected = st.selectbox("Show Results For", range(len(video_files)), format_func = lambda i: video_files[i].name) if len(video_files) > 1 else 0
+    video_file = video_files[selected]
+    job, rejection = submitted[selected]
 
-if video_file is not None:
+if video_file is not None and rejection is None and (job is None or job.status == 'done'):
     with analysis:
-        # Process the video to extract pose keypoints
-        st.session_state.df_pose, st.session_state.key_arr = extract_pose_keypoints(video_file, fps, detectconfidence, trackconfidence, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize)
+        # The job left the landmarks and video in the result cache, so this only reads them back;
+        # without a job the landmarks were cached already and only the overlay is drawn here
+        st.session_state.pose_store, st.session_state.key_arr = extract_pose_keypoints(video_file, fps, detectconfidence, trackconfidence, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling, get_inference_service().segment_workers, profile, NULL_METRICS, None, inference_height, roi, keyframe_interval, optical_flow, upload_hash(video_file))
         # Calculate joint angles
         with upload:
           container_left, container_right = st.columns(2)
           container_left.video(st.session_state.key_arr)
-        df_joint_angles = calculate_joint_angles(st.session_state.df_pose)
-        # Perform exponential weighted mean on joint angles to smooth data
-        df_joint_angles = df_joint_angles.ewm(com=1.5, adjust = False).mean()
+          if diagnostics and job is not None:
+            with st.expander("Diagnostics", expanded = True):
+              show_diagnostics(job.result)
+        # Smoothed joint angles, their derivatives and summary statistics
+        df_kinematics, df_summary = calculate_kinematics(st.session_state.pose_store, use_3d = angles3d)
+        df_joint_angles = df_kinematics['angle'].copy()
         # Slider to display specific time of values
         if 'slide_value' not in st.session_state:
             st.session_state['slide_value'] = 0.0
         #rs, c, ls = st.columns(3)
-        step = st.session_state.df_pose['Frame'].iloc[1] - st.session_state.df_pose['Frame'].iloc[0]
-        max_step = st.session_state.df_pose['Frame'].max()
+        timestamps = st.session_state.pose_store.timestamps
+        step = float(timestamps[1] - timestamps[0]) if len(timestamps) > 1 else 1.0
+        max_step = float(timestamps.max())
+        # The annotated frame and angles at the slider position come straight from the
+        # frame store and the angle table by index, so scrubbing never decodes video
+        frame_store = get_frame_store(pose_video_key(upload_hash(video_file), st.session_state.pose_store, fps, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize, sampling, profile))
+        with upload:
+          # Keep the position inside this video, which can be shorter than the last one
+          st.session_state['slide_value'] = min(max(float(st.session_state['slide_value']), float(timestamps.min())), max_step)
+          st.slider("Scrub", min_value = float(timestamps.min()), max_value = max(max_step, float(timestamps.min()) + step), step = step, key = 'slide_value', format = '%.2f s',
+                    help = 'Show the annotated frame and joint angles at this moment.')
+          frame_index = frame_store.index_at(st.session_state['slide_value']) if frame_store is not None else min(int(np.searchsorted(timestamps, st.session_state['slide_value'])), len(timestamps) - 1)
+          if frame_store is not None:
+            scrub_left, scrub_right = st.columns(2)
+            scrub_left.image(frame_store.jpeg(frame_index), caption = f"{frame_store.timestamps[frame_index]:.2f} s", use_container_width = True)
+            scrub_right.dataframe(df_kinematics.iloc[frame_index].unstack(level = 'quantity')[['angle', 'velocity']].loc[jnt].round(1), use_container_width = True)
+        angles_key = video_hash(np.ascontiguousarray(df_joint_angles.to_numpy()))
         df_joint_angles['time'] = df_joint_angles.index
         # Create joint line plot
-        joint_line_plot = create_joint_line_plot(df_joint_angles, jnt, 
-                                                 slide = int(st.session_state['slide_value'] * fps), 
+        joint_line_plot = create_joint_line_plot(angles_key, df_joint_angles, jnt, 
+                                                 interactive = True, 
                                                  color_discrete_map=color_discrete_map,
                                                 height = 500)
-        joint_line_plot_ms = create_joint_line_plot(df_joint_angles, jnt, 
-                                                 slide = int(st.session_state['slide_value'] * fps), 
+        joint_line_plot_ms = create_joint_line_plot(angles_key, df_joint_angles, jnt, 
+                                                 interactive = True, 
                                                  color_discrete_map=color_discrete_map,
                                                 height = 200)
-        st.download_button("Download Joint Angles", df_joint_angles.to_csv(), use_container_width=True)
+        # Cached figures come back as copies, so the marker of the scrub position never reaches the cache
+        for figure in (joint_line_plot, joint_line_plot_ms):
+            figure.add_vline(x = df_joint_angles['time'].iloc[frame_index], line_color = 'grey')
         container_right.plotly_chart(joint_line_plot_ms, use_container_width=True, config= {'displaylogo': False})
         st.plotly_chart(joint_line_plot, use_container_width=True, config= {'displaylogo': False})
         le, ri = st.columns(2)
         for joint in jnt:
-            if joint.startswith("Left"):
+            # Joints of neither side, e.g. custom trunk angles, go in the left column
+            if not joint.startswith("Right"):
                 if 'Wrist' in joint or 'Ankle' in joint:
                     html_str = f"""<p style = 'background-color: {color_discrete_map[joint]};
                                     color: black;
@@ -605,11 +586,13 @@ if video_file is not None:
                                     {joint} 📐</style>
                                 <BR></p>"""
                 le.markdown(html_str, unsafe_allow_html=True)
-                le.code(f"Mean: {round(df_joint_angles[joint].mean(), 2)} degrees")
-                le.code(f"Min: {round(df_joint_angles[joint].min(), 2)} degrees")
-                le.code(f"Max: {round(df_joint_angles[joint].max(), 2)} degrees")
-                le.code(f"Range: {round(df_joint_angles[joint].max() - df_joint_angles[joint].min(), 2)} degrees")
-                le.plotly_chart(create_joint_line_plot(df_joint_angles, joint, slide = None, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
+                stats = df_summary.loc[('angle', joint)]
+                le.code(f"Mean: {round(stats['mean'], 2)} degrees")
+                le.code(f"Min: {round(stats['min'], 2)} degrees")
+                le.code(f"Max: {round(stats['max'], 2)} degrees")
+                le.code(f"Range: {round(stats['range'], 2)} degrees")
+                le.code(f"Median (5th-95th percentile): {round(stats['p50'], 2)} ({round(stats['p5'], 2)}-{round(stats['p95'], 2)}) degrees")
+                le.plotly_chart(create_joint_line_plot(angles_key, df_joint_angles, joint, interactive = False, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
                 le.write("____")
         for joint in jnt:
             if joint.startswith("Right"):
@@ -636,33 +619,36 @@ if video_file is not None:
                                     {joint} 📐</style>
                                 <BR></p>"""
                 ri.markdown(html_str, unsafe_allow_html=True)
-                ri.code(f"Mean: {round(df_joint_angles[joint].mean(), 2)} degrees")
-                ri.code(f"Min: {round(df_joint_angles[joint].min(), 2)} degrees")
-                ri.code(f"Max: {round(df_joint_angles[joint].max(), 2)} degrees")
-                ri.code(f"Range: {round(df_joint_angles[joint].max() - df_joint_angles[joint].min(), 2)} degrees")
-                ri.plotly_chart(create_joint_line_plot(df_joint_angles, joint, slide = None, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
+                stats = df_summary.loc[('angle', joint)]
+                ri.code(f"Mean: {round(stats['mean'], 2)} degrees")
+                ri.code(f"Min: {round(stats['min'], 2)} degrees")
+                ri.code(f"Max: {round(stats['max'], 2)} degrees")
+                ri.code(f"Range: {round(stats['range'], 2)} degrees")
+                ri.code(f"Median (5th-95th percentile): {round(stats['p50'], 2)} ({round(stats['p5'], 2)}-{round(stats['p95'], 2)}) degrees")
+                ri.plotly_chart(create_joint_line_plot(angles_key, df_joint_angles, joint, interactive = False, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
                 ri.write("____")
 
     with data:
-        st.download_button("Download Joint Velocities", df_joint_angles.diff(fps).abs().to_csv(), use_container_width=True)
+        show_export(st.session_state.pose_store, df_kinematics, df_summary, angles3d, video_file.name)
+        save_to_library(st.session_state.pose_store, df_kinematics, df_summary, video_file.name)
+        st.download_button("Download Summary Statistics", df_summary.to_csv(), file_name = 'movesense_summary.csv', use_container_width=True)
         # Create joint velocity plot
-        joint_velocity_plot = create_joint_velocity_plot(df_joint_angles, 
+        joint_velocity_plot = create_joint_velocity_plot(angles_key, df_kinematics['speed'], 
                                                          jnt, 
-                                                         fps,
-                                                         slide = int(st.session_state['slide_value'] * fps), 
+                                                         interactive = True, 
                                                          color_discrete_map=color_discrete_map,
                                                         height = 500)
-        joint_velocity_plot_ms = create_joint_velocity_plot(df_joint_angles, 
+        joint_velocity_plot_ms = create_joint_velocity_plot(angles_key, df_kinematics['speed'], 
                                                          jnt, 
-                                                         fps,
-                                                         slide = int(st.session_state['slide_value'] * fps), 
+                                                         interactive = True, 
                                                          color_discrete_map=color_discrete_map,
                                                         height = 200)
         st.plotly_chart(joint_velocity_plot, use_container_width=True, config= {'displaylogo': False})
         container_right.plotly_chart(joint_velocity_plot_ms, use_container_width=True, config= {'displaylogo': False})
         le, ri = st.columns(2)
         for joint in jnt:
-            if joint.startswith("Left"):
+            # Joints of neither side, e.g. custom trunk angles, go in the left column
+            if not joint.startswith("Right"):
                 if 'Wrist' in joint or 'Ankle' in joint:
                     html_str = f"""<p style = 'background-color: {color_discrete_map[joint]};
                                     color: black;
@@ -686,11 +672,13 @@ if video_file is not None:
                                     {joint} 💨</style>
                                 <BR></p>"""
                 le.markdown(html_str, unsafe_allow_html=True)
-                le.code(f"Mean: {round(df_joint_angles[joint].diff(fps).abs().mean(), 2)} degrees")
-                le.code(f"Min: {round(df_joint_angles[joint].diff(fps).abs().min(), 2)} degrees")
-                le.code(f"Max: {round(df_joint_angles[joint].diff(fps).abs().max(), 2)} degrees")
-                le.code(f"Range: {round(df_joint_angles[joint].diff(fps).abs().max() - df_joint_angles[joint].min(), 2)} degrees")
-                le.plotly_chart(create_joint_velocity_plot(df_joint_angles, joint, fps, slide = None, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
+                stats = df_summary.loc[('speed', joint)]
+                le.code(f"Mean: {round(stats['mean'], 2)} degrees/second")
+                le.code(f"Min: {round(stats['min'], 2)} degrees/second")
+                le.code(f"Max: {round(stats['max'], 2)} degrees/second")
+                le.code(f"Range: {round(stats['range'], 2)} degrees/second")
+                le.code(f"Median (5th-95th percentile): {round(stats['p50'], 2)} ({round(stats['p5'], 2)}-{round(stats['p95'], 2)}) degrees/second")
+                le.plotly_chart(create_joint_velocity_plot(angles_key, df_kinematics['speed'], joint, interactive = False, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
                 le.write("____")
         for joint in jnt:
             if joint.startswith("Right"):
@@ -717,14 +705,72 @@ if video_file is not None:
                                     {joint} 💨</style>
                                 <BR></p>"""
                 ri.markdown(html_str, unsafe_allow_html=True)
-                ri.code(f"Mean: {round(df_joint_angles[joint].diff(fps).abs().mean(), 2)} degrees")
-                ri.code(f"Min: {round(df_joint_angles[joint].diff(fps).abs().min(), 2)} degrees")
-                ri.code(f"Max: {round(df_joint_angles[joint].diff(fps).abs().max(), 2)} degrees")
-                ri.code(f"Range: {round(df_joint_angles[joint].diff(fps).abs().max() - df_joint_angles[joint].min(), 2)} degrees")
-                ri.plotly_chart(create_joint_velocity_plot(df_joint_angles, joint, fps, slide = None, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
+                stats = df_summary.loc[('speed', joint)]
+                ri.code(f"Mean: {round(stats['mean'], 2)} degrees/second")
+                ri.code(f"Min: {round(stats['min'], 2)} degrees/second")
+                ri.code(f"Max: {round(stats['max'], 2)} degrees/second")
+                ri.code(f"Range: {round(stats['range'], 2)} degrees/second")
+                ri.code(f"Median (5th-95th percentile): {round(stats['p50'], 2)} ({round(stats['p5'], 2)}-{round(stats['p95'], 2)}) degrees/second")
+                ri.plotly_chart(create_joint_velocity_plot(angles_key, df_kinematics['speed'], joint, interactive = False, color_discrete_map = color_discrete_map, height = 260), use_container_width = True, config= {'displaylogo': False, 'renderer': 'svg', 'staticPlot': True})
                 ri.write("____")
+elif video_file is not None:
+    with analysis:
+        # Angles of the frames analyzed so far, refreshed while the job runs
+        partial_store = job.partial if job is not None else None
+        if job is None:
+            st.warning(f"{video_file.name} was not analyzed: {rejection}", icon = '⏳')
+        elif partial_store is not None and len(partial_store) > 1:
+            st.info(f"Analyzing {video_file.name}: showing the first {len(partial_store)} frames", icon = '⏳')
+            df_partial = core.smooth_joint_angles(core.calculate_joint_angles(partial_store, use_3d = angles3d))
+            partial_plot = plotting.series_figure(df_partial, jnt, color_discrete_map, 500)
+            partial_plot.update_xaxes(tickformat="%H:%M:%S", title = 'Seconds (HH:MM:SS)')
+            partial_plot.update_yaxes(range=[0,190], title = 'Angle (degrees)')
+            st.plotly_chart(partial_plot, use_container_width=True, config= {'displaylogo': False})
+        elif job.active:
+            st.info(f"Waiting for the analysis of {video_file.name} to start", icon = '⏳')
+        else:
+            st.error(f"No results for {video_file.name}", icon = '📁')
+    with data:
+        st.info("Velocities are shown once the analysis is done", icon = '⏳')
 else:
     with analysis:
         st.error("Upload Video", icon = '📁')
     with data:
         st.error("Upload Video", icon = '📁')
+
+with library:
+    show_library()
+
+with live:
+    # Runs until the source ends or the page is changed; any widget change stops the loop
+    l, r = st.columns(2)
+    live_source = l.selectbox("Live Source", options = live_sources(), format_func = lambda source: f'Camera {source}' if source.isdigit() else source,
+                              help = 'A camera of the server (Camera 0 is the default one) or a stream or video file the server is configured to allow.')
+    latency_budget = r.number_input("Latency Budget (ms)", value = 250, min_value = 50, max_value = 5000, step = 50, help = 'Frames that have waited longer than this when pose estimation is ready for them are skipped, so the display never falls behind the source.')
+    realtime = l.checkbox("Replay Files in Real Time", value = True, help = 'Play video files at their recorded frame rate, as a camera would deliver them, instead of as fast as they decode.')
+    run_live = r.checkbox("Run Live Analysis", value = False, disabled = live_source is None)
+    if run_live:
+        frame_view, angle_view = st.columns(2)
+        frame_slot = frame_view.empty()
+        stats_slot = frame_view.empty()
+        angle_slot = angle_view.empty()
+        session = LiveSession(live_source, detectconfidence, trackconfidence, color_discrete_map, textscale, textsize, angletextcolor, linesize, markersize,
+                              latency_budget = latency_budget / 1000, realtime = realtime, inference_height = inference_height, roi = roi)
+        try:
+            for update in session.run():
+                stats = update['stats']
+                frame_slot.image(update['frame'], channels = 'RGB', use_container_width = True)
+                stats_slot.caption(f"{stats['fps']:.1f} fps, latency {stats['latency_p50_ms']:.0f} ms (95th percentile {stats['latency_p95_ms']:.0f} ms), "
+                                   f"{stats['processed']} frames analyzed, {stats['dropped'] + stats['stale']} skipped")
+                # Smoothed with past frames only, so values update as each frame arrives
+                angle_slot.dataframe(pd.DataFrame({'Angle (degrees)': update['angles'], 'Velocity (degrees/second)': update['velocities']},
+                                                  index = session.joints).loc[jnt].round(1), use_container_width = True)
+        except ValueError as error:
+            st.error(str(error))
+
+startup_times().setdefault('first_render_seconds', time.perf_counter() - script_start)
+
+if active_jobs:
+    # Poll the background jobs; reruns stop once none are queued or running
+    time.sleep(1)
+    st.rerun()
@@ -0,0 +1,32 @@
+# Stand-in for MediaPipe in tests: a Pose that finds the synthetic figure by its
+# color and spreads the 33 landmarks over its bounding box. Landmarks depend on
+# the frame alone, so runs over the same frames give the same landmarks.
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class Pose:
+    def __init__(self, static_image_mode = False, min_detection_confidence = 0.5, min_tracking_confidence = 0.5):
+        pass
+
+    def process(self, image):
+        ys, xs = np.nonzero(image[:, :, 0] > 150)
+        if len(xs) == 0:
+            return SimpleNamespace(pose_landmarks=None)
+        height, width = image.shape[:2]
+        x0, x1 = xs.min() / width, xs.max() / width
+        y0, y1 = ys.min() / height, ys.max() / height
+        steps = np.linspace(0, 1, 33)
+        landmark = [SimpleNamespace(x=x0 + (x1 - x0) * s, y=y0 + (y1 - y0) * (1 - s), z=float(xs.mean() / width), visibility=1.0)
+                    for s in steps]
+        return SimpleNamespace(pose_landmarks=SimpleNamespace(landmark=landmark))
+
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+
+solutions = SimpleNamespace(pose=SimpleNamespace(Pose=Pose))
@@ -0,0 +1,29 @@
+import json
+import os
+
+import pytest
+
+from movesense.analytics import AnalyticsStore
+
+
+@pytest.fixture
+def library(tmp_path):
+    store = AnalyticsStore(str(tmp_path))
+    records = [{'session_id': 'a', 'name': 'squat', 'subject': 'A', 'recorded': '2026-01-01T00:00:00', 'added': '2026-01-01T00:00:00', 'right_knee_angle_range': 80.0},
+               {'session_id': 'b', 'name': 'lunge', 'subject': 'B', 'recorded': '2026-02-01T00:00:00', 'added': '2026-02-01T00:00:00', 'right_knee_angle_range': 120.0}]
+    with open(os.path.join(store.directory, 'index.jsonl'), 'w') as f:
+        f.writelines(json.dumps(record) + '\n' for record in records)
+    return store
+
+
+def test_filter_selects_sessions(library):
+    assert list(library.sessions("right_knee_angle_range < 90 and subject == 'A'").index) == ['a']
+    assert list(library.sessions("not subject == 'A' or recorded < '2025-01-01'").index) == ['b']
+    assert list(library.sessions("-5 < right_knee_angle_range <= 120").index) == ['a', 'b']
+
+
+@pytest.mark.parametrize('query', ["name.__class__ == 'x'", "subject == name.upper()", "__import__('os')",
+                                   "subject == @x", "subject in ['A']", "frames > 1"])
+def test_filter_refuses_anything_but_comparisons(library, query):
+    with pytest.raises(ValueError):
+        library.sessions(query)
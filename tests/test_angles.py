@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import figure_landmarks
+from movesense import core
+from movesense.schema import DEFAULT_SCHEMA, JointSchema, merge_schema
+
+# The trunk-lean example of the schema documentation
+TRUNK_LEAN = {'points': {'mid_shoulder': {'mean': ['left_shoulder', 'right_shoulder']},
+                         'mid_hip': {'mean': ['left_hip', 'right_hip']},
+                         'above_mid_hip': {'mean': ['left_hip', 'right_hip'], 'offset': [0, -0.1, 0]}},
+              'angles': {'Trunk Lean': {'points': ['mid_shoulder', 'mid_hip', 'above_mid_hip'], 'color': '#00a000'}}}
+
+
+def figure_store(n_frames = 60, missing = (5, 17)):
+    # Landmark store of the synthetic figure with a few frames without a detection
+    store = core.LandmarkStore()
+    for i, landmarks in enumerate(figure_landmarks(n_frames, 30)):
+        store.append(None if i in missing else landmarks, i / 30)
+    return store.trim()
+
+
+def loop_joint_angles(store):
+    # The per-frame loop compute_joint_angles replaced
+    rows = []
+    for landmarks, valid in zip(store.landmarks, store.valid):
+        row = {}
+        for joint, (a, b, c) in core.JOINT_ANGLE_TRIPLETS.items():
+            if not valid:
+                row[joint] = np.nan
+                continue
+            v1 = landmarks[a, :2].astype(np.float64) - landmarks[b, :2]
+            v2 = landmarks[c, :2].astype(np.float64) - landmarks[b, :2]
+            row[joint] = np.degrees(np.arccos(np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))))
+        rows.append(row)
+    return pd.DataFrame(rows, index=store.time_index())
+
+
+def test_joint_angles_match_the_frame_loop():
+    store = figure_store()
+    expected = loop_joint_angles(store)
+    df_joint_angles = core.calculate_joint_angles(store, schema=JointSchema(DEFAULT_SCHEMA))
+    pd.testing.assert_frame_equal(df_joint_angles, expected[df_joint_angles.columns], check_exact=False, atol=1e-4)
+
+
+def test_joint_angles_are_nan_for_frames_without_landmarks():
+    store = figure_store(missing=(0, 5, 17))
+    df_joint_angles = core.calculate_joint_angles(store, schema=JointSchema(DEFAULT_SCHEMA))
+    assert df_joint_angles.iloc[[0, 5, 17]].isna().all().all()
+    assert df_joint_angles.drop(df_joint_angles.index[[0, 5, 17]]).notna().all().all()
+
+
+@pytest.mark.parametrize('definition', [DEFAULT_SCHEMA, merge_schema(DEFAULT_SCHEMA, TRUNK_LEAN)], ids=['default', 'trunk lean'])
+def test_overlay_angles_match_joint_angles(definition):
+    schema = JointSchema(definition)
+    store = figure_store()
+    renderer = core.OverlayRenderer({}, 0.5, 1, 'White', 1, 2, schema=schema)
+    df_joint_angles = core.calculate_joint_angles(store, schema=schema)
+    assert list(df_joint_angles.columns) == schema.joints
+    for landmarks, valid, (_, expected) in zip(store.landmarks, store.valid, df_joint_angles.iterrows()):
+        if valid:
+            np.testing.assert_allclose(renderer.frame_angles(landmarks), expected.to_numpy(), rtol=1e-6)
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+import pytest
+
+from movesense.cache import ResultCache, landmarks_key
+from movesense.cli import build_parser
+
+
+def test_cli_and_app_share_landmark_keys():
+    options = build_parser().parse_args(['clip.mp4'])
+    cli_key = landmarks_key('digest', options.fps, options.detect_confidence, options.track_confidence, options.sampling,
+                            options.inference_height, options.roi, options.keyframe_interval, options.optical_flow)
+    # The app's number inputs give an int fps
+    app_key = landmarks_key('digest', 3, 0.85, 0.85, 'grab', None, False, 1, False)
+    assert cli_key == app_key
+
+
+def age(cache, key, suffix, seconds_ago):
+    path = cache._path(key, suffix)
+    mtime = time.time() - seconds_ago
+    os.utime(path, (mtime, mtime))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=3000)
+    for i, key in enumerate(['aa01', 'bb02', 'cc03']):
+        cache.put_video(key, b'x' * 1000)
+        age(cache, key, '.mp4', 300 - 100 * i)
+    # Reading the oldest entry makes it the most recently used
+    assert cache.get_video('aa01') == b'x' * 1000
+    cache.put_video('dd04', b'x' * 1000)
+    assert cache.has_video('aa01')
+    assert not cache.has_video('bb02')
+    assert cache.has_video('cc03') and cache.has_video('dd04')
+    assert cache.stats()['bytes'] == 3000
+    assert cache.get_video('bb02') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_failed_write_leaves_nothing(tmp_path):
+    cache = ResultCache(str(tmp_path))
+
+    def write(f):
+        f.write(b'half a video')
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        cache._write('aa01', '.mp4', write)
+    assert not cache.has_video('aa01')
+    assert [name for _, _, names in os.walk(tmp_path) for name in names if not name.startswith('.')] == []
+
+
+def test_concurrent_writers_stay_in_budget(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=20000)
+
+    def write(worker):
+        for i in range(20):
+            cache.put_video(f'{worker:02x}{i:04x}', bytes([worker]) * 1000)
+
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['bytes'] <= 20000
+    assert stats['entries'] == stats['bytes'] // 1000
+    # A second cache on the same directory, as another app process would have, sees the same entries
+    assert ResultCache(str(tmp_path), max_bytes=20000).stats()['entries'] == stats['entries']
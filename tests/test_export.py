@@ -0,0 +1,75 @@
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import figure_landmarks
+from movesense import analytics, core, export
+from movesense.analytics import AnalyticsStore
+
+
+@pytest.fixture
+def session():
+    store = core.LandmarkStore()
+    for i, landmarks in enumerate(figure_landmarks(40, 10)):
+        store.append(None if i == 7 else landmarks, i / 10)
+    store = store.trim()
+    df_kinematics = core.compute_kinematics(core.smooth_joint_angles(core.calculate_joint_angles(store)))
+    return store, df_kinematics, core.summarize_kinematics(df_kinematics)
+
+
+def test_parquet_round_trip(session):
+    pytest.importorskip('pyarrow')
+    store, df_kinematics, df_summary = session
+    frame = pd.read_parquet(io.BytesIO(export.export_session(store, df_kinematics, df_summary, 'parquet')))
+    np.testing.assert_array_equal(frame['time'], store.timestamps)
+    np.testing.assert_array_equal(frame['detected'], store.valid)
+    np.testing.assert_array_equal(frame['left_knee_x'], store.landmarks[:, 25, 0])
+    np.testing.assert_allclose(frame['right_knee_angle'], df_kinematics[('angle', 'Right Knee')], rtol=1e-6)
+
+
+def test_arrow_round_trip_carries_the_summary(session):
+    pa = pytest.importorskip('pyarrow')
+    store, df_kinematics, df_summary = session
+    table = pa.ipc.open_file(pa.BufferReader(export.export_session(store, df_kinematics, df_summary, 'arrow'))).read_all()
+    assert table.num_rows == len(store)
+    summary = json.loads(table.schema.metadata[b'movesense.summary'])
+    assert summary['right_knee_angle']['max'] == pytest.approx(df_summary.loc[('angle', 'Right Knee'), 'max'])
+
+
+def test_hdf5_round_trip(session):
+    h5py = pytest.importorskip('h5py')
+    store, df_kinematics, df_summary = session
+    with h5py.File(io.BytesIO(export.export_session(store, df_kinematics, df_summary, 'hdf5')), 'r') as h5:
+        np.testing.assert_array_equal(h5['landmarks'][:], store.landmarks)
+        assert [joint.decode() for joint in h5['joints'][:]] == list(df_kinematics['angle'].columns)
+
+
+def test_npz_round_trip(session):
+    store, df_kinematics, df_summary = session
+    with np.load(io.BytesIO(export.export_session(store, df_kinematics, df_summary, 'npz'))) as data:
+        np.testing.assert_array_equal(data['landmarks'], store.landmarks)
+        np.testing.assert_array_equal(data['valid'], store.valid)
+        knee = list(data['joints']).index('Right Knee')
+        np.testing.assert_allclose(data['kinematics'][:, 0, knee], df_kinematics[('angle', 'Right Knee')], rtol=1e-6)
+
+
+def test_formats_without_their_package_are_not_offered(session, monkeypatch):
+    monkeypatch.setitem(export.EXPORT_REQUIREMENTS, 'parquet', 'movesense_missing_package')
+    assert 'parquet' not in export.available_formats()
+    assert export.missing_formats()['parquet'] == 'movesense_missing_package'
+    with pytest.raises(ImportError):
+        export.export_session(*session, 'parquet')
+
+
+def test_library_falls_back_to_npz(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(analytics, 'series_format', lambda: 'npz')
+    store, df_kinematics, df_summary = session
+    library = AnalyticsStore(str(tmp_path))
+    session_id = library.add_session(store, df_kinematics, df_summary, name='squat')
+    assert os.path.exists(os.path.join(str(tmp_path), 'sessions', session_id, 'series.npz'))
+    series = library.series([session_id], 'Right Knee')[session_id]
+    np.testing.assert_allclose(series.to_numpy(), df_kinematics[('angle', 'Right Knee')].to_numpy(), rtol=1e-6)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from movesense.frames import FrameStore, FrameStoreWriter
+
+
+def write_store(path, timestamps):
+    with open(path, 'wb') as f:
+        writer = FrameStoreWriter(f)
+        for i, t in enumerate(timestamps):
+            writer.append(np.full((8, 8, 3), i * 10 % 256, dtype=np.uint8), t)
+        writer.close()
+    return FrameStore(path)
+
+
+def test_index_at_uniform(tmp_path):
+    store = write_store(tmp_path / 'frames.bin', [i / 30 for i in range(30)])
+    assert len(store) == 30
+    assert store.index_at(0) == 0
+    assert store.index_at(10 / 30) == 10
+    assert store.index_at(10.4 / 30) == 10
+    assert store.index_at(10.6 / 30) == 11
+    store.close()
+
+
+def test_index_at_clamps(tmp_path):
+    store = write_store(tmp_path / 'frames.bin', [1.0, 1.5, 2.0])
+    assert store.index_at(-5) == 0
+    assert store.index_at(100) == 2
+    store.close()
+
+
+def test_index_at_jittered(tmp_path):
+    # Variable frame rate: the uniform estimate lands on a neighbour of the nearest frame
+    timestamps = [0.0, 0.01, 0.02, 0.5, 0.98, 0.99, 1.0]
+    store = write_store(tmp_path / 'frames.bin', timestamps)
+    for seconds in np.linspace(-0.1, 1.1, 61):
+        assert store.index_at(seconds) == int(np.argmin(np.abs(np.asarray(timestamps) - seconds)))
+    store.close()
+
+
+def test_single_frame(tmp_path):
+    store = write_store(tmp_path / 'frames.bin', [0.0])
+    assert store.index_at(3.0) == 0
+    assert store.frame(0).shape == (8, 8, 3)
+    store.close()
+
+
+def test_not_a_frame_store(tmp_path):
+    path = tmp_path / 'frames.bin'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        FrameStore(path)
@@ -0,0 +1,38 @@
+import numpy as np
+
+from movesense import core
+
+
+class StubEstimator:
+    # Landmarks for each frame from a table, by the frame's value
+    def __init__(self, table):
+        self.table = table
+        self.calls = []
+
+    def process(self, frame):
+        self.calls.append(int(frame[0, 0, 0]))
+        return self.table[int(frame[0, 0, 0])]
+
+
+def frames(n):
+    return [(i / 10, np.full((4, 4, 3), i, dtype=np.uint8)) for i in range(n)]
+
+
+def pose(value):
+    return np.full((core.LandmarkStore.NUM_LANDMARKS, 4), value, dtype=np.float32)
+
+
+def test_keyframes_interpolate_between_detections():
+    estimator = StubEstimator({0: pose(0.0), 4: pose(0.4), 8: pose(0.8)})
+    results = list(core.keyframe_landmarks(frames(9), estimator, 4))
+    assert estimator.calls == [0, 4, 8]
+    assert [t for t, _ in results] == [i / 10 for i in range(9)]
+    for i, (_, landmarks) in enumerate(results):
+        np.testing.assert_allclose(landmarks, pose(i / 10), atol=1e-6)
+
+
+def test_keyframes_without_still_estimator_leave_gaps_to_a_missing_detection_empty():
+    estimator = StubEstimator({0: pose(0.0), 4: None, 8: pose(0.8)})
+    results = [landmarks for _, landmarks in core.keyframe_landmarks(frames(9), estimator, 4)]
+    assert all(landmarks is None for landmarks in results[1:8])
+    np.testing.assert_allclose(results[8], pose(0.8))
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import synthetic_case
+from movesense import core, models
+
+STUBS = os.path.join(os.path.dirname(__file__), 'stubs')
+
+
+@pytest.fixture
+def stub_mediapipe(monkeypatch):
+    # MediaPipe replaced by tests/stubs/mediapipe here and in the spawned segment workers
+    monkeypatch.syspath_prepend(STUBS)
+    monkeypatch.delitem(sys.modules, 'mediapipe', raising=False)
+    monkeypatch.setattr(models, '_default_pool', None)
+    yield
+    sys.modules.pop('mediapipe', None)
+
+
+def test_segment_parallel_matches_sequential(tmp_path, stub_mediapipe):
+    # 10 s is long enough for two segments after the warm-up
+    path, _ = synthetic_case(str(tmp_path), 160, 120, 30, 10)
+    sequential = core.extract_pose_landmarks(path, 5, 0.5, 0.5, workers=1)
+    parallel = core.extract_pose_landmarks(path, 5, 0.5, 0.5, workers=2)
+    assert len(sequential) > 40
+    np.testing.assert_array_equal(parallel.timestamps, sequential.timestamps)
+    np.testing.assert_array_equal(parallel.valid, sequential.valid)
+    np.testing.assert_allclose(parallel.landmarks, sequential.landmarks, atol=1e-6)
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from movesense import plotting
+
+
+def test_lttb_keeps_ends_and_extremes():
+    x = np.arange(10000, dtype=float)
+    y = np.sin(x / 500)
+    y[3333] = 50
+    y[6666] = -50
+    indices = plotting.lttb(x, y, 200)
+    assert len(indices) == 200
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert 3333 in indices and 6666 in indices
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lttb_short_series_unchanged():
+    np.testing.assert_array_equal(plotting.lttb(np.arange(5), np.arange(5), 10), np.arange(5))
+
+
+def test_downsample_keeps_gaps():
+    y = np.sin(np.arange(5000) / 100)
+    y[1000:1100] = np.nan
+    indices = plotting.downsample_indices(np.arange(5000), y, 100)
+    # The first missing value of the gap is kept so the line breaks there
+    assert 1000 in indices
+    assert np.isfinite(y[np.setdiff1d(indices, [1000])]).all()
+
+
+def test_series_figure_downsamples():
+    index = pd.to_datetime(np.arange(20000) / 30, unit='s')
+    df = pd.DataFrame({'Left Knee': 90 + 20 * np.sin(np.arange(len(index)) / 50)}, index=index)
+    df.iloc[12345, 0] = 180
+    figure = plotting.series_figure(df, ['Left Knee'], {'Left Knee': '#ff0000'}, 200)
+    assert len(figure.data) == 1
+    assert len(figure.data[0].y) <= plotting.MAX_POINTS
+    assert np.max(figure.data[0].y) == 180
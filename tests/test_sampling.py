@@ -0,0 +1,59 @@
+from fractions import Fraction
+
+import av
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import synthetic_case
+from movesense import core
+from movesense.metrics import RunMetrics
+
+
+def write_gop_video(path, keyint, n_frames = 600, fps = 30):
+    # Plain frames with a keyframe every keyint frames
+    container = av.open(path, 'w')
+    stream = container.add_stream('h264', Fraction(fps))
+    stream.width = 160
+    stream.height = 120
+    stream.pix_fmt = 'yuv420p'
+    stream.options = {'preset': 'ultrafast', 'g': str(keyint), 'keyint_min': str(keyint), 'sc_threshold': '0'}
+    for i in range(n_frames):
+        frame = np.full((120, 160, 3), i % 256, dtype=np.uint8)
+        for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format='rgb24')):
+            container.mux(packet)
+    for packet in stream.encode(None):
+        container.mux(packet)
+    container.close()
+    return path
+
+
+def sample(path, fps, sampling):
+    metrics = RunMetrics()
+    container = core.open_video_container(path)
+    try:
+        times = [t for t, _ in core.sampled_frames(container, fps, sampling, metrics = metrics)]
+    finally:
+        container.close()
+    return times, metrics.counters['frames_decoded']
+
+
+@pytest.fixture
+def long_gop_video(tmp_path):
+    # 240 frames with a single keyframe
+    path, _ = synthetic_case(str(tmp_path), 160, 120, 30, 8)
+    return path
+
+
+def test_seek_on_long_gop_decodes_no_more_than_grab(long_gop_video):
+    grab_times, grab_decoded = sample(long_gop_video, 0.4, 'grab')
+    seek_times, seek_decoded = sample(long_gop_video, 0.4, 'seek')
+    assert seek_times == pytest.approx(grab_times)
+    assert seek_decoded <= grab_decoded
+
+
+def test_seek_skips_frames_on_short_gop(tmp_path):
+    path = write_gop_video(str(tmp_path / 'gop.mp4'), keyint = 30)
+    grab_times, grab_decoded = sample(path, 0.4, 'grab')
+    seek_times, seek_decoded = sample(path, 0.4, 'seek')
+    assert seek_times == pytest.approx(grab_times)
+    assert seek_decoded < grab_decoded / 2
@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import Future
+
+import pytest
+
+from movesense.cache import ResultCache
+from movesense.metrics import RunMetrics
+from movesense.service import AdmissionError, InferenceService
+
+SETTINGS = {'fps': 10}
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # Videos are probed as (duration, frames) from their name, and jobs run
+    # until the test completes their futures instead of on the worker pool
+    service = InferenceService(ResultCache(str(tmp_path / 'cache')), workers=1, max_queued=4,
+                               max_session_frames=100, max_video_seconds=60)
+    service.futures = []
+
+    def probe(video, fps):
+        if isinstance(video, bytes):
+            return 30.0, 20
+        duration, frames = os.path.basename(video).split('-')
+        return float(duration), int(frames)
+
+    def submit(function, *args):
+        future = Future()
+        service.futures.append((args[0], future))
+        return service._executor, future
+
+    monkeypatch.setattr(service, '_probe', probe)
+    monkeypatch.setattr(service, '_submit', submit)
+    yield service
+    service.close()
+
+
+def complete(service, job):
+    for job_id, future in service.futures:
+        if job_id == job.id:
+            future.set_result(RunMetrics().to_dict())
+            return
+    raise AssertionError(f'{job.id} was never dispatched')
+
+
+def test_admission(service):
+    with pytest.raises(AdmissionError) as rejected:
+        service.submit('a', '90-100', 'k', SETTINGS)
+    assert rejected.value.estimated_wait is None
+    with pytest.raises(AdmissionError) as rejected:
+        service.submit('a', '30-150', 'k', SETTINGS)
+    assert rejected.value.estimated_wait is None
+    service.submit('a', '30-60', 'k', SETTINGS)
+    # Over the session's frame budget: waiting for its earlier video helps
+    with pytest.raises(AdmissionError) as rejected:
+        service.submit('a', '30-60', 'k', SETTINGS)
+    assert rejected.value.estimated_wait > 0
+    # Other sessions are not held to session a's budget
+    service.submit('b', '30-60', 'k', SETTINGS)
+    assert service.rejected == 3
+    assert service.stats()['rejected'] == 3
+
+
+def test_queue_full(service):
+    jobs = [service.submit(session, '10-10', 'k', SETTINGS) for session in 'abcde']
+    assert [job.status for job in jobs] == ['running'] + ['queued'] * 4
+    with pytest.raises(AdmissionError) as rejected:
+        service.submit('f', '10-10', 'k', SETTINGS)
+    assert rejected.value.estimated_wait > 0
+
+
+def test_round_robin(service):
+    a = [service.submit('a', '10-10', 'k', SETTINGS) for _ in range(3)]
+    b = [service.submit('b', '10-10', 'k', SETTINGS) for _ in range(2)]
+    order = []
+    while len(order) < 5:
+        job = next(job for job in a + b if job.status == 'running')
+        order.append(job)
+        complete(service, job)
+    # Session a's earlier uploads do not keep session b waiting
+    assert order == [a[0], b[0], a[1], b[1], a[2]]
+    assert all(job.status == 'done' for job in a + b)
+    assert service.stats()['sessions'] == 0
+
+
+def test_cancel_queued(service):
+    running = service.submit('a', '10-10', 'k', SETTINGS)
+    queued = service.submit('a', '10-10', 'k', SETTINGS)
+    queued.cancel()
+    complete(service, running)
+    assert queued.status == 'cancelled'
+    assert [job_id for job_id, _ in service.futures] == [running.id]
+
+
+def test_staged_once(service):
+    # Jobs of the same upload share one staged file, removed after the last of them
+    first = service.submit('a', b'video', 'k', SETTINGS)
+    second = service.submit('b', b'video', 'k', SETTINGS)
+    path = service._staged['k']['path']
+    with open(path, 'rb') as f:
+        assert f.read() == b'video'
+    complete(service, first)
+    assert os.path.exists(path)
+    complete(service, second)
+    assert not os.path.exists(path)
+    assert service._staged == {}